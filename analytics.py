@@ -0,0 +1,138 @@
+# ==============================================================================
+# analytics.py
+# 商品ごとの使用ペースを集計し、在庫切れまでの日数と発注点を予測します。
+#   - 使用ペースは指数移動平均（1日あたりの使用数）で持ち、使用登録のたびに O(1) で更新します。
+#   - 使用履歴からの集計は、起動時の全件と、その後に増えた分だけを一定時間ごとに加えます。
+#   - 予測は全商品分をまとめて NumPy / pandas で計算します。
+# ==============================================================================
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+SECONDS_PER_DAY = 86400.0
+# 使用ペースを平均する期間（日）。短い期間は急な増加を、長い期間は普段のペースを表します。
+DEFAULT_WINDOWS_DAYS = (7.0, 30.0)
+# 発注点の安全在庫の係数（1.65 で約95%の確率で発注から入荷までに在庫切れしない）
+DEFAULT_SERVICE_Z = 1.65
+
+STATUS_OUT = "在庫切れ"
+STATUS_REORDER = "要発注"
+STATUS_OK = "OK"
+
+
+class ConsumptionTracker:
+    """
+    ProductTag ごとの使用ペース（指数移動平均）を保持するクラス。
+    各期間 τ について r = Σ exp(-(現在 - 使用日時) / τ) / τ を持ち、使用のたびに
+    「前回からの経過時間分だけ減衰させて 1/τ を足す」だけで更新できます。
+    """
+
+    def __init__(self, windows_days=DEFAULT_WINDOWS_DAYS):
+        self.windows = np.asarray(windows_days, dtype=float)
+        self._index = {}  # ProductTag → 配列の行番号
+        self._rates = np.zeros((0, len(self.windows)))  # 行: 商品、列: 期間（1日あたりの使用数）
+        self._updated_at = np.zeros(0)  # 各行を最後に更新した時刻（UNIX秒）
+        self._lock = threading.Lock()
+
+    def load(self, tags, used_at, now=None):
+        """
+        使用履歴（ProductTag の配列と、使用日時の ISO 8601 文字列の配列）から集計を作り直す。
+        これまでの集計は破棄します。
+        """
+        with self._lock:
+            self._index = {}
+            self._rates = np.zeros((0, len(self.windows)))
+            self._updated_at = np.zeros(0)
+        self.merge(tags, used_at, now)
+
+    def merge(self, tags, used_at, now=None):
+        """
+        使用履歴（load と同じ形式）を今の集計に加える。
+        前回から増えた分の使用履歴だけを渡せば、全件を読み直さずに他のサーバーでの使用を反映できます。
+        """
+        now = time.time() if now is None else now
+        events = pd.DataFrame({
+            "tag": pd.Series(tags, dtype=object),
+            "used_at": pd.to_datetime(pd.Series(used_at, dtype=object), utc=True, errors="coerce"),
+        }).dropna()
+        codes, uniques = pd.factorize(events["tag"])
+        used_at_seconds = (events["used_at"] - pd.Timestamp(0, tz="UTC")).dt.total_seconds().to_numpy()
+        ages_days = np.maximum(now - used_at_seconds, 0.0) / SECONDS_PER_DAY
+        weights = np.exp(-ages_days[:, None] / self.windows) / self.windows
+        added = np.zeros((len(uniques), len(self.windows)))
+        np.add.at(added, codes, weights)
+
+        with self._lock:
+            rows = np.array([self._index.get(tag, -1) for tag in uniques], dtype=int)
+            for j in np.flatnonzero(rows < 0):
+                rows[j] = self._add_row(uniques[j], now)
+            # 今の集計を now の時点まで減衰させてから足します（now より後に記録された行は減衰させません）。
+            elapsed_days = np.maximum(now - self._updated_at, 0.0) / SECONDS_PER_DAY
+            self._rates = self._rates * np.exp(-elapsed_days[:, None] / self.windows)
+            self._updated_at = np.maximum(self._updated_at, now)
+            self._rates[rows] += added
+
+    def record(self, tag, at=None, count=1):
+        """使用を記録する（at は UNIX秒。使用登録のたびに呼ばれ、計算量は商品数によらず一定です）"""
+        at = time.time() if at is None else at
+        with self._lock:
+            i = self._index.get(tag)
+            if i is None:
+                i = self._add_row(tag, at)
+            elapsed_days = max(at - self._updated_at[i], 0.0) / SECONDS_PER_DAY
+            self._rates[i] = self._rates[i] * np.exp(-elapsed_days / self.windows) + count / self.windows
+            self._updated_at[i] = max(at, self._updated_at[i])
+
+    def _add_row(self, tag, at):
+        i = len(self._index)
+        self._index[tag] = i
+        self._rates = np.vstack([self._rates, np.zeros(len(self.windows))])
+        self._updated_at = np.append(self._updated_at, at)
+        return i
+
+    def rates(self, tags, now=None):
+        """指定した ProductTag の現在の使用ペース（行: 商品、列: 期間）を返す"""
+        now = time.time() if now is None else now
+        with self._lock:
+            rows = np.array([self._index.get(tag, -1) for tag in tags], dtype=int)
+            known = rows >= 0
+            result = np.zeros((len(rows), len(self.windows)))
+            elapsed_days = np.maximum(now - self._updated_at[rows[known]], 0.0) / SECONDS_PER_DAY
+            result[known] = self._rates[rows[known]] * np.exp(-elapsed_days[:, None] / self.windows)
+        return result
+
+
+def forecast(products, tracker, lead_time_days=7.0, service_z=DEFAULT_SERVICE_Z, now=None):
+    """
+    商品一覧（get_all_products の戻り値）に、使用ペース・在庫切れまでの日数・発注点・状態の列を加えた DataFrame を返す。
+    使用ペースは各期間のうち大きい方を使い、急に使われ始めた商品も早めに検出します。
+    商品に LeadTimeDays（発注から入荷までの日数）があればそちらを優先します。
+    """
+    df = pd.DataFrame(products)
+    if df.empty:
+        return df
+    tags = df["ProductTag"].tolist()
+    stock = pd.to_numeric(df.get("CurrentStock"), errors="coerce").fillna(0).to_numpy(dtype=float)
+    lead_time = lead_time_days
+    if "LeadTimeDays" in df:
+        lead_time = pd.to_numeric(df["LeadTimeDays"], errors="coerce").fillna(lead_time_days).to_numpy(dtype=float)
+
+    daily_rate = tracker.rates(tags, now).max(axis=1)
+    # 使用実績が無い商品は、在庫切れまでの日数を計算しません（無限大 → 空欄）。
+    with np.errstate(divide="ignore", invalid="ignore"):
+        days_left = np.where(daily_rate > 0, stock / daily_rate, np.inf)
+    # 発注点 = 入荷までの使用数 + 安全在庫（使用数をポアソン分布とみなしたばらつき分）
+    lead_demand = daily_rate * lead_time
+    reorder_point = np.ceil(lead_demand + service_z * np.sqrt(lead_demand))
+
+    df["DailyRate"] = daily_rate
+    df["DaysToStockout"] = pd.Series(days_left, index=df.index).replace(np.inf, np.nan)
+    df["ReorderPoint"] = reorder_point.astype(int)
+    df["Status"] = np.select(
+        [stock <= 0, (daily_rate > 0) & (stock <= reorder_point)],
+        [STATUS_OUT, STATUS_REORDER],
+        default=STATUS_OK,
+    )
+    return df
@@ -0,0 +1,117 @@
+# ==============================================================================
+# auth.py
+# パスワード照合（bcrypt）とログイン試行回数の制限を行います。
+# bcryptの照合は1回あたり数百ミリ秒CPUを使うため、同時に実行する数を制限します。
+# ==============================================================================
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
+import bcrypt
+import streamlit as st
+
+BUSY_MESSAGE = "ログインが混み合っています。しばらくしてから再度お試しください。"
+
+
+class LoginBusyError(Exception):
+    """照合待ちが上限に達していて、パスワードを照合できないときのエラー"""
+
+
+class PasswordVerifier:
+    """
+    bcryptの照合を専用のスレッドプールで行うクラス。
+    同時に実行する数を max_workers、待ち行列の長さを max_pending で制限し、
+    ログインが集中してもStreamlitのスレッドがすべてbcryptで埋まらないようにします。
+    """
+
+    def __init__(self, max_workers=2, max_pending=8, timeout=10.0):
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bcrypt")
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def _run(self, fn, *args):
+        """プールで fn を実行して結果を返す（待ち行列が一杯なら LoginBusyError）"""
+        if not self._slots.acquire(blocking=False):
+            raise LoginBusyError(BUSY_MESSAGE)
+        # 待ち時間切れで呼び出し元が戻っても、処理が終わるまで枠は解放しません。
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FuturesTimeoutError:
+            raise LoginBusyError(BUSY_MESSAGE)
+
+    def verify(self, password, hashed):
+        """パスワードがハッシュ値と一致するか調べる"""
+        if not password or not hashed:
+            return False
+        return self._run(bcrypt.checkpw, password.encode('utf-8'), hashed.encode('utf-8'))
+
+    def hash(self, password, rounds=12):
+        """パスワードをbcryptでハッシュ化する"""
+        return self._run(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+class LoginRateLimiter:
+    """
+    キー（研究室とユーザー名など）ごとに、一定時間内の失敗回数が上限を超えたら試行を止める。
+    キーを変えながらの総当たりに備え、全キー合計の失敗回数が global_max_failures を超えた場合もすべての試行を止めます。
+    """
+
+    def __init__(self, max_failures=5, window_seconds=300, global_max_failures=50):
+        self.max_failures = max_failures
+        self.window_seconds = window_seconds
+        self.global_max_failures = global_max_failures
+        self._failures = defaultdict(deque)
+        self._all_failures = deque()  # 全キーの失敗時刻
+        self._lock = threading.Lock()
+
+    def _prune(self, key, now):
+        failures = self._failures[key]
+        while failures and now - failures[0] > self.window_seconds:
+            failures.popleft()
+        if not failures:
+            del self._failures[key]
+        while self._all_failures and now - self._all_failures[0] > self.window_seconds:
+            self._all_failures.popleft()
+        return failures
+
+    def retry_after(self, key):
+        """試行できるまでの残り秒数を返す（試行できる場合は0）"""
+        now = time.monotonic()
+        with self._lock:
+            failures = self._prune(key, now)
+            oldest = []
+            if len(failures) >= self.max_failures:
+                oldest.append(failures[-self.max_failures])
+            if len(self._all_failures) >= self.global_max_failures:
+                oldest.append(self._all_failures[-self.global_max_failures])
+            if not oldest:
+                return 0
+            return int(self.window_seconds - (now - max(oldest))) + 1
+
+    def record_failure(self, key):
+        now = time.monotonic()
+        with self._lock:
+            self._failures[key].append(now)
+            self._all_failures.append(now)
+
+    def reset(self, key):
+        """key の失敗回数を消す（全キー合計の失敗回数は消しません）"""
+        with self._lock:
+            self._failures.pop(key, None)
+
+
+# 照合用のスレッドプールと試行回数の記録は st.cache_resource でプロセスに1つだけ作り、全セッションで共有します。
+@st.cache_resource(show_spinner=False)
+def get_password_verifier(max_workers=2, max_pending=8):
+    """共有のパスワード照合クラスを返す（初回の呼び出し時に作成）"""
+    return PasswordVerifier(max_workers, max_pending)
+
+
+@st.cache_resource(show_spinner=False)
+def get_rate_limiter(max_failures=5, window_seconds=300, global_max_failures=50):
+    """共有のログイン試行制限を返す（初回の呼び出し時に作成）"""
+    return LoginRateLimiter(max_failures, window_seconds, global_max_failures)
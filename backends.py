@@ -0,0 +1,334 @@
+# ==============================================================================
+# backends.py
+# database.py から使うデータストアの実装です。
+# Airtable（ネットワーク越し）とSQLite（ローカルファイル）を同じ操作で扱えます。
+# レコードはどちらも Airtable と同じ {'id': ..., 'fields': {...}} 形式でやり取りします。
+# ==============================================================================
+import json
+import re
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from pyairtable.formulas import field_name, match, quoted
+
+from scheduler import ScheduledApi
+
+# アプリで使用するテーブル名
+TABLE_NAMES = ("Products", "Users", "QRCodes")
+
+# Airtableが1回のリクエストで作成・更新できるレコード数（batch_create / batch_update はこの件数ずつ送られます）。
+# 書き込みを自分で分けて送り、送れた分ごとに記録を進める処理（sync / write_queue / 一括更新）もこの件数を使います。
+BATCH_SIZE = 10
+
+# SQLiteで索引を作るフィールド（検索条件によく使うもの）
+INDEXED_FIELDS = {
+    "Products": ("ProductTag",),
+    "Users": ("Username",),
+    "QRCodes": ("QRCodeID", "Status", "UsedAt", "UsedBy"),
+}
+
+# query_page で使える条件の種類（field, op, value）
+#   "="      : 完全一致
+#   "prefix" : 前方一致（文字列）
+#   "since"  : 日時が value 以降（value は ISO 8601 の UTC 文字列）
+#   "until"  : 日時が value より前
+#   "in"     : value（リスト）のいずれかと完全一致
+#   "numbered": value で始まり、残りが数字だけ（「商品タグ_連番」のQRCodeIDを商品タグで絞り込む用。
+#               "TIP_" で TIP_1 は一致し、別の商品 TIP_L_1 は一致しません）
+QUERY_OPS = ("=", "prefix", "since", "until", "in", "numbered")
+
+
+class AirtableBackend:
+    """Airtable（pyairtable）をそのまま使うバックエンド"""
+
+    name = "airtable"
+
+    def __init__(self, api_key, base_id, **api_options):
+        # リクエストはすべて scheduler.RequestScheduler を通ります（レート制限・再試行・読み取りのまとめ）。
+        self.api = ScheduledApi(api_key, **api_options)
+        self.base_id = base_id
+        self.tables = {name: self.api.table(base_id, name) for name in TABLE_NAMES}
+
+    def all(self, table, filters=None):
+        """条件（フィールド名 → 値 の完全一致）に合うレコードをすべて返す"""
+        if filters:
+            return self.tables[table].all(formula=match(filters))
+        return self.tables[table].all()
+
+    def get(self, table, record_id):
+        """レコードIDでレコードを1件取得する"""
+        return self.tables[table].get(record_id)
+
+    def create(self, table, fields):
+        """レコードを1件作成する"""
+        return self.tables[table].create(fields)
+
+    def batch_create(self, table, fields_list):
+        """レコードをまとめて作成する（BATCH_SIZE 件ずつ送信されます）"""
+        return self.tables[table].batch_create(fields_list)
+
+    def update(self, table, record_id, fields):
+        """レコードを1件更新する（指定したフィールドのみ）"""
+        return self.tables[table].update(record_id, fields)
+
+    def batch_update(self, table, records):
+        """{'id', 'fields'} のリストでレコードをまとめて更新する（BATCH_SIZE 件ずつ送信されます）"""
+        return self.tables[table].batch_update(records)
+
+    def query_page(self, table, conditions=(), sort_field=None, descending=False, page_size=50, cursor=None):
+        """
+        条件に合うレコードを1ページ分だけ返す。戻り値は (レコードのリスト, 次ページのカーソル)。
+        条件はAirtableの数式に変換してサーバー側で絞り込みます。カーソルはAirtableのoffsetです。
+        """
+        options = {"page_size": page_size}
+        if conditions:
+            options["formula"] = "AND(" + ",".join(_to_formula(*c) for c in conditions) + ")"
+        if sort_field:
+            options["sort"] = [f"-{sort_field}" if descending else sort_field]
+        if cursor:
+            options["offset"] = cursor
+        t = self.tables[table]
+        response = self.api.request(
+            "get", t.urls.records, fallback=("post", t.urls.records_post), options=options
+        )
+        return response.get("records", []), response.get("offset")
+
+    def get_many(self, table, record_ids):
+        """複数のレコードIDのレコードをまとめて取得する（ページ単位で通信します）"""
+        record_ids = list(record_ids)
+        if not record_ids:
+            return []
+        conditions = ",".join(f"RECORD_ID()='{record_id}'" for record_id in record_ids)
+        return self.tables[table].all(formula=f"OR({conditions})")
+
+    def all_modified_since(self, table, since):
+        """指定日時（ISO 8601文字列）より後に変更されたレコードだけを返す（差分同期用）"""
+        return self.tables[table].all(
+            formula=f"IS_AFTER(LAST_MODIFIED_TIME(), DATETIME_PARSE('{since}'))"
+        )
+
+
+class SQLiteBackend:
+    """ローカルのSQLiteファイルにデータを保存するバックエンド"""
+
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        # Streamlitは複数スレッドから呼び出すため、接続を共有してロックで保護します。
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self.transaction():
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            for table in TABLE_NAMES:
+                self._conn.execute(
+                    f'CREATE TABLE IF NOT EXISTS "{table}" '
+                    "(id TEXT PRIMARY KEY, fields TEXT NOT NULL, modified_at TEXT NOT NULL)"
+                )
+                for field in INDEXED_FIELDS.get(table, ()):
+                    self._conn.execute(
+                        f'CREATE INDEX IF NOT EXISTS "idx_{table}_{field}" '
+                        f'ON "{table}" ({_json_field(field)})'
+                    )
+
+    @contextmanager
+    def transaction(self):
+        """接続をロックし、ブロックを抜けるときにまとめてコミットする"""
+        with self._lock, self._conn:
+            yield self._conn
+
+    @staticmethod
+    def _check_table(table):
+        if table not in TABLE_NAMES:
+            raise ValueError(f"不明なテーブルです: {table}")
+
+    @staticmethod
+    def _to_record(row):
+        return {'id': row[0], 'fields': json.loads(row[1])}
+
+    def all(self, table, filters=None):
+        """条件（フィールド名 → 値 の完全一致）に合うレコードをすべて返す"""
+        self._check_table(table)
+        sql = f'SELECT id, fields FROM "{table}"'
+        params = []
+        if filters:
+            sql += " WHERE " + " AND ".join(f"{_json_field(field)} = ?" for field in filters)
+            params = list(filters.values())
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [self._to_record(row) for row in rows]
+
+    def get(self, table, record_id):
+        """レコードIDでレコードを1件取得する"""
+        self._check_table(table)
+        with self._lock:
+            row = self._conn.execute(f'SELECT id, fields FROM "{table}" WHERE id = ?', (record_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"{table} にレコード {record_id} がありません。")
+        return self._to_record(row)
+
+    def get_many(self, table, record_ids):
+        """複数のレコードIDのレコードをまとめて取得する（見つからないIDは無視します）"""
+        self._check_table(table)
+        record_ids = list(record_ids)
+        if not record_ids:
+            return []
+        placeholders = ",".join("?" * len(record_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT id, fields FROM "{table}" WHERE id IN ({placeholders})', record_ids
+            ).fetchall()
+        return [self._to_record(row) for row in rows]
+
+    def create(self, table, fields):
+        """レコードを1件作成する"""
+        return self.batch_create(table, [fields])[0]
+
+    def batch_create(self, table, fields_list):
+        """レコードをまとめて作成する（1トランザクション）"""
+        self._check_table(table)
+        records = [{'id': _new_record_id(), 'fields': dict(fields)} for fields in fields_list]
+        now = _now()
+        with self.transaction():
+            self._conn.executemany(
+                f'INSERT INTO "{table}" (id, fields, modified_at) VALUES (?, ?, ?)',
+                [(r['id'], json.dumps(r['fields'], ensure_ascii=False), now) for r in records],
+            )
+        return records
+
+    def update(self, table, record_id, fields):
+        """レコードを1件更新する（指定したフィールドのみ）"""
+        return self.batch_update(table, [{'id': record_id, 'fields': fields}])[0]
+
+    def batch_update(self, table, records, journal=None):
+        """
+        {'id', 'fields'} のリストでレコードをまとめて更新する（1トランザクション）。
+        journal を渡すと、同じトランザクション内で journal(conn, table, record_id, 更新前のfields, 変更したfields) を呼びます。
+        """
+        self._check_table(table)
+        updated = []
+        now = _now()
+        with self.transaction():
+            for record in records:
+                row = self._conn.execute(
+                    f'SELECT fields FROM "{table}" WHERE id = ?', (record['id'],)
+                ).fetchone()
+                if row is None:
+                    raise KeyError(f"{table} にレコード {record['id']} がありません。")
+                old_fields = json.loads(row[0])
+                fields = {**old_fields, **record['fields']}
+                if journal:
+                    journal(self._conn, table, record['id'], old_fields, record['fields'])
+                self._conn.execute(
+                    f'UPDATE "{table}" SET fields = ?, modified_at = ? WHERE id = ?',
+                    (json.dumps(fields, ensure_ascii=False), now, record['id']),
+                )
+                updated.append({'id': record['id'], 'fields': fields})
+        return updated
+
+    def query_page(self, table, conditions=(), sort_field=None, descending=False, page_size=50, cursor=None):
+        """
+        条件に合うレコードを1ページ分だけ返す。戻り値は (レコードのリスト, 次ページのカーソル)。
+        カーソルは読み飛ばす件数を文字列にしたものです。
+        """
+        self._check_table(table)
+        sql = f'SELECT id, fields FROM "{table}"'
+        where, params = [], []
+        for field, op, value in conditions:
+            column = _json_field(field)
+            if op == "=":
+                where.append(f"{column} = ?")
+            elif op == "prefix":
+                where.append(f"substr({column}, 1, {len(value)}) = ?")
+            elif op == "since":
+                where.append(f"{column} >= ?")
+            elif op == "until":
+                where.append(f"{column} < ?")
+            elif op == "numbered":
+                where.append(
+                    f"substr({column}, 1, {len(value)}) = ? AND length({column}) > {len(value)} "
+                    f"AND substr({column}, {len(value) + 1}) NOT GLOB '*[^0-9]*'"
+                )
+            elif op == "in":
+                where.append(f"{column} IN ({','.join('?' * len(value))})" if value else "0")
+                params.extend(value)
+                continue
+            else:
+                raise ValueError(f"使用できない条件です: {op}")
+            params.append(value)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        if sort_field:
+            sql += f" ORDER BY {_json_field(sort_field)} {'DESC' if descending else 'ASC'}, id"
+        offset = int(cursor or 0)
+        # 次ページの有無を調べるため、1件多く読みます。
+        sql += " LIMIT ? OFFSET ?"
+        params += [page_size + 1, offset]
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        next_cursor = str(offset + page_size) if len(rows) > page_size else None
+        return [self._to_record(row) for row in rows[:page_size]], next_cursor
+
+    def upsert_records(self, table, records):
+        """レコードIDを保ったまま、レコードを丸ごと書き込む（Airtableからの取り込み用）"""
+        self._check_table(table)
+        now = _now()
+        with self.transaction():
+            self._conn.executemany(
+                f'INSERT INTO "{table}" (id, fields, modified_at) VALUES (?, ?, ?) '
+                "ON CONFLICT(id) DO UPDATE SET fields = excluded.fields, modified_at = excluded.modified_at",
+                [(r['id'], json.dumps(r['fields'], ensure_ascii=False), now) for r in records],
+            )
+
+    def delete_records(self, table, record_ids):
+        """レコードIDのリストでレコードを削除する"""
+        self._check_table(table)
+        with self.transaction():
+            self._conn.executemany(f'DELETE FROM "{table}" WHERE id = ?', [(i,) for i in record_ids])
+
+    def record_ids(self, table):
+        """テーブルに保存されているすべてのレコードIDを返す"""
+        self._check_table(table)
+        with self._lock:
+            return {row[0] for row in self._conn.execute(f'SELECT id FROM "{table}"')}
+
+
+def _to_formula(field, op, value):
+    """query_page の条件1つをAirtableの数式に変換する"""
+    name = field_name(field)
+    if op == "=":
+        return f"{name}={quoted(value)}"
+    if op == "prefix":
+        return f"LEFT({name},{len(value)})={quoted(value)}"
+    if op == "since":
+        return f"AND({name},NOT(IS_BEFORE({name},DATETIME_PARSE({quoted(value)}))))"
+    if op == "until":
+        return f"AND({name},IS_BEFORE({name},DATETIME_PARSE({quoted(value)})))"
+    if op == "numbered":
+        return (
+            f"AND(LEFT({name},{len(value)})={quoted(value)},"
+            f"REGEX_MATCH(RIGHT({name},LEN({name})-{len(value)}),'^[0-9]+$'))"
+        )
+    if op == "in":
+        return "OR(" + ",".join(f"{name}={quoted(v)}" for v in value) + ")" if value else "FALSE()"
+    raise ValueError(f"使用できない条件です: {op}")
+
+
+def _json_field(field):
+    """フィールド値を取り出すSQL式（索引と検索で同じ式を使う必要があります）"""
+    if not re.fullmatch(r"\w+", field):
+        raise ValueError(f"使用できないフィールド名です: {field}")
+    return f"json_extract(fields, '$.\"{field}\"')"
+
+
+def _new_record_id():
+    """Airtable風のレコードIDを作成する"""
+    return "rec" + uuid.uuid4().hex[:14]
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
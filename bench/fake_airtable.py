@@ -0,0 +1,446 @@
+# ==============================================================================
+# bench/fake_airtable.py
+# ベンチマーク用の Airtable REST API の模擬サーバーです（ネットワーク接続は不要です）。
+#   - レコードはメモリ上に保持し、アプリが使う一覧・取得・作成・更新のAPIに応答します。
+#   - 応答の遅延（latency / jitter）と、ベースごとのレート制限（429）を再現できます。
+#   - 本物と同じく、トークン（Authorization: Bearer ...）の無いリクエストは401で拒否します。
+#   - filterByFormula は、アプリが送る数式（AND / OR / LEFT / IS_BEFORE など）だけを解釈します。
+# ==============================================================================
+import json
+import operator
+import random
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+# Airtableの制限（1回のリクエストで作成・更新できる件数、1ページの最大件数）
+MAX_RECORDS_PER_REQUEST = 10
+MAX_PAGE_SIZE = 100
+
+
+class FakeAirtable:
+    """
+    メモリ上で動く Airtable の模擬サーバー。
+    latency 秒（+ 0〜jitter 秒）遅れて応答し、rate_limit（毎秒の件数、ベースごと）を超えたリクエストには429を返します。
+    penalty を指定すると、本物と同じように429の後しばらくすべてのリクエストを拒否します。
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit=5.0, penalty=0.0, host="127.0.0.1", port=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.penalty = penalty
+        # {ベースID: {テーブル名: {レコードID: レコード}}}（レコードには最終更新時刻 _modified を持たせます）
+        self.bases = defaultdict(lambda: defaultdict(dict))
+        self.stats = defaultdict(int)
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """別スレッドでサーバーを起動し、接続先URLを返す"""
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-airtable", daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def seed(self, base_id, table, fields_list):
+        """レコードを直接登録する（レート制限・遅延なし）。作成したレコードのリストを返す"""
+        with self._lock:
+            return [self._insert(base_id, table, fields) for fields in fields_list]
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats.clear()
+
+    # --- レート制限 ---
+    def _allow(self, base_id):
+        """ベースごとのトークンバケットで、このリクエストを受け付けるか判定する"""
+        if not self.rate_limit:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at, blocked_until = self._buckets.get(base_id, (self.rate_limit, now, 0.0))
+            if now < blocked_until:
+                return False
+            tokens = min(self.rate_limit, tokens + (now - updated_at) * self.rate_limit)
+            if tokens < 1:
+                self._buckets[base_id] = (tokens, now, now + self.penalty)
+                return False
+            self._buckets[base_id] = (tokens - 1, now, blocked_until)
+            return True
+
+    # --- レコード操作 ---
+    def _insert(self, base_id, table, fields):
+        now = _now()
+        record = {
+            "id": "rec" + uuid.uuid4().hex[:14],
+            "createdTime": now,
+            "fields": {k: v for k, v in fields.items() if v is not None},
+            "_modified": now,
+        }
+        self.bases[base_id][table][record["id"]] = record
+        return _public(record)
+
+    def _update(self, base_id, table, record_id, fields, replace=False):
+        record = self.bases[base_id][table].get(record_id)
+        if record is None:
+            raise _ApiError(404, "MODEL_ID_NOT_FOUND", f"Could not find record {record_id}")
+        merged = {} if replace else dict(record["fields"])
+        for key, value in fields.items():
+            # Airtableでは空の値を送るとフィールドが消えます。
+            if value is None:
+                merged.pop(key, None)
+            else:
+                merged[key] = value
+        record["fields"] = merged
+        record["_modified"] = _now()
+        return _public(record)
+
+    def list_records(self, base_id, table, formula=None, sort=(), page_size=MAX_PAGE_SIZE, offset=None,
+                     max_records=None):
+        records = list(self.bases[base_id][table].values())
+        if formula:
+            evaluate = _Formula(formula)
+            records = [r for r in records if _truthy(evaluate(r))]
+        # 複数条件の並べ替えは、後ろの条件から順に安定ソートします。
+        for spec in reversed(sort):
+            records.sort(key=lambda r: _sort_key(r["fields"].get(spec["field"])), reverse=spec.get("direction") == "desc")
+        if max_records:
+            records = records[:int(max_records)]
+        start = int(offset[3:]) if offset else 0
+        page_size = min(int(page_size or MAX_PAGE_SIZE), MAX_PAGE_SIZE)
+        page = records[start:start + page_size]
+        response = {"records": [_public(r) for r in page]}
+        if start + page_size < len(records):
+            response["offset"] = f"itr{start + page_size}"
+        return response
+
+    def handle(self, method, path, query, body):
+        """リクエスト1件を処理して (ステータス, 応答) を返す"""
+        parts = [unquote(p) for p in path.strip("/").split("/")]
+        if len(parts) < 3 or parts[0] != "v0":
+            raise _ApiError(404, "NOT_FOUND", "Could not find what you are looking for")
+        base_id, table, rest = parts[1], parts[2], parts[3:]
+
+        with self._lock:
+            if method == "GET" and not rest:
+                return 200, self.list_records(
+                    base_id, table,
+                    formula=_first(query, "filterByFormula"),
+                    sort=_sort_from_query(query),
+                    page_size=_first(query, "pageSize"),
+                    offset=_first(query, "offset"),
+                    max_records=_first(query, "maxRecords"),
+                )
+            if method == "POST" and rest == ["listRecords"]:
+                return 200, self.list_records(
+                    base_id, table,
+                    formula=body.get("filterByFormula"),
+                    sort=body.get("sort") or (),
+                    page_size=body.get("pageSize"),
+                    offset=body.get("offset"),
+                    max_records=body.get("maxRecords"),
+                )
+            if method == "GET" and len(rest) == 1:
+                record = self.bases[base_id][table].get(rest[0])
+                if record is None:
+                    raise _ApiError(404, "MODEL_ID_NOT_FOUND", f"Could not find record {rest[0]}")
+                return 200, _public(record)
+            if method == "POST" and not rest:
+                if "records" in body:
+                    _check_batch(body["records"])
+                    return 200, {"records": [self._insert(base_id, table, r["fields"]) for r in body["records"]]}
+                return 200, self._insert(base_id, table, body.get("fields", {}))
+            if method in ("PATCH", "PUT") and not rest:
+                _check_batch(body.get("records", []))
+                return 200, {"records": [
+                    self._update(base_id, table, r["id"], r["fields"], replace=method == "PUT")
+                    for r in body["records"]
+                ]}
+            if method in ("PATCH", "PUT") and len(rest) == 1:
+                return 200, self._update(base_id, table, rest[0], body.get("fields", {}), replace=method == "PUT")
+        raise _ApiError(404, "NOT_FOUND", "Could not find what you are looking for")
+
+
+class _ApiError(Exception):
+    def __init__(self, status, error_type, message):
+        super().__init__(message)
+        self.status = status
+        self.body = {"error": {"type": error_type, "message": message}}
+
+
+def _make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        # Keep-Alive で接続を使い回せるよう HTTP/1.1 で応答します。
+        protocol_version = "HTTP/1.1"
+
+        def _dispatch(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            delay = fake.latency + (random.uniform(0, fake.jitter) if fake.jitter else 0)
+            if delay:
+                time.sleep(delay)
+
+            url = urlparse(self.path)
+            base_id = url.path.strip("/").split("/")[1] if url.path.count("/") >= 2 else ""
+            with fake._lock:
+                fake.stats["requests"] += 1
+                fake.stats[f"{self.command} requests"] += 1
+            # 本物のAirtableと同じく、トークン（Authorization: Bearer ...）の無いリクエストは401で拒否します。
+            if not (self.headers.get("Authorization") or "").startswith("Bearer "):
+                with fake._lock:
+                    fake.stats["unauthorized"] += 1
+                return self._send(401, {"error": {"type": "AUTHENTICATION_REQUIRED",
+                                                  "message": "Authentication required"}})
+            if not fake._allow(base_id):
+                with fake._lock:
+                    fake.stats["rate_limited"] += 1
+                return self._send(429, {"errors": [{"error": "RATE_LIMIT_REACHED",
+                                                    "message": "Rate limit exceeded. Please try again later"}]})
+            try:
+                body = json.loads(raw) if raw else {}
+                status, payload = fake.handle(self.command, url.path, parse_qs(url.query), body)
+            except _ApiError as e:
+                status, payload = e.status, e.body
+            except (ValueError, KeyError, TypeError) as e:
+                status, payload = 422, {"error": {"type": "INVALID_REQUEST_UNKNOWN", "message": str(e)}}
+            if status >= 400:
+                with fake._lock:
+                    fake.stats["errors"] += 1
+            self._send(status, payload)
+
+        def _send(self, status, payload):
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST = do_PATCH = do_PUT = _dispatch
+
+        def log_message(self, format, *args):
+            pass  # リクエストごとのログは出しません
+
+    return Handler
+
+
+# --- 補助関数 ---
+def _now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def _public(record):
+    return {"id": record["id"], "createdTime": record["createdTime"], "fields": dict(record["fields"])}
+
+
+def _first(query, key):
+    values = query.get(key)
+    return values[0] if values else None
+
+
+def _sort_from_query(query):
+    """sort[0][field]=...&sort[0][direction]=... 形式の並べ替え条件を取り出す"""
+    specs = defaultdict(dict)
+    for key, values in query.items():
+        m = re.fullmatch(r"sort\[(\d+)\]\[(field|direction)\]", key)
+        if m:
+            specs[int(m.group(1))][m.group(2)] = values[0]
+    return [specs[i] for i in sorted(specs)]
+
+
+def _sort_key(value):
+    # 空の値は先頭に並べ、型が混ざっても比較できるようにします。
+    if value is None:
+        return (0, "")
+    if isinstance(value, (int, float)):
+        return (1, value)
+    return (2, str(value))
+
+
+def _check_batch(records):
+    if len(records) > MAX_RECORDS_PER_REQUEST:
+        raise _ApiError(422, "INVALID_RECORDS", f"You may only send {MAX_RECORDS_PER_REQUEST} records per request")
+
+
+def _truthy(value):
+    return value not in (None, "", 0, False, [])
+
+
+def _to_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    if not value:
+        return None
+    return datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+
+
+# --- 数式の解釈 ---
+_TOKEN = re.compile(
+    r"\s*(?:"
+    r"(?P<number>\d+(?:\.\d+)?)"
+    r"|(?P<string>'(?:\\.|[^'\\])*'|\"(?:\\.|[^\"\\])*\")"
+    r"|(?P<field>\{(?:\\.|[^}\\])*\})"
+    r"|(?P<name>[A-Za-z_][A-Za-z0-9_]*)"
+    r"|(?P<op>!=|<=|>=|[=<>&+\-*/(),])"
+    r")"
+)
+
+
+class _Formula:
+    """filterByFormula を解釈し、レコードごとに評価する関数を作る（アプリが使う範囲のみ対応）"""
+
+    FUNCTIONS = {
+        "AND": lambda *args: all(_truthy(a) for a in args),
+        "OR": lambda *args: any(_truthy(a) for a in args),
+        "NOT": lambda a: not _truthy(a),
+        "IF": lambda cond, a, b=None: a if _truthy(cond) else b,
+        "LEFT": lambda s, n: str(s or "")[:int(n)],
+        "RIGHT": lambda s, n: str(s or "")[-int(n):] if int(n) else "",
+        "LEN": lambda s: len(str(s or "")),
+        "LOWER": lambda s: str(s or "").lower(),
+        "UPPER": lambda s: str(s or "").upper(),
+        "FIND": lambda needle, s, start=0: str(s or "").find(str(needle), max(int(start) - 1, 0)) + 1,
+        "REGEX_MATCH": lambda s, pattern: re.search(str(pattern), str(s or "")) is not None,
+        "BLANK": lambda: None,
+        "TRUE": lambda: True,
+        "FALSE": lambda: False,
+        "DATETIME_PARSE": lambda s, *_: _to_datetime(s),
+        "IS_BEFORE": lambda a, b: bool(a and b) and _to_datetime(a) < _to_datetime(b),
+        "IS_AFTER": lambda a, b: bool(a and b) and _to_datetime(a) > _to_datetime(b),
+        "IS_SAME": lambda a, b, *_: bool(a and b) and _to_datetime(a) == _to_datetime(b),
+    }
+    # レコード自体の情報を返す関数
+    RECORD_FUNCTIONS = {
+        "RECORD_ID": lambda record: record["id"],
+        "CREATED_TIME": lambda record: record["createdTime"],
+        "LAST_MODIFIED_TIME": lambda record: record["_modified"],
+    }
+
+    def __init__(self, text):
+        self.tokens = []
+        pos = 0
+        text = text.strip()
+        while pos < len(text):
+            m = _TOKEN.match(text, pos)
+            if not m or m.end() == pos:
+                raise ValueError(f"数式を解釈できません: {text[pos:pos + 20]}")
+            kind = m.lastgroup
+            self.tokens.append((kind, m.group(kind)))
+            pos = m.end()
+        self.pos = 0
+        self.tree = self._comparison()
+        if self.pos != len(self.tokens):
+            raise ValueError(f"数式を解釈できません: {text}")
+
+    def __call__(self, record):
+        return self._eval(self.tree, record)
+
+    # 構文解析（比較 → 連結・加減算 → 乗除算 → 値 の順に結合が強くなります）
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def _take(self, value=None):
+        token = self._peek()
+        if value is not None and token[1] != value:
+            raise ValueError(f"'{value}' が必要です")
+        self.pos += 1
+        return token
+
+    def _comparison(self):
+        left = self._additive()
+        while self._peek()[1] in ("=", "!=", "<", ">", "<=", ">="):
+            op = self._take()[1]
+            left = ("op", op, left, self._additive())
+        return left
+
+    def _additive(self):
+        left = self._term()
+        while self._peek()[1] in ("&", "+", "-"):
+            op = self._take()[1]
+            left = ("op", op, left, self._term())
+        return left
+
+    def _term(self):
+        left = self._primary()
+        while self._peek()[1] in ("*", "/"):
+            op = self._take()[1]
+            left = ("op", op, left, self._primary())
+        return left
+
+    def _primary(self):
+        kind, value = self._take()
+        if kind == "number":
+            return ("value", float(value) if "." in value else int(value))
+        if kind == "string":
+            return ("value", re.sub(r"\\(.)", r"\1", value[1:-1]))
+        if kind == "field":
+            return ("field", re.sub(r"\\(.)", r"\1", value[1:-1]))
+        if kind == "op" and value == "(":
+            inner = self._comparison()
+            self._take(")")
+            return inner
+        if kind == "op" and value == "-":
+            return ("op", "-", ("value", 0), self._primary())
+        if kind == "name":
+            name = value.upper()
+            if name not in self.FUNCTIONS and name not in self.RECORD_FUNCTIONS:
+                raise ValueError(f"対応していない関数です: {value}")
+            self._take("(")
+            args = []
+            if self._peek()[1] != ")":
+                args.append(self._comparison())
+                while self._peek()[1] == ",":
+                    self._take()
+                    args.append(self._comparison())
+            self._take(")")
+            return ("call", name, args)
+        raise ValueError(f"数式を解釈できません: {value}")
+
+    def _eval(self, node, record):
+        kind = node[0]
+        if kind == "value":
+            return node[1]
+        if kind == "field":
+            value = record["fields"].get(node[1])
+            # 連携レコードなどのリストは、Airtableと同じくカンマ区切りの文字列として比較します。
+            return ", ".join(map(str, value)) if isinstance(value, list) else value
+        if kind == "call":
+            if node[1] in self.RECORD_FUNCTIONS:
+                return self.RECORD_FUNCTIONS[node[1]](record)
+            return self.FUNCTIONS[node[1]](*(self._eval(arg, record) for arg in node[2]))
+        _, op, left, right = node
+        a, b = self._eval(left, record), self._eval(right, record)
+        if op == "&":
+            return f"{'' if a is None else a}{'' if b is None else b}"
+        if op in ("+", "-", "*", "/"):
+            a, b = a or 0, b or 0
+            return {"+": lambda: a + b, "-": lambda: a - b, "*": lambda: a * b, "/": lambda: a / b if b else None}[op]()
+        # 空の値は空文字列と等しいものとして比較します。
+        if a is None:
+            a = "" if isinstance(b, str) else a
+        if b is None:
+            b = "" if isinstance(a, str) else b
+        if op == "=":
+            return a == b
+        if op == "!=":
+            return a != b
+        if a is None or b is None:
+            return False
+        return {"<": operator.lt, ">": operator.gt, "<=": operator.le, ">=": operator.ge}[op](a, b)
@@ -0,0 +1,327 @@
+# ==============================================================================
+# bench/run_bench.py
+# database.py と、app.py の主な処理（スキャン・使用登録・QRコード生成など）の負荷試験です。
+# 模擬サーバー（bench/fake_airtable.py）を起動して接続するため、本番のベースやネットワークは使いません。
+#
+# 使い方（リポジトリのルートで実行します）:
+#   python -m bench.run_bench --products 50 --qrcodes 2000 --users 20 --concurrency 10 --latency 0.2
+#   python -m bench.run_bench --json after.json --compare before.json   # 変更前の結果と比較
+# ==============================================================================
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+
+from bench.fake_airtable import FakeAirtable
+
+BASE_ID = "appBenchmark0000"
+APP_BASE_URL = "https://bench.example"
+SCENARIOS = ("login", "scan", "consume", "history", "generate")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="消耗品管理システムの負荷試験")
+    parser.add_argument("--products", type=int, default=50, help="商品数 (N)")
+    parser.add_argument("--qrcodes", type=int, default=2000, help="未使用のQRコード数 (M)")
+    parser.add_argument("--users", type=int, default=20, help="ユーザー数 (K)")
+    parser.add_argument("--concurrency", type=int, default=None, help="同時に操作するユーザー数（既定: --users と同じ）")
+    parser.add_argument("--operations", type=int, default=200, help="シナリオごとの操作回数")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"実行するシナリオ（{','.join(SCENARIOS)}）")
+    parser.add_argument("--backend", choices=("airtable", "mirror", "sqlite"), default="airtable",
+                        help="database.py のデータストア（DATABASE_BACKEND）")
+    parser.add_argument("--latency", type=float, default=0.2, help="模擬サーバーの応答遅延（秒）")
+    parser.add_argument("--jitter", type=float, default=0.05, help="応答遅延のばらつき（秒）")
+    parser.add_argument("--rate-limit", type=float, default=5.0, help="模擬サーバーのレート制限（毎秒、0で無制限）")
+    parser.add_argument("--penalty", type=float, default=0.0, help="429の後にすべてのリクエストを拒否する時間（秒）")
+    parser.add_argument("--generate-batch", type=int, default=10, help="generate シナリオで1回に作るQRコード数")
+    parser.add_argument("--bcrypt-rounds", type=int, default=4, help="ユーザーのパスワードハッシュのコスト")
+    parser.add_argument("--seed", type=int, default=1, help="乱数の種")
+    parser.add_argument("--json", help="結果をJSONで保存するファイル")
+    parser.add_argument("--compare", help="比較する以前の結果（--json で保存したファイル）")
+    args = parser.parse_args(argv)
+    args.concurrency = args.concurrency or args.users
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"不明なシナリオです: {', '.join(sorted(unknown))}")
+    return args
+
+
+# --- テストデータ ---
+def make_dataset(args):
+    """商品・ユーザー・QRコードのテストデータを作る（QRコードは商品に均等に割り当てます）"""
+    import bcrypt
+
+    rng = random.Random(args.seed)
+    products = [
+        {
+            "ProductTag": f"P{i:04d}",
+            "ProductName": f"消耗品{i:04d}",
+            "CurrentStock": args.qrcodes,
+            # QRコードは商品に順番に割り当てるため、発行済みの番号は件数から決まります。
+            "LatestQRCodeNum": args.qrcodes // args.products + (1 if i < args.qrcodes % args.products else 0),
+            "Unit": rng.choice(["箱", "本", "袋"]),
+        }
+        for i in range(args.products)
+    ]
+    # ハッシュ化は重いため、全ユーザーで同じパスワードのハッシュを使い回します。
+    hashed = bcrypt.hashpw(b"password", bcrypt.gensalt(args.bcrypt_rounds)).decode("utf-8")
+    users = [
+        {"Name": f"利用者{i:03d}", "Username": f"user{i:03d}", "HashedPassword": hashed, "Role": "User"}
+        for i in range(args.users)
+    ]
+    return products, users
+
+
+def make_qrcodes(products, count, rng):
+    """未使用のQRコードを作る（商品に順番に割り当て、登録順はばらばらにします）"""
+    qrcodes = [
+        {
+            "QRCodeID": f"{products[i % len(products)]['fields']['ProductTag']}_{i // len(products) + 1}",
+            "Product": [products[i % len(products)]["id"]],
+            "Status": "未使用",
+        }
+        for i in range(count)
+    ]
+    rng.shuffle(qrcodes)
+    return qrcodes
+
+
+def prepare_backend(args, fake, workdir):
+    """データを登録し、database.py が読む環境変数を設定する"""
+    import backends
+
+    rng = random.Random(args.seed)
+    products, users = make_dataset(args)
+    os.environ["DATABASE_BACKEND"] = args.backend
+    os.environ["SQLITE_PATH"] = os.path.join(workdir, "bench.db")
+    os.environ["WRITE_QUEUE_PATH"] = os.path.join(workdir, "write_queue.db")
+    os.environ["AIRTABLE_API_KEY"] = "patBenchmark"
+    os.environ["AIRTABLE_BASE_ID"] = BASE_ID
+    os.environ["AIRTABLE_ENDPOINT_URL"] = fake.url
+    os.environ["AIRTABLE_RATE_LIMIT"] = str(args.rate_limit or 1000)
+
+    if args.backend == "sqlite":
+        store = backends.SQLiteBackend(os.environ["SQLITE_PATH"])
+        product_records = store.batch_create("Products", products)
+        store.batch_create("Users", users)
+        qrcodes = make_qrcodes(product_records, args.qrcodes, rng)
+        store.batch_create("QRCodes", qrcodes)
+    else:
+        product_records = fake.seed(BASE_ID, "Products", products)
+        fake.seed(BASE_ID, "Users", users)
+        qrcodes = make_qrcodes(product_records, args.qrcodes, rng)
+        fake.seed(BASE_ID, "QRCodes", qrcodes)
+    return product_records, users, [q["QRCodeID"] for q in qrcodes]
+
+
+def wait_for_mirror(database, expected_products, timeout=120):
+    """mirror のとき、最初の取り込みが終わるまで待つ"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        backend = database.get_store().backend
+        if len(backend.all("Products")) >= expected_products and backend.all("QRCodes"):
+            return
+        time.sleep(0.2)
+    raise RuntimeError("Airtableからの取り込みが終わりませんでした")
+
+
+# --- シナリオ（app.py の処理の流れをそのまま再現します） ---
+class Scenarios:
+    def __init__(self, database, qr_labels, auth, products, users, qrcode_ids, args):
+        self.db = database
+        self.qr_labels = qr_labels
+        self.args = args
+        self.products = products
+        self.users = users
+        self.unused = deque(qrcode_ids)
+        self._unused_lock = threading.Lock()
+        self.verifier = auth.PasswordVerifier(max_workers=2, max_pending=max(args.concurrency, 8), timeout=60)
+        self.image_cache = qr_labels.QRImageCache()
+
+    def _next_qrcode(self):
+        with self._unused_lock:
+            return self.unused.popleft() if self.unused else None
+
+    def login(self, rng):
+        """ログイン画面: ユーザーを取得してパスワードを照合する"""
+        user = self.db.get_user(rng.choice(self.users)["Username"])
+        return bool(user) and self.verifier.verify("password", user.get("HashedPassword"))
+
+    def _scan(self, qrcode_id):
+        """QRコードを読み取った直後の画面: QRコードと商品を取得する"""
+        data = self.db.fetch_concurrently(
+            qrcode=(self.db.get_qrcode_data, qrcode_id),
+            products=self.db.get_all_products,
+        )
+        qrcode_data = data["qrcode"]
+        if not qrcode_data or qrcode_data["fields"].get("Status") == "使用済み":
+            return None, None
+        product_record_id = (qrcode_data["fields"].get("Product") or [None])[0]
+        return qrcode_data, self.db.get_product_by_record_id(product_record_id)
+
+    def scan(self, rng):
+        with self._unused_lock:
+            qrcode_id = rng.choice(self.unused) if self.unused else None
+        _, product = self._scan(qrcode_id)
+        return product is not None
+
+    def consume(self, rng):
+        """使用登録: スキャンしてから在庫を1つ減らす"""
+        qrcode_id = self._next_qrcode()
+        if qrcode_id is None:
+            return False
+        qrcode_data, product = self._scan(qrcode_id)
+        if product is None:
+            return False
+        user = rng.choice(self.users)
+        return self.db.consume_qrcode(
+            qrcode_data["id"], product["id"], used_by=user["Name"], qrcode_id=qrcode_id
+        ) is not None
+
+    def history(self, rng):
+        """管理者メニュー: 商品一覧と使用履歴の1ページ目を取得する"""
+        data = self.db.fetch_concurrently(
+            products=self.db.get_all_products,
+            history=lambda: self.db.query_usage_history(status="使用済み", page_size=50),
+        )
+        return data["products"] is not None
+
+    def generate(self, rng):
+        """QRコード生成: まとめて発行し、印刷用シートを作成する"""
+        product = rng.choice(self.products)
+        new_ids = self.db.create_qrcodes_bulk(product["id"], product["fields"]["ProductTag"], self.args.generate_batch)
+        if not new_ids:
+            return False
+        self.qr_labels.render_label_sheet(new_ids, APP_BASE_URL, fmt="PDF", cache=self.image_cache)
+        return True
+
+
+def run_scenario(name, fn, args, metrics):
+    """fn を同時実行数 args.concurrency で args.operations 回実行し、処理時間を集計する"""
+    registry = metrics.MetricsRegistry(window=None)
+    remaining = [args.operations]
+    lock = threading.Lock()
+
+    def worker(index):
+        rng = random.Random(f"{args.seed}-{name}-{index}")
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            started = time.perf_counter()
+            try:
+                ok = fn(rng)
+            except Exception:
+                ok = False
+            registry.observe(name, time.perf_counter() - started, error=not ok)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    rows, _ = registry.summary()
+    row = rows[0]
+    return {
+        "operations": row["count"],
+        "errors": row["errors"],
+        "elapsed_s": elapsed,
+        "throughput": row["count"] / elapsed if elapsed else None,
+        "p50_ms": row["p50"] * 1000,
+        "p95_ms": row["p95"] * 1000,
+        "p99_ms": row["p99"] * 1000,
+        "mean_ms": row["mean"] * 1000,
+    }
+
+
+# --- 結果の表示 ---
+def print_results(results, previous=None):
+    header = f"{'シナリオ':<10}{'件数':>6}{'失敗':>6}{'件/秒':>9}{'p50ms':>9}{'p95ms':>9}{'p99ms':>9}{'通信':>7}{'429':>6}"
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        print(
+            f"{name:<12}{r['operations']:>6}{r['errors']:>6}{r['throughput']:>9.2f}"
+            f"{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}"
+            f"{r['server_requests']:>7}{r['rate_limited']:>6}"
+        )
+        before = (previous or {}).get(name)
+        if before:
+            print(
+                f"{'  (前回比)':<12}{'':>12}{_change(before['throughput'], r['throughput']):>9}"
+                f"{_change(before['p50_ms'], r['p50_ms']):>9}{_change(before['p95_ms'], r['p95_ms']):>9}"
+                f"{_change(before['p99_ms'], r['p99_ms']):>9}"
+            )
+
+
+def _change(before, after):
+    if not before:
+        return "-"
+    return f"{(after - before) / before:+.0%}"
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    fake = FakeAirtable(latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit, penalty=args.penalty)
+    fake.start()
+    workdir = tempfile.mkdtemp(prefix="stock-bench-")
+    products, users, qrcode_ids = prepare_backend(args, fake, workdir)
+
+    # 設定を環境変数に入れてから読み込みます（database.py は最初に使うときに、その設定で接続します）。
+    import streamlit.logger
+    import auth
+    import database
+    import metrics
+    import qr_labels
+    streamlit.logger.set_log_level("error")  # 画面の外で st.error を呼んだときの警告を抑えます
+
+    if args.backend == "mirror":
+        wait_for_mirror(database, len(products))
+
+    scenarios = Scenarios(database, qr_labels, auth, products, users, qrcode_ids, args)
+    print(
+        f"backend={args.backend} products={args.products} qrcodes={args.qrcodes} users={args.users} "
+        f"concurrency={args.concurrency} latency={args.latency}s rate_limit={args.rate_limit}/s",
+        file=sys.stderr,
+    )
+
+    results = {}
+    for name in args.scenarios:
+        fake.reset_stats()
+        result = run_scenario(name, getattr(scenarios, name), args, metrics)
+        result["server_requests"] = fake.stats["requests"]
+        result["rate_limited"] = fake.stats["rate_limited"]
+        results[name] = result
+
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous = json.load(f)["results"]
+    print_results(results, previous)
+
+    if args.json:
+        db_rows, db_counters = metrics.registry.summary()
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({
+                "args": vars(args),
+                "results": results,
+                # database.py などの処理ごとの内訳（metrics.py の記録）
+                "breakdown": db_rows,
+                "counters": db_counters,
+            }, f, ensure_ascii=False, indent=2)
+    fake.stop()
+    return results
+
+
+if __name__ == "__main__":
+    main()
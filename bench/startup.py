@@ -0,0 +1,147 @@
+# ==============================================================================
+# bench/startup.py
+# 起動時間の計測です。画面ごとに新しい Python プロセスで画面のモジュール（views/）を読み込み、
+# 読み込みにかかった時間と、時間のかかっているライブラリの内訳（python -X importtime）を表示します。
+# Streamlit 本体と Secrets はサーバーの起動時に読み込まれるため、計測の前に読み込んでおきます。
+#
+# 使い方（リポジトリのルートで実行します）:
+#   python -m bench.startup --repeat 5
+#   python -m bench.startup --json after.json --compare before.json   # 変更前の結果と比較
+# ==============================================================================
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+PAGES = ("login", "user", "admin")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+START_MARKER = "--- start ---"
+
+# 新しいプロセスで実行するコード（最後の行に読み込み時間を秒で出力します）
+MEASURE_CODE = """
+import sys, time
+import streamlit, streamlit.logger
+streamlit.logger.set_log_level("error")
+streamlit.secrets.get("TIMEZONE")
+sys.stderr.write({marker!r} + "\\n")
+started = time.perf_counter()
+import views.{page}
+print(time.perf_counter() - started)
+"""
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="画面ごとの起動時間（モジュールの読み込み時間）の計測")
+    parser.add_argument("--pages", nargs="+", choices=PAGES, default=list(PAGES))
+    parser.add_argument("--repeat", type=int, default=3, help="画面ごとの計測回数（中央値を表示します）")
+    parser.add_argument("--top", type=int, default=8, help="内訳に表示するパッケージの数")
+    parser.add_argument("--json", help="結果をJSONで保存するファイル")
+    parser.add_argument("--compare", help="比較する以前の結果（--json で保存したファイル）")
+    return parser.parse_args(argv)
+
+
+def measure(page, env, workdir):
+    """新しいプロセスで画面のモジュールを読み込み、(秒, {パッケージ: 秒}) を返す"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", MEASURE_CODE.format(marker=START_MARKER, page=page)],
+        cwd=workdir, env=env, capture_output=True, text=True, check=True,
+    )
+    seconds = float(proc.stdout.strip().splitlines()[-1])
+    return seconds, parse_importtime(proc.stderr)
+
+
+def parse_importtime(stderr):
+    """
+    -X importtime の出力から、計測開始後に読み込まれたモジュールの時間をトップレベルのパッケージごとに合計する（秒）。
+    出力は「import time: 自身 [us] | 累積 [us] | モジュール名」の形式で、各モジュール自身の時間を
+    パッケージ名（pandas.core.frame → pandas）で合計します。
+    """
+    _, _, measured = stderr.partition(START_MARKER)
+    packages = {}
+    for line in measured.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue  # 見出しの行
+        package = parts[2].strip().split(".")[0]
+        packages[package] = packages.get(package, 0.0) + int(parts[0]) / 1e6
+    return packages
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="stock-startup-")
+    # 画面のモジュールは読み込み時に Secrets を読むため、作業ディレクトリに空の Secrets ファイルを用意し、
+    # そこを起点にリポジトリのモジュールを読み込みます。
+    os.makedirs(os.path.join(workdir, ".streamlit"))
+    with open(os.path.join(workdir, ".streamlit", "secrets.toml"), "w", encoding="utf-8") as f:
+        f.write("# bench/startup.py\n")
+    # database.py がデータストアへ接続する場合に備えて、ローカルの SQLite に向けます。
+    env = {
+        **os.environ,
+        "PYTHONPATH": ROOT,
+        "DATABASE_BACKEND": "sqlite",
+        "SQLITE_PATH": os.path.join(workdir, "startup.db"),
+    }
+    results = {}
+    for page in args.pages:
+        samples, breakdowns = [], []
+        for _ in range(args.repeat):
+            seconds, modules = measure(page, env, workdir)
+            samples.append(seconds)
+            breakdowns.append(modules)
+        # 内訳は中央値に最も近い回のものを使います。
+        median = statistics.median(samples)
+        modules = breakdowns[min(range(len(samples)), key=lambda i: abs(samples[i] - median))]
+        results[page] = {
+            "import_ms": median * 1000,
+            "min_ms": min(samples) * 1000,
+            "max_ms": max(samples) * 1000,
+            "packages_ms": {
+                name: seconds * 1000
+                for name, seconds in sorted(modules.items(), key=lambda item: -item[1])[:args.top]
+            },
+        }
+    return results
+
+
+def print_results(results, previous=None):
+    header = f"{'画面':<8}{'読み込みms':>12}{'最小ms':>10}{'最大ms':>10}"
+    print(header)
+    print("-" * len(header))
+    for page, r in results.items():
+        line = f"{page:<10}{r['import_ms']:>12.1f}{r['min_ms']:>10.1f}{r['max_ms']:>10.1f}"
+        before = (previous or {}).get(page)
+        if before:
+            line += f"  (前回比 {_change(before['import_ms'], r['import_ms'])})"
+        print(line)
+        print("    内訳: " + ", ".join(f"{name} {ms:.0f}ms" for name, ms in r["packages_ms"].items()))
+
+
+def _change(before, after):
+    if not before:
+        return "-"
+    return f"{(after - before) / before:+.0%}"
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run(args)
+
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous = json.load(f)["results"]
+    print_results(results, previous)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -2,32 +2,283 @@
 # database.py (診断用パッチ適用済み)
 # ==============================================================================
 import streamlit as st
-from pyairtable import Api
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import backends  # Airtable / SQLite のデータストア実装
+import sync  # ローカルとAirtableの同期（mirror モード）
+import scheduler  # Airtableへのリクエストの送信制御
+import metrics  # 処理時間・呼び出し回数の記録
+import write_queue  # 使用登録の書き込みキュー（airtable モード）
+import tenants  # 研究室（テナント）ごとの設定と、現在の研究室
+# analytics（使用ペースの集計）と stocktake（在庫の一括更新）は pandas を使うため、
+# ログイン画面などで読み込まずに済むよう、使う関数の中で読み込みます。
 #from pyairtable.api.errors import Exception # <--- 新しくインポート
-import os
+import contextvars
+import functools
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import ExitStack, contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
-# --- Airtableとの接続設定 ---
-# Streamlit CloudのSecretsから情報を取得
-API_KEY = st.secrets.get("AIRTABLE_API_KEY")
-BASE_ID = st.secrets.get("AIRTABLE_BASE_ID")
+logger = logging.getLogger(__name__)
 
-# Secretsが設定されていない場合のフォールバック（ローカル開発用）
-if not API_KEY or not BASE_ID:
-    st.error("Airtableの接続情報がSecretsに設定されていません。")
-    st.stop()
 
-api = Api(API_KEY)
-# 各テーブルへの接続
-products_table = api.table(BASE_ID, "Products")
-users_table = api.table(BASE_ID, "Users")
-qrcodes_table = api.table(BASE_ID, "QRCodes")
+# 全体の設定（環境変数 → Secrets）。研究室ごとの設定は tenants.Tenant.setting で読みます。
+_get_setting = tenants.get_setting
+
+# --- データストアの接続設定 ---
+# 研究室ごとの DATABASE_BACKEND で保存先を切り替えます（研究室の設定は tenants.py を参照）。
+#   "airtable"（既定）: Airtableに直接読み書きします。
+#   "sqlite"          : SQLITE_PATH のローカルファイルに読み書きします（オフライン動作・ベンチマーク用）。
+#   "mirror"          : SQLITE_PATH のローカルファイルから読み、Airtableとバックグラウンドで同期します。
+
+
+def _connect_airtable(tenant):
+    """SecretsのAPIキーで研究室のAirtableのベースに接続する"""
+    # Streamlit CloudのSecretsから情報を取得
+    api_key = tenant.setting("AIRTABLE_API_KEY")
+    base_id = tenant.setting("AIRTABLE_BASE_ID")
+
+    # Secretsが設定されていない場合のフォールバック（ローカル開発用）
+    if not api_key or not base_id:
+        st.error(f"「{tenant.name}」のAirtableの接続情報がSecretsに設定されていません。")
+        st.stop()
+
+    # 1ベースあたり毎秒5リクエストの上限に合わせて送信し、429や5xxは待ってから再試行します。
+    # 送信枠は研究室（ベース）ごとに持つため、混み合っている研究室が他の研究室の送信を待たせません。
+    request_scheduler = scheduler.RequestScheduler(
+        rate=float(tenant.setting("AIRTABLE_RATE_LIMIT", 5)),
+        max_retries=int(tenant.setting("AIRTABLE_MAX_RETRIES", 5)),
+    )
+    api_options = {}
+    # 接続先を変更できます（ベンチマーク用の模擬サーバー bench/fake_airtable.py など）。
+    endpoint_url = tenant.setting("AIRTABLE_ENDPOINT_URL")
+    if endpoint_url:
+        api_options["endpoint_url"] = endpoint_url
+    return backends.AirtableBackend(
+        api_key,
+        base_id,
+        scheduler=request_scheduler,
+        pool_size=int(tenant.setting("AIRTABLE_POOL_SIZE", 10)),
+        timeout=(float(tenant.setting("AIRTABLE_CONNECT_TIMEOUT", 5)), float(tenant.setting("AIRTABLE_READ_TIMEOUT", 30))),
+        **api_options,
+    )
+
+
+# 接続・キュー・バックグラウンドのスレッドは st.cache_resource で研究室ごとにプロセスに1つだけ作ります。
+# ソースの変更でこのモジュールが読み込み直されても、接続やスレッドが重複して作られません。
+@st.cache_resource(show_spinner=False)
+def _open_datastore(tenant_id, backend_name):
+    """研究室のデータストアに接続する"""
+    tenant = tenants.get(tenant_id)
+    if backend_name == "sqlite":
+        return backends.SQLiteBackend(tenant.setting("SQLITE_PATH", "inventory.db"))
+    if backend_name == "mirror":
+        # 同期スレッドは TenantStore を作るときに開始します。
+        return sync.MirrorBackend(backends.SQLiteBackend(tenant.setting("SQLITE_PATH", "inventory.db")), _connect_airtable(tenant))
+    return _connect_airtable(tenant)
+
+# --- 使用登録の書き込みキュー（airtable モードのみ） ---
+# 使用登録はローカルのSQLiteファイル（WRITE_QUEUE_PATH）に記録した時点で完了とし、
+# Airtableへはバックグラウンドでまとめて送ります（WRITE_QUEUE = "off" で無効にできます）。
+# sqlite / mirror モードは書き込みがローカルで完結するため使いません。
+# キューを使う場合、スキャン直後のQRコードの確認は再試行せずこの秒数で打ち切り、商品キャッシュから調べた内容で続けます。
+QRCODE_LOOKUP_TIMEOUT = float(_get_setting("QRCODE_LOOKUP_TIMEOUT", 1.5))  # 秒
+
+@st.cache_resource(show_spinner=False)
+def _open_consume_queue(path):
+    """書き込みキューのファイルを開く（送信スレッドは TenantStore を作るときに開始します）"""
+    return write_queue.ConsumeQueue(path)
+
+# --- 並行読み取り用のスレッドプール ---
+# 互いに依存しない読み取りを同時に実行し、画面の表示時間を「合計」ではなく「最も遅い1件」に近づけます。
+# スレッドは送信枠やレート制限の待ち時間の間も占有されるため、研究室ごとに別のプールにして、
+# 混み合っている研究室が他の研究室の読み取りを待たせないようにします。
+@st.cache_resource(show_spinner=False)
+def _open_read_pool(tenant_id):
+    tenant = tenants.get(tenant_id)
+    return ThreadPoolExecutor(
+        max_workers=int(tenant.setting("READ_CONCURRENCY", 8)), thread_name_prefix=f"db-read-{tenant_id}"
+    )
+
+# --- 同期スレッド（mirror モードのみ） ---
+@st.cache_resource(show_spinner=False)
+def _start_sync_engine(tenant_id, backend_name):
+    tenant = tenants.get(tenant_id)
+    engine = sync.SyncEngine(_open_datastore(tenant_id, backend_name), interval=float(tenant.setting("SYNC_INTERVAL", 30)))
+    engine.start()
+    return engine
+
+# --- 書き込みキューの送信スレッド（airtable モードのみ） ---
+@st.cache_resource(show_spinner=False)
+def _start_queue_flusher(tenant_id, path):
+    tenant = tenants.get(tenant_id)
+    flusher = write_queue.QueueFlusher(
+        _open_consume_queue(path),
+        metrics.InstrumentedBackend(_open_datastore(tenant_id, "airtable")),
+        interval=float(tenant.setting("WRITE_QUEUE_INTERVAL", 5)),
+    )
+    flusher.start()
+    return flusher
+
+# --- 商品キャッシュの設定 ---
+# キャッシュは研究室ごとに TenantStore が持ち、Streamlitの全セッションで共有されるため、
+# 再実行のたびにProductsテーブル全体をダウンロードせずに済みます。
+PRODUCT_CACHE_TTL = float(_get_setting("PRODUCT_CACHE_TTL", 60))  # 秒
+
+
+# --- ユーザーキャッシュの設定 ---
+# ログインのたびにUsersテーブルへ問い合わせないよう、ユーザー名で引ける索引を保持します。
+USER_CACHE_TTL = float(_get_setting("USER_CACHE_TTL", 300))  # 秒
+
+# --- 使用ペースの集計（在庫切れ・発注点の予測用） ---
+# 使用登録のたびに商品ごとの使用ペースを更新し、画面の表示では使用履歴を読み直しません。
+# 他のサーバーでの使用も反映するため、一定時間ごとに前回以降の使用履歴だけを読んで加えます。
+ANALYTICS_HISTORY_DAYS = float(_get_setting("ANALYTICS_HISTORY_DAYS", 120))  # 最初の集計に使う履歴の期間（日）
+ANALYTICS_REBUILD_INTERVAL = float(_get_setting("ANALYTICS_REBUILD_INTERVAL", 3600))  # 秒
+# 書き込みキューの使用登録は、使用日時より遅れてAirtableに届きます。
+# 取りこぼさないよう、前回読んだ最新の使用日時よりこの時間だけ前から読み直します（重複はQRコードIDで除きます）。
+ANALYTICS_REFRESH_OVERLAP = float(_get_setting("ANALYTICS_REFRESH_OVERLAP", 86400))  # 秒
+
+# このサーバーで使用済みにしたQRコードのレコードIDを覚えておく数（二重使用の防止用、古いものから破棄）
+_CONSUMED_QRCODES_MAX = 10000
+
+
+class TenantStore:
+    """
+    1つの研究室のデータストアへの接続と、キャッシュ・ロックなどの状態。
+    研究室ごとに初めて使うときに作り、以降はプロセス内で使い回します（get_store）。
+    """
+
+    def __init__(self, tenant):
+        self.tenant = tenant
+        self.backend_name = tenant.setting("DATABASE_BACKEND", "airtable")
+        self.datastore = _open_datastore(tenant.id, self.backend_name)
+        # 操作ごとの処理時間を記録するため、データストアは計測用のラッパーを通して使います。
+        self.backend = metrics.InstrumentedBackend(self.datastore)
+        self.read_pool = _open_read_pool(tenant.id)
+        self.consume_queue = None
+        if self.backend_name == "airtable" and str(tenant.setting("WRITE_QUEUE", "on")).lower() not in ("off", "false", "0"):
+            self.consume_queue = _open_consume_queue(tenant.setting("WRITE_QUEUE_PATH", "write_queue.db"))
+
+        # 商品キャッシュ
+        # snapshot: {"records": レコード一覧, "by_id": レコードID → レコード, "by_tag": ProductTag → レコード}
+        # 再取得時はスナップショットごと差し替えるため、読み取り側はロック不要です。
+        self.product_cache_lock = threading.Lock()
+        # generation: キャッシュを更新・破棄するたびに増やす番号（バックグラウンドの取り直しが古い内容で上書きしないように）
+        self.product_cache = {"snapshot": None, "loaded_at": 0.0, "generation": 0, "refreshing": False}
+        # ユーザーキャッシュ
+        # snapshot: {Username: fields}（商品キャッシュと同様に、丸ごと差し替えます）
+        self.user_cache_lock = threading.Lock()
+        self.user_cache = {"snapshot": None, "loaded_at": 0.0}
+        # 使用ペースの集計
+        # tracker: 集計（analytics.ConsumptionTracker。最初に予測を表示するときに作成）、
+        # loaded_at: 最後に使用履歴を読んだ時刻（未読ならNone）、loading: 読み込み中かどうか、
+        # high_water: 読んだ使用履歴の最新の使用日時（UNIX秒）、
+        # counted: 集計に加えたQRコードID → 使用日時（UNIX秒）（読み直す範囲の分だけ保持し、二重に数えないために使います）
+        self.consumption_lock = threading.Lock()
+        self.consumption_state = {"tracker": None, "loaded_at": None, "loading": False, "high_water": None, "counted": {}}
+        # 使用登録（在庫の減算）の排他制御
+        # 同じ商品の在庫を同時に読み書きすると減算が失われるため、商品ごとにロックします。
+        self.product_locks_lock = threading.Lock()
+        self.product_locks = {}
+        # このサーバーで使用済みにしたQRコードのレコードID
+        self.consumed_qrcodes = OrderedDict()
+
+        # スレッドは使い回すため、通知先はこのモジュールの関数とこの研究室の状態に差し替えます。
+        self.sync_engine = None
+        if self.backend_name == "mirror":
+            self.sync_engine = _start_sync_engine(tenant.id, self.backend_name)
+            self.sync_engine.on_change = functools.partial(_on_sync_change, self)
+        self.queue_flusher = None
+        if self.consume_queue is not None:
+            self.queue_flusher = _start_queue_flusher(tenant.id, self.consume_queue.path)
+            self.queue_flusher.on_flushed = functools.partial(_on_queue_flushed, self)
+            self.queue_flusher.on_rejected = functools.partial(invalidate_product_cache, self)
+            self.queue_flusher.lock_products = functools.partial(_lock_products, self)
+
+
+# 研究室ID → TenantStore（研究室ごとに初めて使うときに作ります）
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_store(tenant=None):
+    """研究室（省略時は現在の研究室）の TenantStore を返す"""
+    tenant = tenant or tenants.current()
+    with _stores_lock:
+        store = _stores.get(tenant.id)
+        if store is None:
+            store = _stores[tenant.id] = TenantStore(tenant)
+        return store
+
+def get_backend_name():
+    """現在の研究室のデータストアの種類（"airtable" / "sqlite" / "mirror"）"""
+    return get_store().backend_name
+
+# --- 並行読み取り ---
+@metrics.timed("db.fetch_concurrently")
+def fetch_concurrently(**calls):
+    """
+    独立した読み取りを並行して実行し、{名前: 結果} の辞書で返す。
+    値には引数なしの関数か、(関数, 引数1, 引数2, ...) のタプルを渡します。
+    例: fetch_concurrently(products=get_all_products, qrcode=(get_qrcode_data, "TIP_1"))
+    """
+    # 各スレッドから st.error などを表示できるよう、呼び出し元のスクリプト情報を引き継ぎます。
+    script_ctx = get_script_run_ctx()
+
+    def run(context, fn, args):
+        if script_ctx:
+            add_script_run_ctx(threading.current_thread(), script_ctx)
+        return context.run(fn, *args)
+
+    read_pool = get_store().read_pool
+    futures = {}
+    for name, call in calls.items():
+        fn, *args = call if isinstance(call, tuple) else (call,)
+        futures[name] = read_pool.submit(run, contextvars.copy_context(), fn, args)
+    return {name: future.result() for name, future in futures.items()}
 
 # --- ユーザー管理用の関数 ---
+@metrics.timed("db.get_user_directory")
+def _get_user_directory(store):
+    """ユーザー名 → ユーザー情報 の索引を返す（期限切れの場合のみ全件を再取得する）"""
+    with store.user_cache_lock:
+        snapshot = store.user_cache["snapshot"]
+        if snapshot is None or time.monotonic() - store.user_cache["loaded_at"] > USER_CACHE_TTL:
+            metrics.increment("cache.users.miss")
+            snapshot = {
+                record['fields']['Username']: record['fields']
+                for record in store.backend.all("Users") if 'Username' in record['fields']
+            }
+            store.user_cache["snapshot"] = snapshot
+            store.user_cache["loaded_at"] = time.monotonic()
+        else:
+            metrics.increment("cache.users.hit")
+        return snapshot
+
+def invalidate_user_cache(store=None):
+    """ユーザーキャッシュを破棄し、次回アクセス時に再取得させる（省略時は現在の研究室）"""
+    store = store or get_store()
+    with store.user_cache_lock:
+        store.user_cache["snapshot"] = None
+        store.user_cache["loaded_at"] = 0.0
+
+@metrics.timed("db.get_user")
 def get_user(username):
     """ユーザー名でユーザー情報を取得する"""
+    store = get_store()
     try:
-        records = users_table.all(formula=f"{{Username}} = '{username}'")
+        user = _get_user_directory(store).get(username)
+        if user:
+            return dict(user)
+        # 他のサーバーで登録された直後のユーザーはキャッシュに無いため、直接問い合わせます。
+        records = store.backend.all("Users", {"Username": username})
         if records:
+            with store.user_cache_lock:
+                if store.user_cache["snapshot"] is not None:
+                    store.user_cache["snapshot"] = {**store.user_cache["snapshot"], username: records[0]['fields']}
             return records[0]['fields']
         return None
     except Exception as e:
@@ -40,15 +291,18 @@ def get_user(username):
     '''
     
 
+@metrics.timed("db.add_user")
 def add_user(name, username, hashed_password):
     """新しいユーザーを登録する"""
+    store = get_store()
     try:
-        users_table.create({
+        store.backend.create("Users", {
             "Name": name,
             "Username": username,
             "HashedPassword": hashed_password,
             "Role": "User"  # デフォルトは一般ユーザー
         })
+        invalidate_user_cache(store)
     except Exception as e: # <--- ここで具体的なAPIエラーをキャッチ
         st.error("🚨 ユーザー登録がデータベースに拒否されました。以下の詳細を確認してください:")
         st.code(str(e)) # <--- 拒否された具体的な理由（どのフィールドがダメか）が表示されます。
@@ -57,12 +311,116 @@ def add_user(name, username, hashed_password):
         st.error(f"予期せぬエラー: {e}")
 
 # --- (以下、get_all_products以降の関数は変更なし) ---
+@metrics.timed("db.get_product_cache")
+def _get_product_cache(store, allow_stale=False):
+    """
+    商品キャッシュを返す（期限切れの場合のみデータストアから再取得して索引を作り直す）。
+    allow_stale=True のとき、またはキューを使う場合は、期限切れでもキャッシュがあればそのまま返し、
+    取り直しはバックグラウンドで行います（Airtableが遅い・つながらないときも画面を待たせません）。
+    """
+    # ロック中に取得することで、同時アクセス時の重複ダウンロードを防ぎます。
+    with store.product_cache_lock:
+        snapshot = store.product_cache["snapshot"]
+        expired = snapshot is None or time.monotonic() - store.product_cache["loaded_at"] > PRODUCT_CACHE_TTL
+        if expired and snapshot is not None and (allow_stale or store.consume_queue is not None):
+            metrics.increment("cache.products.stale")
+            _refresh_product_cache_in_background(store)
+        elif expired:
+            metrics.increment("cache.products.miss")
+            snapshot = _build_product_snapshot(_apply_pending_consumes(store, store.backend.all("Products")))
+            store.product_cache["snapshot"] = snapshot
+            store.product_cache["loaded_at"] = time.monotonic()
+        else:
+            metrics.increment("cache.products.hit")
+        return snapshot
+
+def _build_product_snapshot(records):
+    """商品レコードの一覧から、キャッシュのスナップショット（一覧と索引）を作る"""
+    return {
+        "records": records,
+        "by_id": {record['id']: record for record in records},
+        "by_tag": {
+            record['fields']['ProductTag']: record
+            for record in records if 'ProductTag' in record['fields']
+        },
+    }
+
+def _refresh_product_cache_in_background(store):
+    """商品キャッシュをバックグラウンドで取り直す（product_cache_lock を持った状態で呼びます）"""
+    if store.product_cache["refreshing"]:
+        return
+    store.product_cache["refreshing"] = True
+    generation = store.product_cache["generation"]
+
+    def refresh():
+        try:
+            snapshot = _build_product_snapshot(_apply_pending_consumes(store, store.backend.all("Products")))
+            with store.product_cache_lock:
+                # 取り直している間にキャッシュが更新・破棄された場合は、古い内容で上書きしません。
+                if store.product_cache["generation"] == generation:
+                    store.product_cache["snapshot"] = snapshot
+                    store.product_cache["loaded_at"] = time.monotonic()
+        except Exception:
+            logger.warning("商品キャッシュの取り直しに失敗しました（期限切れのキャッシュを使い続けます）", exc_info=True)
+        finally:
+            with store.product_cache_lock:
+                store.product_cache["refreshing"] = False
+
+    threading.Thread(target=refresh, name=f"product-cache-{store.tenant.id}", daemon=True).start()
+
+def _replace_cached_product(store, record):
+    """更新後の商品レコードでキャッシュを差し替える（全件の再取得を避ける）"""
+    with store.product_cache_lock:
+        snapshot = store.product_cache["snapshot"]
+        if snapshot is None or record['id'] not in snapshot["by_id"]:
+            return
+        records = [record if r['id'] == record['id'] else r for r in snapshot["records"]]
+        by_id = dict(snapshot["by_id"])
+        by_id[record['id']] = record
+        by_tag = {tag: (record if r['id'] == record['id'] else r) for tag, r in snapshot["by_tag"].items()}
+        store.product_cache["snapshot"] = {"records": records, "by_id": by_id, "by_tag": by_tag}
+        store.product_cache["generation"] += 1
+
+def _apply_pending_consumes(store, records):
+    """キューにあってまだAirtableに送っていない使用数を、商品レコードの在庫数から引く"""
+    if store.consume_queue is None:
+        return records
+    pending = store.consume_queue.pending_by_product()
+    if not pending:
+        return records
+    return [
+        {**record, 'fields': {**record['fields'], 'CurrentStock': record['fields'].get('CurrentStock', 0) - pending[record['id']]}}
+        if record['id'] in pending else record
+        for record in records
+    ]
+
+def _on_queue_flushed(store, records):
+    """キューの送信で在庫が更新されたときの処理（送信後の値でキャッシュを差し替える）"""
+    for record in _apply_pending_consumes(store, records):
+        _replace_cached_product(store, record)
+
+def invalidate_product_cache(store=None):
+    """商品キャッシュを破棄し、次回アクセス時に再取得させる（省略時は現在の研究室）"""
+    store = store or get_store()
+    with store.product_cache_lock:
+        store.product_cache["snapshot"] = None
+        store.product_cache["loaded_at"] = 0.0
+        store.product_cache["generation"] += 1
+
+def _on_sync_change(store, table):
+    """同期でテーブルが更新されたときの処理（商品が変わったらキャッシュを破棄する）"""
+    if table == "Products":
+        invalidate_product_cache(store)
+
+@metrics.timed("db.get_all_products")
 def get_all_products():
     """すべての商品情報を取得する"""
+    store = get_store()
     try:
-        all_records = products_table.all()
+        all_records = _get_product_cache(store)["records"]
         # Airtableのレスポンス形式に合わせて'fields'キーからデータを抽出
-        return [record['fields'] for record in all_records]
+        # キャッシュ本体が書き換えられないよう、コピーを返します。
+        return [dict(record['fields']) for record in all_records]
     except Exception as e:
         st.error(f"APIエラー: {e}")
         return []
@@ -72,13 +430,28 @@ def get_all_products():
 
 # （中略：以降の関数は省略しますが、上記のコードで全て上書きしてください）
 
+@metrics.timed("db.get_product_by_record_id")
+def get_product_by_record_id(record_id):
+    """AirtableのレコードIDで商品情報を取得する（キャッシュの索引を使用）"""
+    store = get_store()
+    try:
+        record = _get_product_cache(store)["by_id"].get(record_id)
+        if record:
+            return {'id': record['id'], 'fields': dict(record['fields'])}
+        return None
+    except Exception as e:
+        st.error(f"APIエラー: {e}")
+        return None
+
+@metrics.timed("db.get_product_by_tag")
 def get_product_by_tag(product_tag):
-    """ProductTagで商品情報を取得する"""
+    """ProductTagで商品情報を取得する（キャッシュの索引を使用）"""
+    store = get_store()
     try:
-        records = products_table.all(formula=f"{{ProductTag}} = '{product_tag}'")
-        if records:
+        record = _get_product_cache(store)["by_tag"].get(product_tag)
+        if record:
             # IDも一緒に返すように変更
-            return {'id': records[0]['id'], 'fields': records[0]['fields']}
+            return {'id': record['id'], 'fields': dict(record['fields'])}
         return None
     except Exception as e:
         st.error(f"APIエラー: {e}")
@@ -87,68 +460,532 @@ def get_product_by_tag(product_tag):
         st.error(f"予期せぬエラー: {e}")
         return None
 
+@metrics.timed("db.update_stock")
 def update_stock(record_id, quantity_change):
     """在庫数を更新する (record_idで指定)"""
+    store = get_store()
     try:
-        current_record = products_table.get(record_id)
+        current_record = store.backend.get("Products", record_id)
         current_stock = current_record['fields'].get('CurrentStock', 0)
         new_stock = current_stock + quantity_change
-        products_table.update(record_id, {"CurrentStock": new_stock})
+        store.backend.update("Products", record_id, {"CurrentStock": new_stock})
+        invalidate_product_cache(store)
     except Exception as e:
         st.error(f"APIエラー: {e}")
     except Exception as e:
         st.error(f"予期せぬエラー: {e}")
 
 # --- QRコード管理用の関数 (新規追加) ---
+@metrics.timed("db.get_qrcode_data")
 def get_qrcode_data(qrcode_id):
-    """QRCodeIDでQRコードの情報を取得する"""
+    """
+    QRCodeIDでQRコードの情報を取得する。
+    キューを使う場合は、Airtableへの確認を短時間の1回だけにし、遅い・つながらないときは
+    商品キャッシュからQRコードの情報を作って返します（_qrcode_data_from_tag）。
+    """
+    store = get_store()
     try:
-        records = qrcodes_table.all(formula=f"{{QRCodeID}} = '{qrcode_id}'")
+        with scheduler.fail_fast(QRCODE_LOOKUP_TIMEOUT) if store.consume_queue is not None else nullcontext():
+            records = store.backend.all("QRCodes", {"QRCodeID": qrcode_id})
         if records:
+            fields = records[0]['fields']
+            if store.consume_queue is not None and store.consume_queue.contains(records[0]['id'], qrcode_id):
+                # キューにある使用登録は、Airtableへの送信前でも使用済みとして扱います。
+                fields = {**fields, "Status": "使用済み"}
             # レコードIDとフィールドデータを両方返す
-            return {'id': records[0]['id'], 'fields': records[0]['fields']}
+            return {'id': records[0]['id'], 'fields': fields}
         return None
     except Exception as e:
+        if store.consume_queue is not None:
+            logger.warning("QRコードを確認できないため、商品キャッシュから調べます（%s）: %s", qrcode_id, e)
+            qrcode_data = _qrcode_data_from_tag(store, qrcode_id)
+            if qrcode_data:
+                return qrcode_data
         st.error(f"APIエラー: {e}")
         return None
     except Exception as e:
         st.error(f"予期せぬエラー: {e}")
         return None
 
+@metrics.timed("db.get_qrcodes_data")
+def get_qrcodes_data(qrcode_ids):
+    """複数のQRCodeIDのQRコードの情報をまとめて取得し、{QRCodeID: {'id', 'fields'}} で返す（失敗時はNone）"""
+    store = get_store()
+    try:
+        found = {}
+        cursor = None
+        while True:
+            with scheduler.fail_fast(QRCODE_LOOKUP_TIMEOUT) if store.consume_queue is not None else nullcontext():
+                records, cursor = store.backend.query_page(
+                    "QRCodes", [("QRCodeID", "in", list(qrcode_ids))], page_size=100, cursor=cursor
+                )
+            for record in records:
+                fields = record['fields']
+                if store.consume_queue is not None and store.consume_queue.contains(record['id'], fields.get('QRCodeID')):
+                    # キューにある使用登録は、Airtableへの送信前でも使用済みとして扱います。
+                    fields = {**fields, "Status": "使用済み"}
+                found[fields.get('QRCodeID')] = {'id': record['id'], 'fields': fields}
+            if not cursor:
+                return found
+    except Exception as e:
+        if store.consume_queue is not None:
+            logger.warning("QRコードを確認できないため、商品キャッシュから調べます（%d件）: %s", len(qrcode_ids), e)
+            found = {qrcode_id: _qrcode_data_from_tag(store, qrcode_id) for qrcode_id in qrcode_ids}
+            return {qrcode_id: qrcode_data for qrcode_id, qrcode_data in found.items() if qrcode_data}
+        st.error(f"APIエラー: {e}")
+        return None
+
+def _qrcode_data_from_tag(store, qrcode_id):
+    """
+    Airtableに問い合わせずに、QRCodeID（「商品タグ_連番」）の商品タグから商品キャッシュを引いてQRコードの情報を作る。
+    レコードIDは分からないためNoneで、'unverified': True を付けます。QRコードが実在して未使用かどうかは、
+    キューの送信時に確認します（確認できなければ「送信できなかった使用登録」になります）。
+    商品が見つからない場合はNoneを返します。
+    """
+    try:
+        product_record = _get_product_cache(store, allow_stale=True)["by_tag"].get(qrcode_id.rsplit("_", 1)[0])
+    except Exception:
+        return None
+    if product_record is None:
+        return None
+    status = "使用済み" if store.consume_queue.contains(qrcode_id=qrcode_id) else "未使用"
+    return {
+        'id': None,
+        'fields': {"QRCodeID": qrcode_id, "Product": [product_record['id']], "Status": status},
+        'unverified': True,
+    }
+
+@metrics.timed("db.create_new_qrcode")
 def create_new_qrcode(product_record_id, product_tag):
     """新しいQRコードを作成し、DBに登録する"""
+    new_qrcode_ids = create_qrcodes_bulk(product_record_id, product_tag, 1)
+    return new_qrcode_ids[0] if new_qrcode_ids else None
+
+@metrics.timed("db.create_qrcodes_bulk")
+def create_qrcodes_bulk(product_record_id, product_tag, count):
+    """新しいQRコードをまとめて作成し、作成したQRCodeIDのリストを返す（失敗時はNone）"""
+    store = get_store()
     try:
-        # 該当商品の最新番号を取得して+1する
-        product_record = products_table.get(product_record_id)
-        latest_num = product_record['fields'].get('LatestQRCodeNum', 0)
-        new_num = latest_num + 1
-        
+        # 同じ商品の番号を同時に予約しないよう、在庫の更新と同じロックを使います。
+        with _get_product_lock(store, product_record_id):
+            # 該当商品の最新番号を取得し、count件分の番号を1回の更新でまとめて予約する
+            product_record = store.backend.get("Products", product_record_id)
+            latest_num = product_record['fields'].get('LatestQRCodeNum', 0)
+            updated = store.backend.update("Products", product_record_id, {"LatestQRCodeNum": latest_num + count})
+            _replace_cached_product(store, updated)
+
         # 新しいQRCodeIDを作成
-        new_qrcode_id = f"{product_tag}_{new_num}"
-        
-        # QRCodesテーブルに新しいレコードを追加
-        qrcodes_table.create({
-            "QRCodeID": new_qrcode_id,
-            "Product": [product_record_id],  # 連携レコードはリストでIDを指定
-            "Status": "未使用"
-        })
-        
-        # Productsテーブルの最新番号を更新
-        products_table.update(product_record_id, {"LatestQRCodeNum": new_num})
-        
-        return new_qrcode_id
+        new_qrcode_ids = [f"{product_tag}_{num}" for num in range(latest_num + 1, latest_num + count + 1)]
+
+        # QRCodesテーブルに新しいレコードを追加（batch_create が BATCH_SIZE 件ずつに分けて送信します）
+        store.backend.batch_create("QRCodes", [
+            {
+                "QRCodeID": qrcode_id,
+                "Product": [product_record_id],  # 連携レコードはリストでIDを指定
+                "Status": "未使用"
+            }
+            for qrcode_id in new_qrcode_ids
+        ])
+        return new_qrcode_ids
     except Exception as e:
         st.error(f"APIエラー: {e}")
         return None
+
+def _get_product_lock(store, product_record_id):
+    """商品ごとのロックを返す（無ければ作成する）"""
+    with store.product_locks_lock:
+        if product_record_id not in store.product_locks:
+            store.product_locks[product_record_id] = threading.Lock()
+        return store.product_locks[product_record_id]
+
+@contextmanager
+def _lock_products(store, product_record_ids):
+    """
+    複数の商品のロックをまとめて取る（with 文で使います）。
+    互いに待ち合わないよう、レコードIDの順に取ります（使用登録・一括更新・キューの送信で共通）。
+    """
+    with ExitStack() as stack:
+        for product_record_id in sorted(set(product_record_ids)):
+            stack.enter_context(_get_product_lock(store, product_record_id))
+        yield
+
+def _to_utc_iso(dt, milliseconds=False):
+    """日時をAirtableと同じ形式のUTC文字列（例: 2024-04-01T09:30:00.000Z）にする（milliseconds=True ならミリ秒まで）"""
+    dt = dt.astimezone(timezone.utc)
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.") + f"{dt.microsecond // 1000 if milliseconds else 0:03d}Z"
+
+@metrics.timed("db.consume_qrcode")
+def consume_qrcode(qrcode_record_id, product_record_id, used_by=None, qrcode_id=None):
+    """QRコード1枚分の使用を記録し、更新後の在庫数を返す（失敗時はNone）"""
+    new_stocks = consume_qrcodes([(qrcode_record_id, product_record_id, qrcode_id)], used_by=used_by)
+    return new_stocks[product_record_id] if new_stocks else None
+
+@metrics.timed("db.consume_qrcodes")
+def consume_qrcodes(items, used_by=None):
+    """
+    複数のQRコードの使用をまとめて記録し、{商品のレコードID: 更新後の在庫数} を返す。
+    items は (QRコードのレコードID, 商品のレコードID, QRCodeID) のリストです。
+    キューを使う場合、Airtableにつながらずレコードが分からないQRコードはレコードIDをNoneにできます（QRCodeIDで積みます）。
+    在庫は商品ごとに使用数をまとめて減らし、QRコードと商品の書き込みはそれぞれ batch_update でまとめて行います。
+    1つでも記録できない場合は、どれも記録せずにNoneを返します。
+
+    同時使用の防止は、商品ごとのロック（このサーバーのプロセス内）と書き込み前後の読み直しで行います。
+    Airtableには条件付き更新が無いため、複数のサーバーで同じベースを使う場合は完全には防げません。
+    読み直しの間に別のサーバーが同じQRコードを書き込んだ場合や、使用日時（ミリ秒まで）と使用者が
+    別のサーバーの書き込みと一致した場合は二重に記録されることがあり、
+    同じ商品の在庫を同時に減らすと片方の減算が失われることがあります（1台のサーバーで動かす前提です）。
+    """
+    store = get_store()
+    # 同じQRコードが重複していても1回だけ数えます。
+    items = list({qrcode_id or qrcode_record_id: (qrcode_record_id, product_record_id, qrcode_id)
+                  for qrcode_record_id, product_record_id, qrcode_id in items}.values())
+    counts = Counter(product_record_id for _, product_record_id, _ in items)
+    try:
+        # Airtableには条件付き更新が無いため、同じ商品の読み取り〜書き込みをロックで直列化し、
+        # ロック内で最新の在庫数を読み直してから減算します。
+        with _lock_products(store, counts):
+            if store.consume_queue is not None:
+                return _enqueue_consumes(store, items, counts, used_by)
+            if any(qrcode_record_id in store.consumed_qrcodes for qrcode_record_id, _, _ in items):
+                st.error("既に使用されているQRコードがあります。")
+                return None
+
+            # 別のサーバーがすでに使用済みにしていないかの確認と、在庫数の読み取りを同時に行います。
+            qrcode_record_ids = [qrcode_record_id for qrcode_record_id, _, _ in items]
+            current = fetch_concurrently(
+                qrcodes=(store.backend.get_many, "QRCodes", qrcode_record_ids),
+                products=(store.backend.get_many, "Products", list(counts)),
+            )
+            if any(r['fields'].get('Status') == "使用済み" for r in current["qrcodes"]):
+                st.error("既に使用されているQRコードがあります。")
+                return None
+            products = {r['id']: r for r in current["products"]}
+            new_stocks = _decrement_stocks(products, counts)
+            if new_stocks is None:
+                return None
+
+            # 先にQRコードを使用済みにして、二重使用を防ぎます。使用日時と使用者は使用履歴に使います。
+            # 使用日時はミリ秒まで書き、読み直したときに同じ秒の別のサーバーの書き込みと区別できるようにします。
+            used_fields = {"Status": "使用済み", "UsedAt": _to_utc_iso(datetime.now(timezone.utc), milliseconds=True)}
+            if used_by:
+                used_fields["UsedBy"] = used_by
+            # 途中で失敗したときに取り消す範囲（使用済みにできたQRコードと、在庫を減らせた商品）
+            marked, decremented = [], Counter()
+            try:
+                for start in range(0, len(qrcode_record_ids), backends.BATCH_SIZE):
+                    chunk = qrcode_record_ids[start:start + backends.BATCH_SIZE]
+                    store.backend.batch_update("QRCodes", [{"id": qrcode_record_id, "fields": used_fields} for qrcode_record_id in chunk])
+                    marked += chunk
+                # 在庫の書き込みと並行して、QRコードを読み直します。
+                # 別のサーバーが同じQRコードを同時に使用した場合は、後から書いた方の使用日時・使用者が残ります。
+                verify = store.read_pool.submit(contextvars.copy_context().run, store.backend.get_many, "QRCodes", marked)
+                updated = []
+                product_record_ids = list(new_stocks)
+                for start in range(0, len(product_record_ids), backends.BATCH_SIZE):
+                    chunk = product_record_ids[start:start + backends.BATCH_SIZE]
+                    updated += store.backend.batch_update("Products", [
+                        {"id": product_record_id, "fields": {"CurrentStock": new_stocks[product_record_id]}}
+                        for product_record_id in chunk
+                    ])
+                    decremented.update({product_record_id: counts[product_record_id] for product_record_id in chunk})
+                written = {r['id']: r['fields'] for r in verify.result()}
+            except Exception:
+                # 書き込めた分だけを取り消します（在庫数は最新の値に足し戻します）。取り消しに失敗しても元のエラーを返します。
+                try:
+                    _cancel_consumes(store, marked, decremented)
+                except Exception:
+                    logger.exception("使用登録の取り消しに失敗しました（QRコード %d件、商品 %d件）", len(marked), len(decremented))
+                raise
+
+            # 読み直して自分の書き込みが残っていなければ、この使用登録を取り消します。
+            lost = [
+                qrcode_record_id for qrcode_record_id in marked
+                if any(written.get(qrcode_record_id, {}).get(f) != used_fields.get(f) for f in ("UsedAt", "UsedBy"))
+            ]
+            if lost:
+                _cancel_consumes(store, [q for q in marked if q not in lost], counts)
+                st.error("ほかの端末で同時に使用されたQRコードがあるため、使用の記録を取り消しました。")
+                return None
+
+            for qrcode_record_id, _, _ in items:
+                store.consumed_qrcodes[qrcode_record_id] = True
+                if len(store.consumed_qrcodes) > _CONSUMED_QRCODES_MAX:
+                    store.consumed_qrcodes.popitem(last=False)
+            # 書き込み結果でキャッシュを更新するので、画面側で再取得する必要はありません。
+            for record in updated:
+                _replace_cached_product(store, record)
+            qrcode_ids = {r['id']: r['fields'].get('QRCodeID') for r in current["qrcodes"]}
+            for product_record_id in counts:
+                _record_consumption(store, products[product_record_id]['fields'].get('ProductTag'), [
+                    qrcode_ids.get(qrcode_record_id) for qrcode_record_id, p, _ in items if p == product_record_id
+                ])
+            return new_stocks
     except Exception as e:
-        st.error(f"予期せぬエラー: {e}")
+        st.error(f"APIエラー: {e}")
         return None
 
+def _cancel_consumes(store, qrcode_record_ids, counts):
+    """
+    書き込んだ使用登録を取り消す（qrcode_record_ids のQRコードを未使用に戻し、在庫数に使用数を足し戻す）。
+    在庫数は別のサーバーが書き換えている場合があるため、元の値ではなく最新の値に足し戻します。
+    """
+    if qrcode_record_ids:
+        store.backend.batch_update("QRCodes", [
+            {"id": qrcode_record_id, "fields": {"Status": "未使用", "UsedAt": None, "UsedBy": None}}
+            for qrcode_record_id in qrcode_record_ids
+        ])
+    if counts:
+        products = store.backend.get_many("Products", list(counts))
+        store.backend.batch_update("Products", [
+            {"id": r['id'], "fields": {"CurrentStock": r['fields'].get('CurrentStock', 0) + counts[r['id']]}}
+            for r in products
+        ])
+    invalidate_product_cache(store)
+
+def _decrement_stocks(products, counts):
+    """商品ごとの使用数を在庫数から引いた {商品のレコードID: 在庫数} を返す（足りない場合はNone）"""
+    new_stocks = {}
+    for product_record_id, count in counts.items():
+        product_record = products.get(product_record_id)
+        if product_record is None:
+            st.error("QRコードに紐づく商品が見つかりませんでした。")
+            return None
+        current_stock = product_record['fields'].get('CurrentStock', 0)
+        if current_stock < count:
+            product_name = product_record['fields'].get('ProductName')
+            st.error(f"「{product_name}」の在庫が足りません（在庫 {current_stock}、使用 {count}）。" if current_stock > 0 else "在庫がありません。")
+            return None
+        new_stocks[product_record_id] = current_stock - count
+    return new_stocks
+
+def _enqueue_consumes(store, items, counts, used_by):
+    """使用登録をキューに積み、キャッシュ上の在庫数から減らした値を返す（Airtableへの送信は待たない）"""
+    cached_products = _get_product_cache(store, allow_stale=True)["by_id"]
+    new_stocks = _decrement_stocks(cached_products, counts)
+    if new_stocks is None:
+        return None
+    # 同じQRコードはキューに1度しか積めないため、送信前でも二重使用を防げます。
+    used_at = _to_utc_iso(datetime.now(timezone.utc), milliseconds=True)
+    if store.consume_queue.enqueue([
+        (qrcode_record_id, product_record_id, used_at, used_by, qrcode_id)
+        for qrcode_record_id, product_record_id, qrcode_id in items
+    ]):
+        st.error("既に使用されているQRコードがあります。")
+        return None
+    metrics.increment("queue.enqueued", len(items))
+
+    for product_record_id, new_stock in new_stocks.items():
+        product_record = cached_products[product_record_id]
+        _replace_cached_product(store, {**product_record, 'fields': {**product_record['fields'], 'CurrentStock': new_stock}})
+        _record_consumption(store, product_record['fields'].get('ProductTag'), [
+            qrcode_id for _, p, qrcode_id in items if p == product_record_id
+        ])
+    return new_stocks
+
+def get_write_queue_status():
+    """書き込みキューの状態ごとの件数と、送信できなかった使用登録を返す（キューを使わない場合はNone）"""
+    store = get_store()
+    if store.consume_queue is None:
+        return None
+    return {"counts": store.consume_queue.counts(), "rejected": store.consume_queue.rejected()}
+
+# --- 使用履歴 ---
+@metrics.timed("db.query_usage_history")
+def query_usage_history(since=None, until=None, product_tag=None, used_by=None, status=None,
+                        page_size=50, cursor=None):
+    """
+    条件に合うQRコードの使用履歴を1ページ分だけ取得する（新しい順）。
+    絞り込みはデータストア側で行い、戻り値は (行のリスト, 次ページのカーソル) です。
+    since / until はタイムゾーン付きのdatetime（until は含まない）。
+    """
+    store = get_store()
+    conditions = []
+    if since:
+        conditions.append(("UsedAt", "since", _to_utc_iso(since)))
+    if until:
+        conditions.append(("UsedAt", "until", _to_utc_iso(until)))
+    if product_tag:
+        # QRCodeIDは「商品タグ_連番」なので、「商品タグ_」の後が数字だけのものに絞り込みます
+        # （単純な前方一致では、TIP で別の商品 TIP_L の TIP_L_1 まで一致してしまうため）。
+        conditions.append(("QRCodeID", "numbered", f"{product_tag}_"))
+    if used_by:
+        conditions.append(("UsedBy", "=", used_by))
+    if status:
+        conditions.append(("Status", "=", status))
+
+    try:
+        records, next_cursor = store.backend.query_page(
+            "QRCodes", conditions, sort_field="UsedAt", descending=True, page_size=page_size, cursor=cursor
+        )
+    except Exception as e:
+        st.error(f"APIエラー: {e}")
+        return [], None
+
+    rows = []
+    for record in records:
+        fields = record['fields']
+        product_record_id = (fields.get('Product') or [None])[0]
+        product = get_product_by_record_id(product_record_id) if product_record_id else None
+        rows.append({
+            "QRCodeID": fields.get('QRCodeID'),
+            "ProductName": product['fields'].get('ProductName') if product else None,
+            "Status": fields.get('Status'),
+            "UsedAt": fields.get('UsedAt'),
+            "UsedBy": fields.get('UsedBy'),
+        })
+    return rows, next_cursor
+
+# --- 使用ペースと在庫切れの予測 ---
+@metrics.timed("db.get_consumption_tracker")
+def get_consumption_tracker():
+    """
+    商品ごとの使用ペースの集計と、集計が使える状態かどうかを (集計, 準備済みか) で返す。
+    使用履歴からの作り直しはバックグラウンドで行い、画面の表示は待たせません。
+    """
+    store = get_store()
+    with store.consumption_lock:
+        if store.consumption_state["tracker"] is None:
+            import analytics
+            store.consumption_state["tracker"] = analytics.ConsumptionTracker()
+        loaded_at = store.consumption_state["loaded_at"]
+        expired = loaded_at is None or time.monotonic() - loaded_at > ANALYTICS_REBUILD_INTERVAL
+        if expired and not store.consumption_state["loading"]:
+            store.consumption_state["loading"] = True
+            threading.Thread(target=_rebuild_consumption, args=(store,), name=f"consumption-rebuild-{store.tenant.id}", daemon=True).start()
+        return store.consumption_state["tracker"], loaded_at is not None
+
+def _record_consumption(store, product_tag, qrcode_ids):
+    """使用を集計に加える（集計がまだ無い場合は、作成時に使用履歴から読み込まれます）"""
+    now = time.time()
+    with store.consumption_lock:
+        tracker = store.consumption_state["tracker"]
+        if tracker is None:
+            return
+        counted = store.consumption_state["counted"]
+        new_ids = [qrcode_id for qrcode_id in qrcode_ids if qrcode_id is None or qrcode_id not in counted]
+        if new_ids:
+            counted.update((qrcode_id, now) for qrcode_id in new_ids if qrcode_id is not None)
+            tracker.record(product_tag, at=now, count=len(new_ids))
+
+@metrics.timed("db.rebuild_consumption")
+def _rebuild_consumption(store):
+    """
+    前回以降の使用済みのQRコードを読み、使用ペースの集計に加える（初回は ANALYTICS_HISTORY_DAYS 日分）。
+    このサーバーで記録済みのものや、前回と重なって読んだものは数えません。
+    """
+    try:
+        high_water = store.consumption_state["high_water"]
+        if high_water is None:
+            since = time.time() - ANALYTICS_HISTORY_DAYS * 86400
+        else:
+            since = high_water - ANALYTICS_REFRESH_OVERLAP
+        conditions = [("UsedAt", "since", _to_utc_iso(datetime.fromtimestamp(since, timezone.utc))), ("Status", "=", "使用済み")]
+        events = {}
+        cursor = None
+        while True:
+            records, cursor = store.backend.query_page("QRCodes", conditions, page_size=100, cursor=cursor)
+            for record in records:
+                fields = record['fields']
+                events[fields.get('QRCodeID', '')] = fields.get('UsedAt')
+            if not cursor:
+                break
+
+        used_at_seconds = {
+            qrcode_id: datetime.fromisoformat(used_at.replace('Z', '+00:00')).timestamp()
+            for qrcode_id, used_at in events.items() if qrcode_id and used_at
+        }
+        with store.consumption_lock:
+            counted = store.consumption_state["counted"]
+            new_ids = [qrcode_id for qrcode_id in used_at_seconds if qrcode_id not in counted]
+            # QRCodeIDは「商品タグ_連番」なので、商品を引かずにタグが分かります。
+            store.consumption_state["tracker"].merge(
+                [qrcode_id.rsplit('_', 1)[0] for qrcode_id in new_ids],
+                [events[qrcode_id] for qrcode_id in new_ids],
+            )
+            counted.update((qrcode_id, used_at_seconds[qrcode_id]) for qrcode_id in new_ids)
+            high_water = max([*used_at_seconds.values(), *([] if high_water is None else [high_water])], default=None)
+            store.consumption_state["high_water"] = high_water
+            # 次に読み直す範囲より古いものは、もう重複しないので忘れます。
+            if high_water is not None:
+                oldest = high_water - ANALYTICS_REFRESH_OVERLAP
+                store.consumption_state["counted"] = {q: t for q, t in counted.items() if t >= oldest}
+            store.consumption_state["loaded_at"] = time.monotonic()
+    except Exception:
+        logger.exception("使用ペースの集計に失敗しました")
+    finally:
+        with store.consumption_lock:
+            store.consumption_state["loading"] = False
+
+@metrics.timed("db.forecast_stock")
+def forecast_stock(products, lead_time_days=7.0):
+    """商品一覧に、使用ペース・在庫切れまでの日数・発注点・状態を加えた DataFrame と、集計が準備済みかを返す"""
+    import analytics
+    tracker, ready = get_consumption_tracker()
+    return analytics.forecast(products, tracker, lead_time_days=lead_time_days), ready
+
+# --- 在庫の一括更新（入荷・棚卸し） ---
+@metrics.timed("db.reconcile_stock")
+def reconcile_stock(counts, mode="set"):
+    """
+    アップロードされた数量（stocktake.read_upload の戻り値）を現在の在庫と突き合わせた結果を返す。
+    mode は stocktake.MODE_SET（棚卸し）か stocktake.MODE_ADD（入荷）です。
+    """
+    store = get_store()
+    import stocktake
+    try:
+        return stocktake.reconcile(_get_product_cache(store)["records"], counts, mode)
+    except Exception as e:
+        st.error(f"APIエラー: {e}")
+        return None
+
+@metrics.timed("db.apply_stock_changes")
+def apply_stock_changes(report, mode="set", progress=None):
+    """
+    突き合わせの結果のうち在庫数が変わる行だけを、backends.BATCH_SIZE 件ずつ batch_update で反映する。
+    反映できたかどうかを Applied / Error 列に加えた結果を返します（progress(済み件数, 全件数) で進み具合を通知）。
+    """
+    store = get_store()
+    import stocktake
+    report = report.copy()
+    report["Applied"] = False
+    report["Error"] = None
+    changed = stocktake.changed_rows(report)
+    for start in range(0, len(changed), backends.BATCH_SIZE):
+        chunk = changed.iloc[start:start + backends.BATCH_SIZE]
+        record_ids = chunk["RecordID"].tolist()
+        try:
+            # 使用登録・キューの送信と同じ商品ごとのロックを取り、その間に在庫数が書き換わらないようにします。
+            with _lock_products(store, record_ids):
+                if mode == stocktake.MODE_ADD:
+                    # 入荷は突き合わせ後の使用分も含めた最新の在庫数に足します。
+                    latest = {r['id']: r['fields'].get('CurrentStock') or 0 for r in store.backend.get_many("Products", record_ids)}
+                    values = [latest.get(record_id, 0) + int(d) for record_id, d in zip(record_ids, chunk["Difference"])]
+                else:
+                    # キューにある使用登録は送信時に在庫から引かれるため、棚卸しではその分を足して書き込みます。
+                    # ロック中は同じ商品の使用登録も送信も進まないため、ここで読んだ件数が書き込みまで変わりません。
+                    pending = store.consume_queue.pending_by_product() if store.consume_queue is not None else {}
+                    values = [int(n) + pending.get(record_id, 0) for record_id, n in zip(record_ids, chunk["NewStock"])]
+                store.backend.batch_update("Products", [
+                    {"id": record_id, "fields": {"CurrentStock": int(value)}} for record_id, value in zip(record_ids, values)
+                ])
+            report.loc[chunk.index, "Applied"] = True
+            metrics.increment("stocktake.rows_applied", len(chunk))
+        except Exception as e:
+            logger.exception("在庫の一括更新に失敗しました（%d件）", len(chunk))
+            report.loc[chunk.index, "Error"] = str(e)
+        if progress:
+            progress(start + len(chunk), len(changed))
+    invalidate_product_cache(store)
+    return report
+
+@metrics.timed("db.mark_qrcode_as_used")
 def mark_qrcode_as_used(qrcode_record_id):
     """QRコードの状態を「使用済み」に更新する"""
+    store = get_store()
     try:
-        qrcodes_table.update(qrcode_record_id, {"Status": "使用済み"})
+        store.backend.update("QRCodes", qrcode_record_id, {"Status": "使用済み"})
     except Exception as e:
         st.error(f"APIエラー: {e}")
     except Exception as e:
-        st.error(f"予期せぬエラー: {e}")
\ No newline at end of file
+        st.error(f"予期せぬエラー: {e}")
+
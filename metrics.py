@@ -0,0 +1,360 @@
+# ==============================================================================
+# metrics.py
+# 処理時間・呼び出し回数・エラー率を記録します（性能の確認・チューニング用）。
+#   - database.py の各関数、データストアの操作、Airtableへの通信、
+#     QRコードの読み取り・画像作成にかかった時間を記録します。
+#   - 1回の画面表示あたりのAirtableへの通信回数を記録します。
+#   - 起動時（プロセスで最初の1回）のモジュールの読み込み時間と画面表示の時間を記録します。
+#   - 記録は全セッション共有で、管理者メニューの「性能」タブと Prometheus のテキスト形式で確認できます。
+# ==============================================================================
+import contextvars
+import functools
+import importlib
+import logging
+import os
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# パーセンタイルの計算に使う直近の記録数（項目ごと）
+WINDOW_SIZE = 1024
+QUANTILES = (0.5, 0.95, 0.99)
+PROMETHEUS_PREFIX = "stock_app"
+
+# 記録の種類（Prometheus のメトリクス名になります）
+DURATION = "duration_seconds"
+API_CALLS_PER_RENDER = "api_calls_per_render"
+BACKEND_CALLS_PER_RENDER = "backend_calls_per_render"
+
+# 計測中の処理と、表示中の画面（スレッドごと。fetch_concurrently のスレッドにも引き継がれます）
+_current_span = contextvars.ContextVar("metrics_span", default=None)
+_current_render = contextvars.ContextVar("metrics_render", default=None)
+
+_export_thread = None
+_export_lock = threading.Lock()
+
+
+class _Span:
+    """計測中の処理。内側の処理（データストアの操作など）が失敗したら、外側も失敗として数えます。"""
+
+    __slots__ = ("parent", "failed")
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.failed = False
+
+
+class _Series:
+    """1項目分の記録（件数・合計は起動時から、パーセンタイルは直近 WINDOW_SIZE 件から計算）"""
+
+    def __init__(self, kind, window):
+        self.kind = kind
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=window)
+
+
+class MetricsRegistry:
+    """処理時間などの記録をまとめて保持するクラス"""
+
+    def __init__(self, window=WINDOW_SIZE):
+        self.window = window
+        self.started_at = time.time()
+        self._series = {}
+        self._counters = defaultdict(int)
+        # 起動時の記録（名前 → 秒）。プロセスで1度しか測れないため、reset() では消しません。
+        self._startup = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, error=False, kind=DURATION):
+        """値を1件記録する（処理時間は秒で渡します）"""
+        with self._lock:
+            series = self._series.get((kind, name))
+            if series is None:
+                series = self._series[(kind, name)] = _Series(kind, self.window)
+            series.count += 1
+            series.total += value
+            series.recent.append(value)
+            if error:
+                series.errors += 1
+
+    def increment(self, name, amount=1):
+        """回数を数える（キャッシュのヒット数など）"""
+        with self._lock:
+            self._counters[name] += amount
+
+    @contextmanager
+    def time(self, name):
+        """with ブロックの処理時間を記録する。例外が発生した場合はエラーとして数えます。"""
+        span = _Span(_current_span.get())
+        token = _current_span.set(span)
+        started = time.perf_counter()
+        try:
+            yield span
+        except Exception:
+            span.failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            _current_span.reset(token)
+            # database.py の関数は例外を画面のエラー表示に変えて握りつぶすため、内側の失敗を引き継ぎます。
+            if span.failed and span.parent is not None:
+                span.parent.failed = True
+            self.observe(name, elapsed, error=span.failed)
+
+    def timed(self, name):
+        """関数の処理時間を記録するデコレータ"""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.time(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        """項目ごとの集計と、回数の一覧を返す"""
+        with self._lock:
+            items = [
+                (kind, name, s.count, s.errors, s.total, sorted(s.recent))
+                for (kind, name), s in self._series.items()
+            ]
+            counters = dict(self._counters)
+        rows = []
+        for kind, name, count, errors, total, recent in sorted(items):
+            row = {
+                "kind": kind,
+                "name": name,
+                "count": count,
+                "errors": errors,
+                "error_rate": errors / count if count else 0.0,
+                "mean": total / count if count else None,
+                "sum": total,
+            }
+            for q in QUANTILES:
+                row[_quantile_label(q)] = _percentile(recent, q)
+            rows.append(row)
+        return rows, dict(sorted(counters.items()))
+
+    def record_startup(self, name, seconds):
+        """起動時の処理時間を記録する（同じ名前は最初の1回だけ）"""
+        with self._lock:
+            self._startup.setdefault(name, seconds)
+
+    def startup_times(self):
+        """起動時の記録を {名前: 秒} で返す"""
+        with self._lock:
+            return dict(self._startup)
+
+    def reset(self):
+        """記録をすべて消去する"""
+        with self._lock:
+            self._series.clear()
+            self._counters.clear()
+            self.started_at = time.time()
+
+    def to_prometheus(self):
+        """記録を Prometheus のテキスト形式（summary / counter）で返す"""
+        rows, counters = self.summary()
+        lines = []
+        by_kind = defaultdict(list)
+        for row in rows:
+            by_kind[row["kind"]].append(row)
+
+        for kind, kind_rows in by_kind.items():
+            metric = f"{PROMETHEUS_PREFIX}_{kind}"
+            lines.append(f"# TYPE {metric} summary")
+            for row in kind_rows:
+                label = f'name="{_escape_label(row["name"])}"'
+                for q in QUANTILES:
+                    value = row[_quantile_label(q)]
+                    if value is not None:
+                        lines.append(f'{metric}{{{label},quantile="{q}"}} {value:.6g}')
+                lines.append(f"{metric}_sum{{{label}}} {row['sum']:.6g}")
+                lines.append(f"{metric}_count{{{label}}} {row['count']}")
+
+        durations = by_kind.get(DURATION, [])
+        if durations:
+            metric = f"{PROMETHEUS_PREFIX}_errors_total"
+            lines.append(f"# TYPE {metric} counter")
+            for row in durations:
+                lines.append(f'{metric}{{name="{_escape_label(row["name"])}"}} {row["errors"]}')
+
+        startup = self.startup_times()
+        if startup:
+            metric = f"{PROMETHEUS_PREFIX}_startup_seconds"
+            lines.append(f"# TYPE {metric} gauge")
+            for name, value in sorted(startup.items()):
+                lines.append(f'{metric}{{name="{_escape_label(name)}"}} {value:.6g}')
+
+        if counters:
+            metric = f"{PROMETHEUS_PREFIX}_events_total"
+            lines.append(f"# TYPE {metric} counter")
+            for name, value in counters.items():
+                lines.append(f'{metric}{{name="{_escape_label(name)}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+class RenderStats:
+    """1回の画面表示で行ったAirtableへの通信回数とデータストアの操作回数"""
+
+    def __init__(self, registry, page):
+        self.registry = registry
+        self.page = page
+        self.api_calls = 0
+        self.backend_calls = 0
+        self.started = time.perf_counter()
+        self.finished = False
+        self._lock = threading.Lock()
+
+    def add(self, api_calls=0, backend_calls=0):
+        with self._lock:
+            self.api_calls += api_calls
+            self.backend_calls += backend_calls
+
+    def finish(self, record_duration=True):
+        """表示の終了を記録する（2回目以降の呼び出しは無視）"""
+        with self._lock:
+            if self.finished:
+                return
+            self.finished = True
+        name = f"render.{self.page}"
+        # st.rerun() などで途中終了した表示は、終了時刻が分からないため回数だけを記録します。
+        if record_duration:
+            duration = time.perf_counter() - self.started
+            self.registry.observe(name, duration)
+            # 画面ごとの最初の表示には、その画面で初めて使うモジュールの読み込みが含まれます。
+            self.registry.record_startup(f"first_render.{self.page}", duration)
+        self.registry.observe(name, self.api_calls, kind=API_CALLS_PER_RENDER)
+        self.registry.observe(name, self.backend_calls, kind=BACKEND_CALLS_PER_RENDER)
+
+
+class InstrumentedBackend:
+    """データストアの操作ごとに処理時間を記録するラッパー（操作名とテーブル名で集計します）"""
+
+    OPERATIONS = (
+        "all", "get", "create", "batch_create", "update", "batch_update",
+        "query_page", "get_many", "all_modified_since",
+    )
+
+    def __init__(self, backend):
+        self.wrapped = backend
+
+    def __getattr__(self, attr):
+        value = getattr(self.wrapped, attr)
+        if attr not in self.OPERATIONS:
+            return value
+
+        @functools.wraps(value)
+        def wrapper(table, *args, **kwargs):
+            count_backend_call()
+            with registry.time(f"backend.{attr}.{table}"):
+                return value(table, *args, **kwargs)
+        return wrapper
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(len(sorted_values) * q), len(sorted_values) - 1)]
+
+
+def _quantile_label(q):
+    return f"p{round(q * 100)}"
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# --- 全セッション共有の記録 ---
+registry = MetricsRegistry()
+
+
+def timed(name):
+    """共有の記録に処理時間を残すデコレータ"""
+    return registry.timed(name)
+
+
+def time_block(name):
+    """共有の記録に with ブロックの処理時間を残す"""
+    return registry.time(name)
+
+
+def observe(name, value, error=False, kind=DURATION):
+    registry.observe(name, value, error=error, kind=kind)
+
+
+def increment(name, amount=1):
+    registry.increment(name, amount)
+
+
+def record_startup(name, seconds):
+    registry.record_startup(name, seconds)
+
+
+def import_module(name):
+    """
+    モジュールを読み込んで返す。まだ読み込まれていなければ、読み込み時間を import.<モジュール名> として記録します
+    （重いライブラリを使う画面のモジュールを、その画面を開いたときだけ読み込むために使います）。
+    """
+    # 読み込み中の別スレッドがあれば完了を待つよう、読み込み済みでも import_module を通します。
+    loaded = name in sys.modules
+    started = time.perf_counter()
+    module = importlib.import_module(name)
+    if not loaded:
+        registry.record_startup(f"import.{name}", time.perf_counter() - started)
+    return module
+
+
+def start_render(page):
+    """画面表示の計測を開始する（このスレッドから行う通信が、この表示の回数として数えられます）"""
+    render = RenderStats(registry, page)
+    _current_render.set(render)
+    return render
+
+
+def count_api_call():
+    """Airtableへの通信を1回数える"""
+    registry.increment("airtable.requests")
+    render = _current_render.get()
+    if render is not None:
+        render.add(api_calls=1)
+
+
+def count_backend_call():
+    """データストアの操作を1回数える"""
+    render = _current_render.get()
+    if render is not None:
+        render.add(backend_calls=1)
+
+
+def start_textfile_export(path, interval=15.0):
+    """
+    記録を一定間隔で Prometheus のテキスト形式のファイルに書き出す
+    （node_exporter の textfile collector などで収集できます）。
+    """
+    global _export_thread
+    with _export_lock:
+        if _export_thread is not None:
+            return
+
+        def run():
+            while True:
+                try:
+                    # 書き込み途中のファイルを読まれないよう、一時ファイルに書いてから置き換えます。
+                    tmp_path = f"{path}.tmp"
+                    with open(tmp_path, "w", encoding="utf-8") as f:
+                        f.write(registry.to_prometheus())
+                    os.replace(tmp_path, path)
+                except OSError:
+                    logger.exception("メトリクスの書き出しに失敗しました: %s", path)
+                time.sleep(interval)
+
+        _export_thread = threading.Thread(target=run, name="metrics-export", daemon=True)
+        _export_thread.start()
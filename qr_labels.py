@@ -0,0 +1,193 @@
+# ==============================================================================
+# qr_labels.py
+# QRコード画像の生成と、ラベル印刷用シート（PDF/PNG）の作成を行います。
+# ==============================================================================
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+
+import qrcode
+import qrcode.image.svg
+import streamlit as st
+from PIL import Image, ImageDraw, ImageFont
+
+import metrics
+
+# --- ラベルシートのレイアウト設定 ---
+# A4用紙（200dpi）に 4列 × 6行 = 24枚のラベルを並べます。
+SHEET_DPI = 200
+SHEET_SIZE = (1654, 2339)  # A4 (210mm × 297mm) @ 200dpi
+SHEET_MARGIN = 80
+LABEL_COLUMNS = 4
+LABEL_ROWS = 6
+LABELS_PER_PAGE = LABEL_COLUMNS * LABEL_ROWS
+CAPTION_HEIGHT = 40
+
+
+def build_qrcode_url(base_url, qrcode_id):
+    """QRコードに埋め込むURLを作成する（base_url に研究室IDなどのパラメータがあれば後ろに付けます）"""
+    separator = "&" if "?" in base_url else "?"
+    return f"{base_url}{separator}qrcode={qrcode_id}"
+
+
+@metrics.timed("qr.make_png")
+def make_qrcode_png(url):
+    """URLからQRコードのPNG画像（バイト列）を作成する"""
+    qr_img = qrcode.make(url)
+    buf = io.BytesIO()
+    qr_img.save(buf, format='PNG')
+    return buf.getvalue()
+
+
+@metrics.timed("qr.make_svg")
+def make_qrcode_svg(url):
+    """URLからQRコードのSVG画像（バイト列）を作成する"""
+    qr_img = qrcode.make(url, image_factory=qrcode.image.svg.SvgPathImage)
+    buf = io.BytesIO()
+    qr_img.save(buf)
+    return buf.getvalue()
+
+
+class QRImageCache:
+    """
+    作成済みのQRコード画像を保存しておくキャッシュ。
+    QRCodeID・ベースURL・形式から作ったハッシュをキーにし、メモリ上では件数上限付きのLRUで保持します。
+    disk_dir を指定すると、メモリから追い出された画像もディスクから読み直せます。
+    """
+
+    def __init__(self, max_items=2048, disk_dir=None):
+        self.max_items = max_items
+        self.disk_dir = disk_dir
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(qrcode_id, base_url, fmt):
+        return hashlib.sha256(f"{fmt}\0{base_url}\0{qrcode_id}".encode("utf-8")).hexdigest()
+
+    def get(self, qrcode_id, base_url, fmt="PNG"):
+        """QRコード画像を返す（キャッシュに無ければ作成して保存する）"""
+        key = self.make_key(qrcode_id, base_url, fmt)
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                metrics.increment("cache.qr_images.hit")
+                return self._items[key]
+
+        data = self._read_disk(key, fmt)
+        if data is not None:
+            metrics.increment("cache.qr_images.disk_hit")
+        else:
+            metrics.increment("cache.qr_images.miss")
+            url = build_qrcode_url(base_url, qrcode_id)
+            data = make_qrcode_svg(url) if fmt == "SVG" else make_qrcode_png(url)
+            self._write_disk(key, fmt, data)
+
+        with self._lock:
+            self._items[key] = data
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return data
+
+    def _disk_path(self, key, fmt):
+        return os.path.join(self.disk_dir, f"{key}.{fmt.lower()}")
+
+    def _read_disk(self, key, fmt):
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._disk_path(key, fmt), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write_disk(self, key, fmt, data):
+        if not self.disk_dir:
+            return
+        # 書き込み途中のファイルを読まないよう、一時ファイルに書いてから置き換えます。
+        path = self._disk_path(key, fmt)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+# 画像キャッシュは st.cache_resource でプロセスに1つだけ作り、全セッションで共有します。
+@st.cache_resource(show_spinner=False)
+def get_image_cache(max_items=2048, disk_dir=None):
+    """共有の画像キャッシュを返す（初回の呼び出し時に作成）"""
+    return QRImageCache(max_items, disk_dir)
+
+
+def _load_caption_font():
+    """ラベル下部の文字に使うフォントを読み込む"""
+    try:
+        return ImageFont.load_default(size=28)
+    except TypeError:  # Pillow 10.1 より前はサイズ指定できない
+        return ImageFont.load_default()
+
+
+def _render_page(qrcode_ids, font, image_loader):
+    """1ページ分のラベル（最大 LABELS_PER_PAGE 枚）を描画する"""
+    page = Image.new("RGB", SHEET_SIZE, "white")
+    draw = ImageDraw.Draw(page)
+    cell_w = (SHEET_SIZE[0] - SHEET_MARGIN * 2) // LABEL_COLUMNS
+    cell_h = (SHEET_SIZE[1] - SHEET_MARGIN * 2) // LABEL_ROWS
+    qr_size = min(cell_w, cell_h - CAPTION_HEIGHT) - 20
+
+    for i, qrcode_id in enumerate(qrcode_ids):
+        col, row = i % LABEL_COLUMNS, i // LABEL_COLUMNS
+        left = SHEET_MARGIN + col * cell_w
+        top = SHEET_MARGIN + row * cell_h
+
+        qr_img = image_loader(qrcode_id).convert("RGB").resize((qr_size, qr_size), Image.NEAREST)
+        page.paste(qr_img, (left + (cell_w - qr_size) // 2, top))
+
+        # QRコードの下にQRCodeIDを印字し、切り取り線として枠を描きます。
+        caption_w = draw.textlength(qrcode_id, font=font)
+        draw.text((left + (cell_w - caption_w) / 2, top + qr_size + 4), qrcode_id, fill="black", font=font)
+        draw.rectangle((left, top, left + cell_w, top + cell_h), outline="#cccccc")
+    return page
+
+
+@metrics.timed("qr.render_label_sheet")
+def render_label_sheet(qrcode_ids, base_url, fmt="PDF", cache=None):
+    """
+    ラベルを印刷用シートにまとめて、ファイルのバイト列を返す。
+    fmt は "PDF"（複数ページ）または "PNG"（1ページ目のみ）。
+    cache（QRImageCache）を渡すと、作成済みのQRコード画像を使い回します。
+    """
+    return render_label_sheets(qrcode_ids, base_url, formats=(fmt,), cache=cache)[fmt]
+
+
+@metrics.timed("qr.render_label_sheets")
+def render_label_sheets(qrcode_ids, base_url, formats=("PDF", "PNG"), cache=None):
+    """
+    ラベルのページを1度だけ描画し、formats の形式ごとのバイト列を {形式: バイト列} で返す。
+    PNGは1ページ目だけなので、PNGだけの場合は1ページ目だけを描画します。
+    """
+    def image_loader(qrcode_id):
+        if cache is not None:
+            return Image.open(io.BytesIO(cache.get(qrcode_id, base_url, "PNG")))
+        return qrcode.make(build_qrcode_url(base_url, qrcode_id)).get_image()
+
+    font = _load_caption_font()
+    last = len(qrcode_ids) if "PDF" in formats else min(len(qrcode_ids), LABELS_PER_PAGE)
+    pages = [
+        _render_page(qrcode_ids[i:i + LABELS_PER_PAGE], font, image_loader)
+        for i in range(0, max(last, 1), LABELS_PER_PAGE)
+    ]
+    sheets = {}
+    for fmt in formats:
+        buf = io.BytesIO()
+        if fmt == "PDF":
+            pages[0].save(buf, format="PDF", resolution=SHEET_DPI, save_all=True, append_images=pages[1:])
+        else:
+            pages[0].save(buf, format="PNG", dpi=(SHEET_DPI, SHEET_DPI))
+        sheets[fmt] = buf.getvalue()
+    return sheets
@@ -0,0 +1,191 @@
+# ==============================================================================
+# scanner.py
+# カメラ映像からQRコードを読み取る処理です。
+# webrtc_streamer の video_frame_callback に QRScanner のインスタンスを渡して使います。
+# ==============================================================================
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+
+import cv2
+import streamlit as st
+
+import metrics
+
+
+def parse_qrcode_payload(data):
+    """読み取ったデータ（URL）から 'qrcode' パラメータを取り出す（無ければNone）"""
+    try:
+        query_params = parse_qs(urlparse(data).query)
+    except Exception:
+        return None  # URL形式でない場合は無視
+    values = query_params.get('qrcode')
+    return values[0] if values else None
+
+
+class DecodePool:
+    """
+    全セッションで共有するQRコード読み取り用のスレッドプール。
+    待ち行列が上限に達している間は新しいフレームを受け付けず、古いフレームが溜まらないようにします。
+    """
+
+    def __init__(self, max_workers=None, max_pending=None):
+        self.max_workers = max_workers or os.cpu_count() or 2
+        self.max_pending = max_pending or self.max_workers * 2
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="qr-decode")
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+    def submit(self, fn, *args):
+        """処理を投入する。待ち行列が一杯ならFalseを返す（そのフレームは捨てる）"""
+        if not self._slots.acquire(blocking=False):
+            return False
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(lambda _: self._slots.release())
+        return True
+
+
+# OpenCVの読み取り処理は実行中にGILを解放するため、スレッドプールでも複数コアを使えます。
+# プールは st.cache_resource でプロセスに1つだけ作り、全セッションで共有します。
+@st.cache_resource(show_spinner=False)
+def get_decode_pool(max_workers=None, max_pending=None):
+    """共有の読み取りプールを返す（初回の呼び出し時に作成）"""
+    return DecodePool(max_workers, max_pending)
+
+
+class QRScanner:
+    """
+    フレームを間引き・縮小してQRコードを読み取る処理クラス。
+    検出器はフレーム間で使い回し、読み取った結果は画面側が pop_result() で受け取るまで保持します。
+    pool（DecodePool）を渡すと読み取りをプールで行い、コールバックはすぐに戻ります。
+    その場合、読み取り中に届いたフレームは最新の1枚だけを残し、それ以外は捨てます。
+    """
+
+    def __init__(self, decode_every_n=3, min_interval=0.0, max_width=640, debounce_seconds=3.0, pool=None):
+        self.decode_every_n = max(int(decode_every_n), 1)  # Nフレームに1回だけ読み取る
+        self.min_interval = float(min_interval)  # 読み取りの最小間隔（秒）
+        self.max_width = int(max_width)  # これより大きいフレームは縮小してから読み取る
+        self.debounce_seconds = float(debounce_seconds)  # 同じコードを再検出しない時間（秒）
+
+        self._detector = cv2.QRCodeDetector()
+        self._lock = threading.Lock()
+        self._frame_count = 0
+        self._last_decode_at = 0.0
+        self._result = None
+        self._last_code = None
+        self._last_code_at = 0.0
+        self._decode_ms = deque(maxlen=200)  # 直近の読み取り時間（ミリ秒）
+        self._decoded_count = 0
+        self._dropped_count = 0
+
+        self.pool = pool
+        self._busy = False  # プールで読み取り中かどうか
+        self._pending = None  # 読み取り中に届いた最新のフレーム
+
+    def __call__(self, frame):
+        """カメラの各フレームで実行される関数（フレームはそのまま返す）"""
+        self._frame_count += 1
+        if self._should_skip():
+            return frame
+
+        self._last_decode_at = time.monotonic()
+        gray = frame.to_ndarray(format="gray")
+        if self.pool is None:
+            self._decode(gray)
+        else:
+            self._submit(gray)
+        return frame
+
+    def _submit(self, gray):
+        """フレームをプールに渡す（このセッションで読み取り中なら、最新の1枚として保留する）"""
+        with self._lock:
+            if self._busy:
+                if self._pending is not None:
+                    self._dropped_count += 1
+                    metrics.increment("scan.dropped_frames")
+                self._pending = gray
+                return
+            self._busy = True
+        if not self.pool.submit(self._decode_loop, gray):
+            with self._lock:
+                self._busy = False
+                self._dropped_count += 1
+            metrics.increment("scan.dropped_frames")
+
+    def _decode_loop(self, gray):
+        """プールのスレッドで実行される。保留中のフレームが無くなるまで読み取りを続ける"""
+        while gray is not None:
+            self._decode(gray)
+            with self._lock:
+                gray, self._pending = self._pending, None
+                if gray is None:
+                    self._busy = False
+
+    def _decode(self, gray):
+        """1フレーム分のQRコードを読み取る"""
+        # 読み取り済みの結果が受け取られる前に届いたフレームは読み取りません。
+        if self._result is not None:
+            return
+        started = time.perf_counter()
+        data, _, _ = self._detector.detectAndDecode(self._preprocess(gray))
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        with self._lock:
+            self._decode_ms.append(elapsed_ms)
+            self._decoded_count += 1
+        metrics.observe("scan.decode", elapsed_ms / 1000)
+        if data:
+            self._accept(parse_qrcode_payload(data))
+
+    def _should_skip(self):
+        """このフレームの読み取りを省略するかどうか"""
+        # 読み取り済みの結果を画面側がまだ受け取っていなければ、読み取りを止めます。
+        if self._result is not None:
+            return True
+        if self._frame_count % self.decode_every_n:
+            return True
+        return time.monotonic() - self._last_decode_at < self.min_interval
+
+    def _preprocess(self, gray):
+        """グレースケール画像を max_width まで縮小する"""
+        height, width = gray.shape[:2]
+        if width > self.max_width:
+            scale = self.max_width / width
+            gray = cv2.resize(gray, (self.max_width, int(height * scale)), interpolation=cv2.INTER_AREA)
+        return gray
+
+    def _accept(self, code):
+        """読み取ったコードを結果として保存する（直前と同じコードは一定時間無視）"""
+        if not code:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if code == self._last_code and now - self._last_code_at < self.debounce_seconds:
+                return
+            self._last_code = code
+            self._last_code_at = now
+            self._result = code
+
+    def pop_result(self):
+        """読み取った結果を取り出す（無ければNone）。取り出すと次の読み取りが再開されます。"""
+        with self._lock:
+            result, self._result = self._result, None
+            return result
+
+    def stats(self):
+        """読み取り時間などの統計（チューニング用）"""
+        with self._lock:
+            last_ms = self._decode_ms[-1] if self._decode_ms else None
+            timings = sorted(self._decode_ms)
+            decoded = self._decoded_count
+            dropped = self._dropped_count
+        return {
+            "frames": self._frame_count,
+            "decoded_frames": decoded,
+            "dropped_frames": dropped,
+            "last_ms": last_ms,
+            "avg_ms": sum(timings) / len(timings) if timings else None,
+            "p95_ms": timings[min(int(len(timings) * 0.95), len(timings) - 1)] if timings else None,
+        }
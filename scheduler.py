@@ -0,0 +1,228 @@
+# ==============================================================================
+# scheduler.py
+# Airtableへのリクエストをすべて通す窓口です。
+#   - 接続の使い回し（Keep-Alive）ができるよう、HTTP接続プールの大きさを調整します。
+#   - Airtableの上限（1ベースあたり毎秒5リクエスト）を超えないよう、トークンバケットで送信間隔を調整します。
+#   - 429（レート制限）や5xxのエラーは、待ち時間を倍々に延ばしながら再試行します。
+#   - 同じ内容の読み取りが同時に複数あれば、1回だけ送って結果を共有します。
+#   - fail_fast() の中のリクエストは再試行せず、短い時間で打ち切ります（画面表示の前の確認用）。
+# ==============================================================================
+import contextlib
+import contextvars
+import copy
+import json
+import logging
+import random
+import threading
+import time
+
+import requests
+from pyairtable import Api
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 再試行するHTTPステータス
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# fail_fast() で設定した打ち切りまでの秒数（Noneなら通常どおり再試行します）
+_fail_fast_timeout = contextvars.ContextVar("fail_fast_timeout", default=None)
+
+
+@contextlib.contextmanager
+def fail_fast(timeout):
+    """
+    with 文の中のリクエストを、再試行せず timeout 秒で打ち切る（送信枠が timeout 秒以内に空かなければ送りません）。
+    つながらないときに代わりの値を使える読み取りで、Airtableの遅れを画面に持ち込まないために使います。
+    """
+    token = _fail_fast_timeout.set(timeout)
+    try:
+        yield
+    finally:
+        _fail_fast_timeout.reset(token)
+
+
+class TokenBucket:
+    """一定の速度でトークンが補充されるバケット。acquire() はトークンが取れるまで待つ"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)  # 1秒あたりの補充数
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+        """トークンを1つ取る。timeout 秒以内に取れない場合は待たずにFalseを返す"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class _InFlight:
+    """実行中の読み取り（同じリクエストを待つ呼び出し元と結果を共有する）"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class RequestScheduler:
+    """レート制限・再試行・同一読み取りのまとめ（coalescing）を行う"""
+
+    def __init__(self, rate=5.0, burst=None, max_retries=5, backoff_base=0.5, backoff_max=30.0):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        # 統計（送信回数・再試行回数・まとめられた読み取りの回数）
+        self.stats = {"requests": 0, "retries": 0, "coalesced": 0}
+
+    def execute(self, send, read_key=None, retry_on_server_error=True):
+        """
+        send() を実行して結果を返す。
+        read_key を渡すと、同じキーの読み取りが実行中ならその結果を待って共有します。
+        retry_on_server_error=False のときは、429（未処理が保証される）以外は再試行しません。
+        """
+        # fail_fast() の中では、再試行中かもしれない他の読み取りの結果を待たずに送ります。
+        if read_key is None or _fail_fast_timeout.get() is not None:
+            return self._send_with_retry(send, retry_on_server_error)
+
+        with self._lock:
+            in_flight = self._in_flight.get(read_key)
+            leader = in_flight is None
+            if leader:
+                in_flight = self._in_flight[read_key] = _InFlight()
+            else:
+                self.stats["coalesced"] += 1
+                metrics.increment("airtable.coalesced")
+
+        if not leader:
+            in_flight.done.wait()
+            if in_flight.error:
+                raise in_flight.error
+            # 呼び出し元が結果を書き換えても影響しないよう、コピーを返します。
+            return copy.deepcopy(in_flight.result)
+
+        try:
+            in_flight.result = self._send_with_retry(send, retry_on_server_error)
+            return copy.deepcopy(in_flight.result)
+        except Exception as e:
+            in_flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[read_key]
+            in_flight.done.set()
+
+    def _send_with_retry(self, send, retry_on_server_error):
+        fail_fast_timeout = _fail_fast_timeout.get()
+        max_retries = 0 if fail_fast_timeout is not None else self.max_retries
+        attempt = 0
+        while True:
+            waited_from = time.perf_counter()
+            if not self.bucket.acquire(timeout=fail_fast_timeout):
+                raise requests.exceptions.Timeout("Airtableの送信枠が空くのを待てませんでした")
+            # 送信枠の待ち時間（レート制限に引っかかっているかの目安）
+            metrics.observe("airtable.rate_limit_wait", time.perf_counter() - waited_from)
+            with self._lock:
+                self.stats["requests"] += 1
+            metrics.count_api_call()
+            started = time.perf_counter()
+            try:
+                result = send()
+            except requests.exceptions.HTTPError as e:
+                metrics.observe("airtable.request", time.perf_counter() - started, error=True)
+                response = e.response
+                status = response.status_code if response is not None else None
+                retryable = status == 429 or (retry_on_server_error and status in RETRY_STATUSES)
+                if not retryable or attempt >= max_retries:
+                    raise
+                delay = self._backoff(attempt, response)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                metrics.observe("airtable.request", time.perf_counter() - started, error=True)
+                if not retry_on_server_error or attempt >= max_retries:
+                    raise
+                delay = self._backoff(attempt, None)
+            else:
+                metrics.observe("airtable.request", time.perf_counter() - started)
+                return result
+            attempt += 1
+            with self._lock:
+                self.stats["retries"] += 1
+            metrics.increment("airtable.retries")
+            logger.warning("Airtableへのリクエストを %.1f 秒後に再試行します（%d回目）", delay, attempt)
+            time.sleep(delay)
+
+    def _backoff(self, attempt, response):
+        """再試行までの待ち時間（Retry-Afterがあればそれに従う）"""
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        delay = min(self.backoff_base * 2 ** attempt, self.backoff_max)
+        # 複数のスレッドが同時に再試行しないよう、待ち時間をばらつかせます。
+        return delay * random.uniform(0.5, 1.0)
+
+
+class _PooledSession(requests.Session):
+    """接続プールの大きさとタイムアウトの既定値を設定したセッション"""
+
+    def __init__(self, pool_size, timeout):
+        super().__init__()
+        self.default_timeout = timeout
+        # 再試行は RequestScheduler が行うため、ここでは再試行しません。
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", _fail_fast_timeout.get() or self.default_timeout)
+        return super().request(method, url, **kwargs)
+
+
+class ScheduledApi(Api):
+    """すべてのリクエストを RequestScheduler 経由で送る pyairtable の Api"""
+
+    def __init__(self, api_key, scheduler=None, pool_size=10, timeout=(5, 30), **kwargs):
+        super().__init__(api_key, retry_strategy=None, timeout=timeout, **kwargs)
+        # pyairtable は api_key の設定時にセッションへ認証ヘッダーを付けるため、
+        # セッションを差し替えたあとで設定し直します（付け忘れるとすべて401になります）。
+        self.session = _PooledSession(pool_size, timeout)
+        self.api_key = api_key
+        self.scheduler = scheduler or RequestScheduler()
+
+    def request(self, method, url, fallback=None, options=None, params=None, json=None):
+        send = lambda: super(ScheduledApi, self).request(
+            method, url, fallback=fallback, options=options, params=params, json=json
+        )
+        # 読み取り（GETと、URLが長すぎる場合のPOST版のlistRecords）だけをまとめ対象にします。
+        is_read = method.upper() == "GET" or str(url).endswith("/listRecords")
+        if is_read:
+            # fallback 先のPOSTは、元のGETの処理中に呼ばれるため、まとめずにそのまま送ります。
+            read_key = _request_key(method, url, options, params, json) if method.upper() == "GET" else None
+            return self.scheduler.execute(send, read_key=read_key)
+        # 作成（POST）は5xxで再試行すると二重登録になる恐れがあるため、429のみ再試行します。
+        return self.scheduler.execute(send, retry_on_server_error=method.upper() != "POST")
+
+
+def _request_key(method, url, options, params, json_body):
+    """同じリクエストかどうかを判定するためのキー"""
+    return json.dumps([method.upper(), str(url), options, params, json_body], sort_keys=True, default=str)
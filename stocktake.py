@@ -0,0 +1,153 @@
+# ==============================================================================
+# stocktake.py
+# 在庫の一括更新（入荷・棚卸し）用ファイルの読み書きと、現在の在庫との突き合わせを行います。
+#   - アップロードされたCSV/Excelからは、商品タグと数量の列だけを読み込みます。
+#   - 現在の在庫との差分は全商品分をまとめて pandas で計算し、在庫数が変わる行だけを反映対象にします。
+#   - 突き合わせの結果は、そのまま記録用のレポートとしてダウンロードできます。
+# ==============================================================================
+import io
+
+import numpy as np
+import pandas as pd
+
+# 一括更新の種類
+MODE_SET = "set"  # 棚卸し: 数えた数で在庫数を置き換える
+MODE_ADD = "add"  # 入荷: 在庫数に数量を足す（マイナスで減らす）
+
+TAG_COLUMN = "ProductTag"
+QUANTITY_COLUMN = "Quantity"
+# CSVは一度に全体を読まず、この行数ずつ読み込みます。
+CSV_CHUNK_ROWS = 1000
+
+# 突き合わせの結果
+RESULT_CHANGED = "変更あり"
+RESULT_UNCHANGED = "変更なし"
+RESULT_BLANK = "数量が未入力"
+RESULT_INVALID = "数量が正しくありません"
+RESULT_UNKNOWN = "商品タグが見つかりません"
+RESULT_DUPLICATE = "商品タグが重複しています"
+RESULT_NOT_LISTED = "ファイルにありません"  # 棚卸しで数えていない商品
+
+# レポートの列名（ファイル・画面共通）
+REPORT_COLUMNS = {
+    "Row": "行",
+    TAG_COLUMN: "商品タグ",
+    "ProductName": "品目名",
+    "CurrentStock": "現在庫数",
+    QUANTITY_COLUMN: "数量",
+    "NewStock": "反映後の在庫数",
+    "Difference": "差",
+    "Result": "結果",
+}
+
+
+def make_template(products):
+    """
+    現在の在庫一覧を、一括更新用の DataFrame として返す（Quantity 列に数量を入力してアップロードします）。
+    products は get_all_products の戻り値です。
+    """
+    df = pd.DataFrame(products, columns=[TAG_COLUMN, "ProductName", "Unit", "CurrentStock"])
+    df[QUANTITY_COLUMN] = None
+    return df
+
+
+def read_upload(file, filename):
+    """
+    アップロードされたCSV/Excelから、商品タグと数量の列だけを文字列のまま読み込む。
+    必要な列が無い場合は ValueError を送出します。
+    """
+    wanted = (TAG_COLUMN, QUANTITY_COLUMN)
+    if filename.lower().endswith((".xlsx", ".xlsm")):
+        df = pd.read_excel(file, usecols=lambda c: c in wanted, dtype=str)
+    else:
+        df = _read_csv(file, wanted)
+    missing = [c for c in wanted if c not in df.columns]
+    if missing:
+        raise ValueError(f"ファイルに {', '.join(missing)} 列がありません。")
+    return df[list(wanted)]
+
+
+def _read_csv(file, wanted):
+    # Excelで保存したCSVは Shift_JIS（cp932）の場合があるため、UTF-8で読めなければ読み直します。
+    for encoding in ("utf-8-sig", "cp932"):
+        file.seek(0)
+        try:
+            chunks = pd.read_csv(
+                file, usecols=lambda c: c in wanted, dtype=str, encoding=encoding, chunksize=CSV_CHUNK_ROWS
+            )
+            return pd.concat(chunks, ignore_index=True)
+        except UnicodeDecodeError:
+            continue
+    raise ValueError("ファイルの文字コードを判別できませんでした（UTF-8 または Shift_JIS で保存してください）。")
+
+
+def reconcile(products, counts, mode=MODE_SET):
+    """
+    商品一覧（{'id', 'fields'} のリスト）とアップロードされた数量を突き合わせ、
+    行ごとの現在庫数・反映後の在庫数・結果の DataFrame を返す（RecordID 列は反映用で、レポートには出しません）。
+    棚卸し（MODE_SET）では、ファイルに無い商品も「ファイルにありません」として含めます。
+    """
+    current = pd.DataFrame({
+        "RecordID": [p['id'] for p in products],
+        TAG_COLUMN: [p['fields'].get('ProductTag') for p in products],
+        "ProductName": [p['fields'].get('ProductName') for p in products],
+        "CurrentStock": [p['fields'].get('CurrentStock') for p in products],
+    })
+    current["CurrentStock"] = pd.to_numeric(current["CurrentStock"], errors="coerce").fillna(0)
+
+    upload = counts.copy()
+    upload["Row"] = upload.index + 2  # ファイル上の行番号（1行目は見出し）
+    upload[TAG_COLUMN] = upload[TAG_COLUMN].fillna("").str.strip()
+    upload[QUANTITY_COLUMN] = upload[QUANTITY_COLUMN].fillna("").str.strip()
+    upload = upload[upload[TAG_COLUMN] != ""]  # 商品タグが空の行（空行など）は読み飛ばします。
+
+    df = current.merge(upload, on=TAG_COLUMN, how="outer" if mode == MODE_SET else "right", indicator=True)
+    stock = df["CurrentStock"].to_numpy()
+    quantity = pd.to_numeric(df[QUANTITY_COLUMN], errors="coerce").to_numpy()
+    new_stock = quantity if mode == MODE_SET else stock + quantity
+
+    with np.errstate(invalid="ignore"):
+        valid = (quantity == np.round(quantity)) & (new_stock >= 0)
+    df["Result"] = np.select(
+        [
+            (df["_merge"] == "left_only").to_numpy(),
+            (df["_merge"] == "right_only").to_numpy(),
+            df[TAG_COLUMN].duplicated(keep=False).to_numpy() & df["Row"].notna().to_numpy(),
+            (df[QUANTITY_COLUMN] == "").to_numpy(),
+            ~valid,
+            new_stock == stock,
+        ],
+        [RESULT_NOT_LISTED, RESULT_UNKNOWN, RESULT_DUPLICATE, RESULT_BLANK, RESULT_INVALID, RESULT_UNCHANGED],
+        default=RESULT_CHANGED,
+    )
+    applicable = df["Result"].isin([RESULT_CHANGED, RESULT_UNCHANGED]).to_numpy()
+    df["NewStock"] = pd.array(np.where(applicable, new_stock, np.nan)).astype("Int64")
+    df["Difference"] = df["NewStock"] - df["CurrentStock"].astype("Int64")
+    df["CurrentStock"] = df["CurrentStock"].astype("Int64")
+    df["Row"] = df["Row"].astype("Int64")
+
+    df = df.sort_values("Row", na_position="last", kind="stable").reset_index(drop=True)
+    return df[["Row", TAG_COLUMN, "ProductName", "RecordID", "CurrentStock", QUANTITY_COLUMN, "NewStock", "Difference", "Result"]]
+
+
+def changed_rows(report):
+    """突き合わせの結果から、在庫数が変わる行だけを返す"""
+    return report[report["Result"] == RESULT_CHANGED]
+
+
+def to_report(report):
+    """突き合わせの結果を、列名を日本語にした表示・ダウンロード用の DataFrame にする"""
+    columns = [c for c in REPORT_COLUMNS if c in report.columns] + [c for c in ("Applied", "Error") if c in report.columns]
+    return report[columns].rename(columns={**REPORT_COLUMNS, "Applied": "反映", "Error": "エラー"})
+
+
+def to_csv_bytes(df):
+    """DataFrame をBOM付きUTF-8のCSVにする（Excelで開いても文字化けしません）"""
+    return df.to_csv(index=False).encode("utf-8-sig")
+
+
+def to_excel_bytes(df):
+    """DataFrame をExcelファイル（.xlsx）にする"""
+    buffer = io.BytesIO()
+    df.to_excel(buffer, index=False)
+    return buffer.getvalue()
@@ -0,0 +1,273 @@
+# ==============================================================================
+# sync.py
+# ローカルのSQLiteとAirtableを同期します（DATABASE_BACKEND = "mirror" のとき使用）。
+#   - 読み取りはローカルから行い、画面の表示でネットワーク通信が発生しないようにします。
+#   - 書き込みはローカルに反映したうえで送信待ち（outbox）に積み、バックグラウンドでAirtableへ送ります。
+#   - Airtableで変更されたレコードだけを定期的に取り込みます（LAST_MODIFIED_TIME() による差分同期）。
+# ==============================================================================
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from backends import BATCH_SIZE, TABLE_NAMES
+
+logger = logging.getLogger(__name__)
+
+# 差分ではなく加算として送るフィールド（他の端末の更新を上書きしないため）
+COUNTER_FIELDS = {
+    "Products": ("CurrentStock", "LatestQRCodeNum"),
+}
+
+# 差分取得の時刻のずれを吸収するため、前回の取得時刻から少し遡って問い合わせます。
+PULL_OVERLAP = timedelta(seconds=10)
+# 削除されたレコードを反映するため、一定間隔で全件を取り込み直します。
+FULL_RESYNC_INTERVAL = 24 * 60 * 60  # 秒
+# 送信に失敗した場合の再試行間隔（指数バックオフ）
+RETRY_BASE_DELAY = 2.0  # 秒
+RETRY_MAX_DELAY = 300.0  # 秒
+
+
+class MirrorBackend:
+    """ローカルのSQLiteを読み書きし、変更をAirtableへ非同期に送るバックエンド"""
+
+    name = "mirror"
+
+    def __init__(self, local, remote):
+        self.local = local
+        self.remote = remote
+        # 送信待ちが積まれたときに呼ばれる関数（SyncEngine.wakeup を設定します）
+        self.on_enqueue = None
+        with local.transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS _outbox ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, tbl TEXT NOT NULL, record_id TEXT NOT NULL, "
+                "op TEXT NOT NULL, field TEXT NOT NULL, value TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, next_attempt_at REAL NOT NULL DEFAULT 0)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_record ON _outbox (tbl, record_id)")
+
+    def all(self, table, filters=None):
+        return self.local.all(table, filters)
+
+    def get(self, table, record_id):
+        return self.local.get(table, record_id)
+
+    def get_many(self, table, record_ids):
+        return self.local.get_many(table, record_ids)
+
+    def query_page(self, table, conditions=(), sort_field=None, descending=False, page_size=50, cursor=None):
+        return self.local.query_page(table, conditions, sort_field, descending, page_size, cursor)
+
+    def create(self, table, fields):
+        return self.batch_create(table, [fields])[0]
+
+    def batch_create(self, table, fields_list):
+        """レコードの作成はAirtableのレコードIDが必要なため、Airtableへ直接送ってからローカルに保存する"""
+        records = self.remote.batch_create(table, fields_list)
+        self.local.upsert_records(table, records)
+        return records
+
+    def update(self, table, record_id, fields):
+        return self.batch_update(table, [{'id': record_id, 'fields': fields}])[0]
+
+    def batch_update(self, table, records):
+        """ローカルを更新し、同じトランザクションで送信待ちに積む"""
+        updated = self.local.batch_update(table, records, journal=self._enqueue)
+        if self.on_enqueue:
+            self.on_enqueue()
+        return updated
+
+    @staticmethod
+    def _enqueue(conn, table, record_id, old_fields, changed_fields):
+        """変更内容を送信待ちに追加する（カウンタ項目は増減量として記録）"""
+        rows = []
+        for field, value in changed_fields.items():
+            if field in COUNTER_FIELDS.get(table, ()):
+                delta = (value or 0) - (old_fields.get(field) or 0)
+                if delta:
+                    rows.append((table, record_id, "add", field, json.dumps(delta)))
+            else:
+                rows.append((table, record_id, "set", field, json.dumps(value, ensure_ascii=False)))
+        conn.executemany(
+            "INSERT INTO _outbox (tbl, record_id, op, field, value) VALUES (?, ?, ?, ?, ?)", rows
+        )
+
+    def pending_count(self):
+        """まだAirtableへ送っていない変更の件数を返す"""
+        with self.local.transaction() as conn:
+            return conn.execute("SELECT COUNT(*) FROM _outbox").fetchone()[0]
+
+
+class SyncEngine:
+    """送信待ちの書き込みと差分の取り込みをバックグラウンドで繰り返す"""
+
+    def __init__(self, mirror, interval=30.0, batch_size=100, on_change=None):
+        self.mirror = mirror
+        self.local = mirror.local
+        self.remote = mirror.remote
+        self.interval = interval
+        self.batch_size = batch_size
+        # 取り込みでテーブルが変わったときに呼ばれる関数（キャッシュの破棄などに使います）
+        self.on_change = on_change
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        with self.local.transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS _sync_state ("
+                "tbl TEXT PRIMARY KEY, last_pulled_at TEXT, last_full_at REAL NOT NULL DEFAULT 0)"
+            )
+        mirror.on_enqueue = self.wakeup
+
+    # --- スレッドの制御 ---
+    def start(self):
+        """バックグラウンドの同期スレッドを開始する"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="airtable-sync", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+
+    def wakeup(self):
+        """次の周期を待たずに同期を実行させる"""
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sync_once()
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def sync_once(self):
+        """送信 → 取り込みを1回ずつ実行する"""
+        try:
+            self.push_outbox()
+        except Exception:
+            logger.exception("Airtableへの送信に失敗しました")
+        try:
+            self.pull_changes()
+        except Exception:
+            logger.exception("Airtableからの取り込みに失敗しました")
+
+    # --- 送信（ローカル → Airtable） ---
+    def push_outbox(self):
+        """送信待ちの変更をテーブルごとにまとめてAirtableへ送る"""
+        with self.local.transaction() as conn:
+            rows = conn.execute(
+                "SELECT seq, tbl, record_id, op, field, value, attempts FROM _outbox "
+                "WHERE next_attempt_at <= ? ORDER BY seq LIMIT ?",
+                (time.time(), self.batch_size),
+            ).fetchall()
+
+        by_table = defaultdict(list)
+        for row in rows:
+            by_table[row[1]].append(row)
+        for table, table_rows in by_table.items():
+            try:
+                self._push_table(table, table_rows)
+            except Exception:
+                logger.exception("%s の送信に失敗しました（%d件）", table, len(table_rows))
+                self._schedule_retry(table_rows)
+
+    def _push_table(self, table, rows):
+        # レコードごとに変更をまとめます（setは後勝ち、addは合計）。
+        sets, adds = defaultdict(dict), defaultdict(lambda: defaultdict(int))
+        seqs = defaultdict(list)
+        for seq, _, record_id, op, field, value, _ in rows:
+            seqs[record_id].append(seq)
+            if op == "add":
+                adds[record_id][field] += json.loads(value)
+            else:
+                sets[record_id][field] = json.loads(value)
+
+        # 送れた分の送信待ちはその場で消すため、途中で失敗して再送しても加算は1回だけ反映されます。
+        record_ids = list(seqs)
+        try:
+            for start in range(0, len(record_ids), BATCH_SIZE):
+                self._push_chunk(table, record_ids[start:start + BATCH_SIZE], sets, adds, seqs)
+        finally:
+            if self.on_change:
+                self.on_change(table)
+
+    def _push_chunk(self, table, record_ids, sets, adds, seqs):
+        # 加算する項目は、Airtable上の最新値に増減量を足して送ります。
+        remote_fields = {}
+        add_ids = [record_id for record_id in record_ids if record_id in adds]
+        if add_ids:
+            remote_fields = {r['id']: r['fields'] for r in self.remote.get_many(table, add_ids)}
+        updates = []
+        for record_id in record_ids:
+            fields = dict(sets.get(record_id, {}))
+            for field, delta in adds.get(record_id, {}).items():
+                fields[field] = (remote_fields.get(record_id, {}).get(field) or 0) + delta
+            updates.append({'id': record_id, 'fields': fields})
+
+        pushed = self.remote.batch_update(table, updates)
+
+        with self.local.transaction() as conn:
+            conn.executemany(
+                "DELETE FROM _outbox WHERE seq = ?", [(seq,) for r in pushed for seq in seqs.get(r['id'], ())]
+            )
+            still_pending = {
+                r[0] for r in conn.execute("SELECT DISTINCT record_id FROM _outbox WHERE tbl = ?", (table,))
+            }
+        # 送信中に新しい変更が積まれたレコードは、ローカルの値を優先します。
+        self.local.upsert_records(table, [r for r in pushed if r['id'] not in still_pending])
+
+    def _schedule_retry(self, rows):
+        now = time.time()
+        with self.local.transaction() as conn:
+            conn.executemany(
+                "UPDATE _outbox SET attempts = ?, next_attempt_at = ? WHERE seq = ?",
+                [
+                    (row[6] + 1, now + min(RETRY_BASE_DELAY * 2 ** row[6], RETRY_MAX_DELAY), row[0])
+                    for row in rows
+                ],
+            )
+
+    # --- 取り込み（Airtable → ローカル） ---
+    def pull_changes(self):
+        """前回以降にAirtableで変更されたレコードをローカルに取り込む"""
+        for table in TABLE_NAMES:
+            with self.local.transaction() as conn:
+                state = conn.execute(
+                    "SELECT last_pulled_at, last_full_at FROM _sync_state WHERE tbl = ?", (table,)
+                ).fetchone()
+                pending = {
+                    r[0] for r in conn.execute("SELECT DISTINCT record_id FROM _outbox WHERE tbl = ?", (table,))
+                }
+            last_pulled_at, last_full_at = state if state else (None, 0.0)
+
+            started_at = datetime.now(timezone.utc)
+            full = last_pulled_at is None or time.time() - last_full_at > FULL_RESYNC_INTERVAL
+            if full:
+                records = self.remote.all(table)
+            else:
+                since = datetime.fromisoformat(last_pulled_at) - PULL_OVERLAP
+                records = self.remote.all_modified_since(table, since.strftime("%Y-%m-%dT%H:%M:%S.000Z"))
+
+            # 送信待ちのあるレコードは、送信後に取り込み直すまでローカルの値を残します。
+            self.local.upsert_records(table, [r for r in records if r['id'] not in pending])
+            if full:
+                removed = self.local.record_ids(table) - {r['id'] for r in records} - pending
+                if removed:
+                    self.local.delete_records(table, removed)
+
+            with self.local.transaction() as conn:
+                conn.execute(
+                    "INSERT INTO _sync_state (tbl, last_pulled_at, last_full_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(tbl) DO UPDATE SET last_pulled_at = excluded.last_pulled_at, "
+                    "last_full_at = excluded.last_full_at",
+                    (table, started_at.isoformat(), time.time() if full else last_full_at),
+                )
+            if records and self.on_change:
+                self.on_change(table)
@@ -0,0 +1,103 @@
+# ==============================================================================
+# tenants.py
+# 1つのアプリで複数の研究室（テナント）を扱うための、研究室の一覧と「現在の研究室」です。
+#   - 研究室ごとの設定は Secrets の [tenants.<研究室ID>] に書きます。書いていない項目は全体の設定を使います。
+#       [tenants.lab_a]
+#       name = "A研究室"
+#       AIRTABLE_BASE_ID = "appXXXXXXXXXXXXXX"
+#   - [tenants] が無い場合は、従来どおり全体の設定だけを使う1つの研究室（"default"）として動きます。
+#   - 現在の研究室は contextvars で保持します（app.py が再実行のたびにセッションの研究室を設定します）。
+#     database.fetch_concurrently のスレッドにも引き継がれます。
+# ==============================================================================
+import contextvars
+import os
+import threading
+
+import streamlit as st
+
+DEFAULT_TENANT = "default"
+
+# 研究室ごとに別のファイルにする設定（研究室の設定に無ければ、全体の設定のファイル名に研究室IDを付けます）
+PATH_SETTINGS = ("SQLITE_PATH", "WRITE_QUEUE_PATH")
+
+_current = contextvars.ContextVar("tenant", default=None)
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_setting(key, default=None):
+    """設定値を環境変数 → Secrets の順に探して返す"""
+    value = os.environ.get(key)
+    if value is not None:
+        return value
+    try:
+        return st.secrets.get(key, default)
+    except Exception:  # secrets.toml が存在しない場合など
+        return default
+
+
+class Tenant:
+    """1つの研究室の設定"""
+
+    def __init__(self, tenant_id, settings=None):
+        self.id = tenant_id
+        self.settings = dict(settings or {})
+        self.name = self.settings.get("name", tenant_id)
+
+    def setting(self, key, default=None):
+        """研究室の設定 → 全体の設定の順に探して返す"""
+        if key in self.settings:
+            return self.settings[key]
+        value = get_setting(key, default)
+        if key in PATH_SETTINGS and value and self.id != DEFAULT_TENANT:
+            # 全体の設定のファイルを複数の研究室で共有しないよう、研究室IDを付けたファイル名にします。
+            root, ext = os.path.splitext(value)
+            value = f"{root}_{self.id}{ext}"
+        return value
+
+    def __repr__(self):
+        return f"Tenant({self.id!r})"
+
+
+def registry():
+    """研究室ID → Tenant の一覧（Secrets から1度だけ読み込みます）"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            try:
+                configured = st.secrets.get("tenants") or {}
+            except Exception:  # secrets.toml が存在しない場合など
+                configured = {}
+            _registry = {
+                tenant_id: Tenant(tenant_id, settings) for tenant_id, settings in configured.items()
+            } or {DEFAULT_TENANT: Tenant(DEFAULT_TENANT)}
+        return _registry
+
+
+def is_multi_tenant():
+    """複数の研究室が設定されているか（画面で研究室を選ばせるかどうかの判定に使います）"""
+    return len(registry()) > 1
+
+
+def get(tenant_id):
+    """研究室IDの Tenant を返す（登録されていなければNone）"""
+    return registry().get(tenant_id)
+
+
+def default():
+    """研究室が選ばれていないときの研究室（DEFAULT_TENANT の設定、無ければ最初に書かれた研究室）"""
+    tenants = registry()
+    return tenants.get(get_setting("DEFAULT_TENANT")) or next(iter(tenants.values()))
+
+
+def activate(tenant_id):
+    """現在の研究室を設定して返す（登録されていないIDの場合は既定の研究室にします）"""
+    tenant = get(tenant_id) or default()
+    _current.set(tenant)
+    return tenant
+
+
+def current():
+    """現在の研究室"""
+    return _current.get() or default()
@@ -0,0 +1,9 @@
+# ==============================================================================
+# tests/conftest.py
+# テストからリポジトリのルートのモジュール（backends.py など）を読み込めるようにします。
+# 実行方法（リポジトリのルートで）: python -m pytest -q
+# ==============================================================================
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,118 @@
+# ==============================================================================
+# tests/test_analytics.py
+# 使用ペースの集計（analytics.ConsumptionTracker）と在庫切れの予測（analytics.forecast）のテストです。
+# ==============================================================================
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+import analytics
+from analytics import SECONDS_PER_DAY, ConsumptionTracker
+
+NOW = 1_700_000_000.0
+
+
+def iso(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def test_record_adds_one_over_tau_and_decays_exponentially():
+    tracker = ConsumptionTracker(windows_days=(1.0, 10.0))
+    tracker.record("TIP", at=NOW)
+    tracker.record("TIP", at=NOW, count=2)
+    np.testing.assert_allclose(tracker.rates(["TIP"], now=NOW)[0], [3 / 1.0, 3 / 10.0])
+    # 1日後には exp(-1日 / τ) 倍に減衰します。
+    later = NOW + SECONDS_PER_DAY
+    np.testing.assert_allclose(tracker.rates(["TIP"], now=later)[0], [3 * np.exp(-1.0), 0.3 * np.exp(-0.1)])
+
+
+def test_record_decays_previous_rate_before_adding():
+    tracker = ConsumptionTracker(windows_days=(2.0,))
+    tracker.record("TIP", at=NOW)
+    tracker.record("TIP", at=NOW + SECONDS_PER_DAY)
+    expected = np.exp(-0.5) / 2.0 + 1 / 2.0
+    np.testing.assert_allclose(tracker.rates(["TIP"], now=NOW + SECONDS_PER_DAY)[0], [expected])
+
+
+def test_unknown_tags_have_zero_rate():
+    tracker = ConsumptionTracker()
+    tracker.record("TIP", at=NOW)
+    rates = tracker.rates(["GLV", "TIP"], now=NOW)
+    assert rates[0].tolist() == [0.0, 0.0]
+    assert (rates[1] > 0).all()
+
+
+def test_load_matches_recording_each_event():
+    used_at = [NOW - 3 * SECONDS_PER_DAY, NOW - SECONDS_PER_DAY, NOW]
+    loaded = ConsumptionTracker()
+    loaded.load(["TIP"] * 3, [iso(t) for t in used_at], now=NOW)
+    recorded = ConsumptionTracker()
+    for t in used_at:
+        recorded.record("TIP", at=t)
+    np.testing.assert_allclose(loaded.rates(["TIP"], now=NOW), recorded.rates(["TIP"], now=NOW))
+
+
+def test_merge_in_batches_matches_full_load():
+    tags = ["TIP", "GLV", "TIP", "TIP", "GLV"]
+    used_at = [iso(NOW - d * SECONDS_PER_DAY) for d in (20, 10, 5, 1, 0.5)]
+    full = ConsumptionTracker()
+    full.load(tags, used_at, now=NOW)
+
+    incremental = ConsumptionTracker()
+    incremental.merge(tags[:2], used_at[:2], now=NOW - 8 * SECONDS_PER_DAY)
+    incremental.merge(tags[2:], used_at[2:], now=NOW)
+    np.testing.assert_allclose(incremental.rates(["TIP", "GLV"], now=NOW), full.rates(["TIP", "GLV"], now=NOW))
+
+
+def test_merge_keeps_recorded_usage_and_skips_bad_dates():
+    tracker = ConsumptionTracker(windows_days=(7.0,))
+    tracker.record("TIP", at=NOW)
+    tracker.merge(["GLV", "GLV"], [iso(NOW), "not a date"], now=NOW)
+    np.testing.assert_allclose(tracker.rates(["TIP", "GLV"], now=NOW), [[1 / 7.0], [1 / 7.0]])
+
+
+def test_load_discards_previous_state():
+    tracker = ConsumptionTracker()
+    tracker.record("GLV", at=NOW)
+    tracker.load(["TIP"], [iso(NOW)], now=NOW)
+    assert tracker.rates(["GLV"], now=NOW)[0].tolist() == [0.0, 0.0]
+
+
+def test_forecast_uses_the_faster_window_and_flags_stock():
+    tracker = ConsumptionTracker(windows_days=(1.0, 10.0))
+    tracker.record("TIP", at=NOW, count=2)  # 1日あたり 2.0（短い期間）と 0.2（長い期間）
+    tracker.record("BUF", at=NOW, count=2)
+    products = [
+        {"ProductTag": "TIP", "CurrentStock": 100},
+        {"ProductTag": "BUF", "CurrentStock": 3},
+        {"ProductTag": "GLV", "CurrentStock": 0},
+        {"ProductTag": "PEN", "CurrentStock": 5},
+    ]
+    df = analytics.forecast(products, tracker, lead_time_days=2.0, now=NOW).set_index("ProductTag")
+
+    assert df.loc["TIP", "DailyRate"] == pytest.approx(2.0)
+    assert df.loc["TIP", "DaysToStockout"] == pytest.approx(50.0)
+    # 発注点 = ceil(2.0 × 2日 + 1.65 × √4)
+    assert df.loc["TIP", "ReorderPoint"] == 8
+    assert df.loc["TIP", "Status"] == analytics.STATUS_OK
+    assert df.loc["BUF", "Status"] == analytics.STATUS_REORDER
+    assert df.loc["GLV", "Status"] == analytics.STATUS_OUT
+    # 使用実績の無い商品は、在庫切れまでの日数を空欄にします。
+    assert np.isnan(df.loc["PEN", "DaysToStockout"])
+    assert df.loc["PEN", "Status"] == analytics.STATUS_OK
+
+
+def test_forecast_prefers_product_lead_time():
+    tracker = ConsumptionTracker(windows_days=(1.0,))
+    tracker.record("TIP", at=NOW)
+    products = [
+        {"ProductTag": "TIP", "CurrentStock": 10, "LeadTimeDays": 9},
+        {"ProductTag": "TIP", "CurrentStock": 10, "LeadTimeDays": None},
+    ]
+    df = analytics.forecast(products, tracker, lead_time_days=1.0, now=NOW)
+    assert df["ReorderPoint"].tolist() == [int(np.ceil(9 + 1.65 * 3)), int(np.ceil(1 + 1.65))]
+
+
+def test_forecast_of_no_products_is_empty():
+    assert analytics.forecast([], ConsumptionTracker(), now=NOW).empty
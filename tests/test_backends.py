@@ -0,0 +1,39 @@
+# ==============================================================================
+# tests/test_backends.py
+# query_page の条件（backends.py）が、SQLite と Airtable（模擬サーバー）で同じ結果になることのテストです。
+# ==============================================================================
+import pytest
+
+from backends import AirtableBackend, SQLiteBackend
+from bench.fake_airtable import FakeAirtable
+
+QRCODE_IDS = ["TIP_1", "TIP_12", "TIP_L_1", "TIP_", "TIPS_1", "XTIP_1"]
+
+
+@pytest.fixture(params=["sqlite", "airtable"])
+def backend(request, tmp_path):
+    if request.param == "sqlite":
+        store = SQLiteBackend(str(tmp_path / "test.db"))
+        store.batch_create("QRCodes", [{"QRCodeID": qrcode_id} for qrcode_id in QRCODE_IDS])
+        yield store
+        return
+    fake = FakeAirtable()
+    fake.start()
+    fake.seed("appTest", "QRCodes", [{"QRCodeID": qrcode_id} for qrcode_id in QRCODE_IDS])
+    yield AirtableBackend("patTest", "appTest", endpoint_url=fake.url)
+    fake.stop()
+
+
+def query_ids(backend, conditions):
+    records, _ = backend.query_page("QRCodes", conditions, page_size=100)
+    return sorted(r["fields"]["QRCodeID"] for r in records)
+
+
+def test_numbered_matches_only_serials_of_the_tag(backend):
+    assert query_ids(backend, [("QRCodeID", "numbered", "TIP_")]) == ["TIP_1", "TIP_12"]
+    assert query_ids(backend, [("QRCodeID", "numbered", "TIP_L_")]) == ["TIP_L_1"]
+
+
+def test_in_matches_listed_values(backend):
+    assert query_ids(backend, [("QRCodeID", "in", ["TIP_1", "TIP_L_1", "NONE"])]) == ["TIP_1", "TIP_L_1"]
+    assert query_ids(backend, [("QRCodeID", "in", [])]) == []
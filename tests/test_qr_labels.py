@@ -0,0 +1,41 @@
+# ==============================================================================
+# tests/test_qr_labels.py
+# ラベルシート（qr_labels.py）の作成のテストです。
+# ==============================================================================
+import io
+
+import pytest
+from PIL import Image
+
+import qr_labels
+from qr_labels import LABELS_PER_PAGE
+
+
+@pytest.fixture
+def rendered_pages(monkeypatch):
+    """_render_page で描画したページ数を数える"""
+    counter = {"pages": 0}
+    render_page = qr_labels._render_page
+
+    def counting_render_page(*args, **kwargs):
+        counter["pages"] += 1
+        return render_page(*args, **kwargs)
+
+    monkeypatch.setattr(qr_labels, "_render_page", counting_render_page)
+    return counter
+
+
+QRCODE_IDS = [f"TIP_{i}" for i in range(1, LABELS_PER_PAGE * 2 + 2)]  # 3ページ分
+
+
+def test_png_renders_only_first_page(rendered_pages):
+    png = qr_labels.render_label_sheet(QRCODE_IDS, "https://example.com", fmt="PNG")
+    assert rendered_pages["pages"] == 1
+    assert Image.open(io.BytesIO(png)).format == "PNG"
+
+
+def test_pdf_and_png_share_rendered_pages(rendered_pages):
+    sheets = qr_labels.render_label_sheets(QRCODE_IDS, "https://example.com", formats=("PDF", "PNG"))
+    assert rendered_pages["pages"] == 3
+    assert sheets["PDF"].startswith(b"%PDF")
+    assert sheets["PNG"] == qr_labels.render_label_sheet(QRCODE_IDS, "https://example.com", fmt="PNG")
@@ -0,0 +1,174 @@
+# ==============================================================================
+# tests/test_scheduler.py
+# Airtableへの送信窓口（scheduler.py）のテストです。
+#   - 送信間隔の調整（トークンバケット）・429/5xxの再試行と回数の上限・同じ読み取りのまとめ
+#   - ScheduledApi が、差し替えたセッションでも認証ヘッダーを送ること
+# ==============================================================================
+import threading
+import time
+
+import pytest
+import requests
+
+import scheduler
+from backends import AirtableBackend
+from bench.fake_airtable import FakeAirtable
+from scheduler import RequestScheduler, TokenBucket
+
+
+@pytest.fixture
+def fake():
+    server = FakeAirtable()
+    server.start()
+    yield server
+    server.stop()
+
+
+def test_session_sends_bearer_token():
+    backend = AirtableBackend("patSECRET", "appTest", endpoint_url="http://127.0.0.1:1")
+    assert backend.api.session.headers["Authorization"] == "Bearer patSECRET"
+
+
+def test_requests_are_authenticated(fake):
+    fake.seed("appTest", "Products", [{"ProductTag": "TIP", "CurrentStock": 3}])
+    backend = AirtableBackend("patSECRET", "appTest", endpoint_url=fake.url)
+    assert [r["fields"]["ProductTag"] for r in backend.all("Products")] == ["TIP"]
+    assert fake.stats["unauthorized"] == 0
+
+
+def test_fake_rejects_requests_without_token(fake):
+    response = requests.get(f"{fake.url}/v0/appTest/Products", timeout=5)
+    assert response.status_code == 401
+    assert fake.stats["unauthorized"] == 1
+
+
+def http_error(status, retry_after=None):
+    response = requests.Response()
+    response.status_code = status
+    if retry_after is not None:
+        response.headers["Retry-After"] = retry_after
+    return requests.exceptions.HTTPError(f"{status}", response=response)
+
+
+class Sender:
+    """errors の例外を順に投げ、尽きたら "ok" を返す send 関数"""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """再試行の待ち時間を記録し、実際には待たない"""
+    waited = []
+    monkeypatch.setattr(scheduler.time, "sleep", waited.append)
+    return waited
+
+
+def test_token_bucket_paces_requests():
+    bucket = TokenBucket(rate=20, capacity=1)
+    started = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    # 1つ目はすぐに取れ、残りの4つは 1/20 秒ずつ待ちます。
+    assert time.monotonic() - started >= 4 / 20 * 0.9
+
+
+def test_rate_limit_and_server_errors_are_retried(sleeps):
+    request_scheduler = RequestScheduler(rate=1000, max_retries=5, backoff_base=0.5)
+    send = Sender(http_error(429, retry_after="2"), http_error(503), requests.exceptions.ConnectionError())
+    assert request_scheduler.execute(send) == "ok"
+    assert send.calls == 4
+    assert request_scheduler.stats["retries"] == 3
+    # Retry-After があればそれに従い、無ければ倍々に延ばします（ばらつきは 0.5〜1.0 倍）。
+    assert sleeps[0] == 2.0
+    assert 0.5 <= sleeps[1] <= 1.0
+    assert 1.0 <= sleeps[2] <= 2.0
+
+
+def test_backoff_doubles_up_to_limit():
+    request_scheduler = RequestScheduler(backoff_base=0.5, backoff_max=3.0)
+    delays = [request_scheduler._backoff(attempt, None) for attempt in range(6)]
+    for attempt, delay in enumerate(delays):
+        expected = min(0.5 * 2 ** attempt, 3.0)
+        assert expected * 0.5 <= delay <= expected
+
+
+def test_retries_stop_at_max_retries(sleeps):
+    request_scheduler = RequestScheduler(rate=1000, max_retries=2)
+    send = Sender(*[http_error(503) for _ in range(10)])
+    with pytest.raises(requests.exceptions.HTTPError):
+        request_scheduler.execute(send)
+    assert send.calls == 3
+
+
+def test_writes_retry_only_rate_limits(sleeps):
+    # retry_on_server_error=False（作成のPOST）は、429だけ再試行します。
+    request_scheduler = RequestScheduler(rate=1000)
+    send = Sender(http_error(429), http_error(503))
+    with pytest.raises(requests.exceptions.HTTPError):
+        request_scheduler.execute(send, retry_on_server_error=False)
+    assert send.calls == 2
+
+
+def test_client_errors_are_not_retried(sleeps):
+    request_scheduler = RequestScheduler(rate=1000)
+    send = Sender(http_error(422))
+    with pytest.raises(requests.exceptions.HTTPError):
+        request_scheduler.execute(send)
+    assert send.calls == 1
+
+
+def test_identical_reads_are_coalesced():
+    request_scheduler = RequestScheduler(rate=1000)
+    release = threading.Event()
+    calls = []
+
+    def send():
+        calls.append(1)
+        release.wait(5)
+        return {"records": [1, 2]}
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(request_scheduler.execute(send, read_key="GET /Products")))
+        for _ in range(3)
+    ]
+    for thread in threads:
+        thread.start()
+    while request_scheduler.stats["coalesced"] < 2:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == [{"records": [1, 2]}] * 3
+    # 呼び出し元ごとに別のコピーを返します。
+    assert results[0] is not results[1]
+
+
+def test_fail_fast_sends_once(sleeps):
+    request_scheduler = RequestScheduler(rate=1000, max_retries=5)
+    send = Sender(http_error(503))
+    with scheduler.fail_fast(0.5), pytest.raises(requests.exceptions.HTTPError):
+        request_scheduler.execute(send, read_key="GET /QRCodes")
+    assert send.calls == 1
+    assert sleeps == []
+
+
+def test_fail_fast_does_not_wait_for_rate_limit():
+    request_scheduler = RequestScheduler(rate=1, burst=1)
+    request_scheduler.execute(Sender())
+    send = Sender()
+    started = time.monotonic()
+    with scheduler.fail_fast(0.1), pytest.raises(requests.exceptions.Timeout):
+        request_scheduler.execute(send)
+    assert send.calls == 0
+    assert time.monotonic() - started < 0.5
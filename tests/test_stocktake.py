@@ -0,0 +1,119 @@
+# ==============================================================================
+# tests/test_stocktake.py
+# 一括更新用ファイルの読み込みと、現在の在庫との突き合わせ（stocktake.py）のテストです。
+# ==============================================================================
+import io
+
+import pandas as pd
+import pytest
+
+import stocktake
+from stocktake import MODE_ADD, MODE_SET
+
+PRODUCTS = [
+    {"id": "recTIP", "fields": {"ProductTag": "TIP", "ProductName": "チップ", "CurrentStock": 10}},
+    {"id": "recGLV", "fields": {"ProductTag": "GLV", "ProductName": "手袋", "CurrentStock": 5}},
+    {"id": "recBUF", "fields": {"ProductTag": "BUF", "ProductName": "バッファー"}},  # 在庫数が未入力
+]
+
+
+def upload(*rows):
+    """アップロードされたファイルの内容（read_upload の戻り値と同じ、文字列の列）"""
+    return pd.DataFrame(rows, columns=["ProductTag", "Quantity"], dtype=object)
+
+
+def results(report):
+    """{商品タグ: (結果, 反映後の在庫数)}（反映しない行の在庫数は None）"""
+    return {
+        row.ProductTag: (row.Result, None if pd.isna(row.NewStock) else int(row.NewStock))
+        for row in report.itertuples()
+    }
+
+
+def test_set_mode_replaces_stock_and_lists_uncounted_products():
+    report = stocktake.reconcile(PRODUCTS, upload(("TIP", "12"), ("GLV", " 5 ")), MODE_SET)
+    assert results(report) == {
+        "TIP": (stocktake.RESULT_CHANGED, 12),
+        "GLV": (stocktake.RESULT_UNCHANGED, 5),
+        "BUF": (stocktake.RESULT_NOT_LISTED, None),
+    }
+    # ファイルの行番号順に並び、ファイルに無い商品は最後になります。
+    assert report["Row"].tolist()[:2] == [2, 3]
+    assert pd.isna(report["Row"].iloc[2])
+    assert stocktake.changed_rows(report)["RecordID"].tolist() == ["recTIP"]
+
+
+def test_add_mode_adds_to_stock_and_ignores_unlisted_products():
+    report = stocktake.reconcile(PRODUCTS, upload(("TIP", "3"), ("GLV", "-5"), ("BUF", "0")), MODE_ADD)
+    assert results(report) == {
+        "TIP": (stocktake.RESULT_CHANGED, 13),
+        "GLV": (stocktake.RESULT_CHANGED, 0),
+        "BUF": (stocktake.RESULT_UNCHANGED, 0),
+    }
+    assert report.loc[report["ProductTag"] == "TIP", "Difference"].item() == 3
+
+
+@pytest.mark.parametrize("mode", [MODE_SET, MODE_ADD])
+def test_duplicate_tags_are_not_applied(mode):
+    report = stocktake.reconcile(PRODUCTS, upload(("TIP", "1"), ("GLV", "6"), ("TIP", "2")), mode)
+    tip = report[report["ProductTag"] == "TIP"]
+    assert tip["Row"].tolist() == [2, 4]
+    assert (tip["Result"] == stocktake.RESULT_DUPLICATE).all()
+    assert tip["NewStock"].isna().all()
+    assert stocktake.changed_rows(report)["ProductTag"].tolist() == ["GLV"]
+
+
+@pytest.mark.parametrize("mode", [MODE_SET, MODE_ADD])
+def test_unknown_tags_are_reported(mode):
+    report = stocktake.reconcile(PRODUCTS, upload(("XYZ", "1"), ("TIP", "11")), mode)
+    unknown = report[report["ProductTag"] == "XYZ"].iloc[0]
+    assert unknown["Result"] == stocktake.RESULT_UNKNOWN
+    assert pd.isna(unknown["RecordID"]) and pd.isna(unknown["NewStock"])
+    assert stocktake.changed_rows(report)["ProductTag"].tolist() == ["TIP"]
+
+
+@pytest.mark.parametrize("mode", [MODE_SET, MODE_ADD])
+def test_invalid_and_blank_quantities_are_not_applied(mode):
+    report = stocktake.reconcile(PRODUCTS, upload(("TIP", "abc"), ("GLV", "1.5"), ("BUF", None)), mode)
+    assert results(report) == {
+        "TIP": (stocktake.RESULT_INVALID, None),
+        "GLV": (stocktake.RESULT_INVALID, None),
+        "BUF": (stocktake.RESULT_BLANK, None),
+    }
+    assert stocktake.changed_rows(report).empty
+
+
+def test_negative_result_is_invalid():
+    assert results(stocktake.reconcile(PRODUCTS, upload(("GLV", "-6")), MODE_ADD))["GLV"] == (stocktake.RESULT_INVALID, None)
+    assert results(stocktake.reconcile(PRODUCTS, upload(("GLV", "-1")), MODE_SET))["GLV"][0] == stocktake.RESULT_INVALID
+
+
+def test_blank_tag_rows_are_skipped():
+    report = stocktake.reconcile(PRODUCTS, upload(("", "3"), (None, None), ("TIP", "1")), MODE_ADD)
+    assert report["ProductTag"].tolist() == ["TIP"]
+    assert report["Row"].tolist() == [4]
+
+
+def test_empty_upload():
+    empty = upload()
+    assert stocktake.reconcile(PRODUCTS, empty, MODE_ADD).empty
+    report = stocktake.reconcile(PRODUCTS, empty, MODE_SET)
+    assert (report["Result"] == stocktake.RESULT_NOT_LISTED).all()
+    assert stocktake.changed_rows(report).empty
+
+
+def test_read_upload_keeps_only_needed_columns_as_text():
+    csv = "ProductName,ProductTag,Quantity\nチップ,TIP,007\n".encode("cp932")
+    df = stocktake.read_upload(io.BytesIO(csv), "counts.csv")
+    assert df.columns.tolist() == ["ProductTag", "Quantity"]
+    assert df.iloc[0].tolist() == ["TIP", "007"]
+
+
+def test_read_upload_requires_tag_and_quantity_columns():
+    with pytest.raises(ValueError, match="Quantity"):
+        stocktake.read_upload(io.BytesIO(b"ProductTag\nTIP\n"), "counts.csv")
+
+
+def test_read_upload_of_header_only_file_reconciles_to_nothing():
+    df = stocktake.read_upload(io.BytesIO(b"ProductTag,Quantity\n"), "counts.csv")
+    assert stocktake.reconcile(PRODUCTS, df, MODE_ADD).empty
@@ -0,0 +1,54 @@
+# ==============================================================================
+# tests/test_sync.py
+# mirror モードの送信（sync.py）のテストです。Airtableの代わりにメモリ上の簡単な実装を使います。
+# ==============================================================================
+import pytest
+
+import sync
+from backends import SQLiteBackend
+from sync import MirrorBackend, SyncEngine
+
+
+class MemoryRemote:
+    """get_many / batch_update だけを持つメモリ上のデータストア（fail_call 回目の更新で失敗します）"""
+
+    def __init__(self, fail_call=None):
+        self.records = {}
+        self.fail_call = fail_call
+        self.calls = 0
+
+    def get_many(self, table, record_ids):
+        return [{"id": record_id, "fields": dict(self.records[record_id])} for record_id in record_ids]
+
+    def batch_update(self, table, updates):
+        self.calls += 1
+        if self.calls == self.fail_call:
+            raise ConnectionError("simulated failure")
+        for update in updates:
+            self.records[update["id"]].update(update["fields"])
+        return [{"id": u["id"], "fields": dict(self.records[u["id"]])} for u in updates]
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    # 再送をすぐに取り出せるよう、待ち時間を0にします。
+    monkeypatch.setattr(sync, "RETRY_BASE_DELAY", 0)
+
+
+def test_partial_push_failure_does_not_add_twice(tmp_path):
+    # 12商品 → 10件 + 2件の2回に分けて送り、2回目が失敗した場合
+    remote = MemoryRemote(fail_call=2)
+    local = SQLiteBackend(str(tmp_path / "mirror.db"))
+    products = local.batch_create("Products", [{"ProductTag": f"P{i}", "CurrentStock": 100} for i in range(12)])
+    for product in products:
+        remote.records[product["id"]] = {"ProductTag": product["fields"]["ProductTag"], "CurrentStock": 100}
+    mirror = MirrorBackend(local, remote)
+    engine = SyncEngine(mirror)
+
+    mirror.batch_update("Products", [{"id": p["id"], "fields": {"CurrentStock": 99}} for p in products])
+    engine.push_outbox()
+    assert mirror.pending_count() == 2
+
+    engine.push_outbox()
+    assert mirror.pending_count() == 0
+    assert [r["CurrentStock"] for r in remote.records.values()] == [99] * 12
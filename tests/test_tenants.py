@@ -0,0 +1,83 @@
+# ==============================================================================
+# tests/test_tenants.py
+# 研究室（テナント）ごとの設定（tenants.py）と、研究室ごとのデータストア（database.get_store）のテストです。
+# ==============================================================================
+import itertools
+import os
+
+import pytest
+
+import tenants
+from tenants import DEFAULT_TENANT, Tenant
+
+# st.cache_resource は研究室IDごとに接続を使い回すため、テストごとに別の研究室IDを使います。
+_test_ids = itertools.count()
+
+
+@pytest.fixture
+def labs(monkeypatch, tmp_path):
+    """全体の設定で sqlite を使う、2つの研究室の一覧（テストの後は現在の研究室を元に戻します）"""
+    monkeypatch.setenv("DATABASE_BACKEND", "sqlite")
+    monkeypatch.setenv("SQLITE_PATH", str(tmp_path / "inventory.db"))
+    monkeypatch.setenv("WRITE_QUEUE_PATH", str(tmp_path / "write_queue.db"))
+    n = next(_test_ids)
+    registry = {f"lab_a{n}": Tenant(f"lab_a{n}", {"name": "A研究室"}), f"lab_b{n}": Tenant(f"lab_b{n}")}
+    monkeypatch.setattr(tenants, "_registry", registry)
+    token = tenants._current.set(None)
+    yield list(registry.values())
+    tenants._current.reset(token)
+
+
+def test_default_tenant_uses_global_paths(labs, tmp_path):
+    tenant = Tenant(DEFAULT_TENANT)
+    assert tenant.setting("SQLITE_PATH") == str(tmp_path / "inventory.db")
+    assert tenant.setting("WRITE_QUEUE_PATH") == str(tmp_path / "write_queue.db")
+
+
+def test_each_lab_gets_its_own_files(labs, tmp_path):
+    lab_a, lab_b = labs
+    for key in tenants.PATH_SETTINGS:
+        path_a, path_b = lab_a.setting(key), lab_b.setting(key)
+        assert path_a != path_b
+        assert os.path.dirname(path_a) == str(tmp_path)
+    assert lab_a.setting("SQLITE_PATH") == str(tmp_path / f"inventory_{lab_a.id}.db")
+    assert lab_b.setting("WRITE_QUEUE_PATH") == str(tmp_path / f"write_queue_{lab_b.id}.db")
+
+
+def test_lab_settings_take_precedence(labs, tmp_path):
+    lab = Tenant("lab_c", {"SQLITE_PATH": "/data/c.db", "DATABASE_BACKEND": "airtable"})
+    assert lab.setting("SQLITE_PATH") == "/data/c.db"
+    assert lab.setting("DATABASE_BACKEND") == "airtable"
+    # パス以外の全体の設定には研究室IDを付けません。
+    assert Tenant("lab_d").setting("DATABASE_BACKEND") == "sqlite"
+    assert lab.name == "lab_c"
+
+
+def test_activate_switches_current_lab_and_falls_back_to_default(labs):
+    lab_a, lab_b = labs
+    assert tenants.is_multi_tenant()
+    assert tenants.activate(lab_b.id) is lab_b
+    assert tenants.current() is lab_b
+    # 登録されていないIDは既定の研究室（最初に書かれた研究室）にします。
+    assert tenants.activate("unknown") is lab_a
+    assert tenants.current() is lab_a
+
+
+def test_each_lab_has_its_own_store(labs, monkeypatch):
+    import database
+
+    monkeypatch.setattr(database, "_stores", {})
+    lab_a, lab_b = labs
+    store_a, store_b = database.get_store(lab_a), database.get_store(lab_b)
+    assert database.get_store(lab_a) is store_a
+    assert store_a is not store_b
+    assert store_a.datastore.path != store_b.datastore.path
+    assert store_a.read_pool is not store_b.read_pool
+    assert store_a.product_cache is not store_b.product_cache
+
+    store_a.backend.create("Products", {"ProductTag": "TIP", "ProductName": "チップ", "CurrentStock": 3})
+    assert [r["fields"]["ProductTag"] for r in store_a.backend.all("Products")] == ["TIP"]
+    assert store_b.backend.all("Products") == []
+
+    tenants.activate(lab_b.id)
+    assert database.get_store() is store_b
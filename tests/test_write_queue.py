@@ -0,0 +1,160 @@
+# ==============================================================================
+# tests/test_write_queue.py
+# 書き込みキュー（write_queue.py）の送信のテストです。Airtableの代わりにメモリ上の簡単な実装を使います。
+# ==============================================================================
+import contextlib
+import sqlite3
+
+import pytest
+
+import write_queue
+from write_queue import DONE, REJECTED, ConsumeQueue, QueueFlusher
+
+
+class MemoryRemote:
+    """get_many / batch_update / query_page（"in" のみ）だけを持つメモリ上のデータストア（fail_products_call 回目の在庫の更新で失敗します）"""
+
+    def __init__(self, fail_products_call=None):
+        self.tables = {"Products": {}, "QRCodes": {}}
+        self.fail_products_call = fail_products_call
+        self.products_calls = 0
+
+    def get_many(self, table, record_ids):
+        records = self.tables[table]
+        return [{"id": record_id, "fields": dict(records[record_id])} for record_id in record_ids if record_id in records]
+
+    def query_page(self, table, conditions=(), page_size=100, cursor=None):
+        (field, op, values), = conditions
+        assert op == "in"
+        return [{"id": record_id, "fields": dict(fields)} for record_id, fields in self.tables[table].items()
+                if fields.get(field) in values], None
+
+    def batch_update(self, table, updates):
+        if table == "Products":
+            self.products_calls += 1
+            if self.products_calls == self.fail_products_call:
+                raise ConnectionError("simulated failure")
+        for update in updates:
+            self.tables[table][update["id"]].update(update["fields"])
+        return [{"id": u["id"], "fields": dict(self.tables[table][u["id"]])} for u in updates]
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    # 再送をすぐに取り出せるよう、待ち時間を0にします。
+    monkeypatch.setattr(write_queue, "RETRY_BASE_DELAY", 0)
+
+
+def make_queue(remote, products):
+    queue = ConsumeQueue(":memory:")
+    entries = []
+    for i in range(products):
+        remote.tables["Products"][f"recP{i}"] = {"CurrentStock": 100}
+        remote.tables["QRCodes"][f"recQ{i}"] = {"QRCodeID": f"P{i}_1", "Product": [f"recP{i}"], "Status": "未使用"}
+        entries.append((f"recQ{i}", f"recP{i}", "2024-04-01T00:00:00.000Z", "tester", f"P{i}_1"))
+    assert queue.enqueue(entries) == []
+    return queue
+
+
+def test_flush_decrements_each_product_once():
+    remote = MemoryRemote()
+    queue = make_queue(remote, 3)
+    flusher = QueueFlusher(queue, remote)
+    assert flusher.flush_once()
+    assert [p["CurrentStock"] for p in remote.tables["Products"].values()] == [99, 99, 99]
+    assert queue.counts()[DONE] == 3
+
+
+def test_partial_stock_failure_is_not_applied_twice():
+    # 12商品 → 10件 + 2件の2回に分けて送り、2回目が失敗した場合
+    remote = MemoryRemote(fail_products_call=2)
+    queue = make_queue(remote, 12)
+    flusher = QueueFlusher(queue, remote)
+    assert not flusher.flush_once()
+    assert queue.counts()[DONE] == 10
+
+    # 再送では残りの2商品だけを減らします。
+    while flusher.flush_once():
+        pass
+    assert [p["CurrentStock"] for p in remote.tables["Products"].values()] == [99] * 12
+    assert queue.counts()[DONE] == 12
+
+
+def test_qrcode_used_elsewhere_is_rejected():
+    remote = MemoryRemote()
+    queue = make_queue(remote, 1)
+    remote.tables["QRCodes"]["recQ0"].update({"Status": "使用済み", "UsedAt": "2020-01-01T00:00:00.000Z"})
+    rejected = []
+    flusher = QueueFlusher(queue, remote, on_rejected=lambda: rejected.append(True))
+    flusher.flush_once()
+    assert queue.counts()[REJECTED] == 1
+    assert remote.tables["Products"]["recP0"]["CurrentStock"] == 100
+    assert rejected
+
+
+def test_stock_is_written_under_product_locks():
+    # 在庫の読み取り〜書き込みが、渡したロックの中で行われること
+    remote = MemoryRemote()
+    queue = make_queue(remote, 12)
+    events = []
+
+    @contextlib.contextmanager
+    def lock_products(product_ids):
+        events.append(("lock", sorted(product_ids)))
+        yield
+        events.append(("unlock", remote.products_calls))
+
+    flusher = QueueFlusher(queue, remote, lock_products=lock_products)
+    flusher.flush_once()
+    assert [e[0] for e in events] == ["lock", "unlock", "lock", "unlock"]
+    assert sum(len(e[1]) for e in events if e[0] == "lock") == 12
+    assert [e[1] for e in events if e[0] == "unlock"] == [1, 2]
+
+
+def test_entry_without_record_id_is_resolved_by_qrcode_id():
+    # Airtableにつながらずに積んだ使用登録（レコードIDなし）は、送信時にQRCodeIDからレコードを調べます。
+    remote = MemoryRemote()
+    queue = make_queue(remote, 0)
+    remote.tables["Products"]["recP0"] = {"CurrentStock": 100}
+    remote.tables["QRCodes"]["recQ0"] = {"QRCodeID": "P0_1", "Product": ["recP0"], "Status": "未使用"}
+    remote.tables["QRCodes"]["recQ1"] = {"QRCodeID": "P0_2", "Product": ["recP0"], "Status": "使用済み"}
+    assert queue.enqueue([
+        (None, "recP0", "2024-04-01T00:00:00.000Z", "tester", "P0_1"),
+        (None, "recP0", "2024-04-01T00:00:00.000Z", "tester", "P0_2"),
+        (None, "recP0", "2024-04-01T00:00:00.000Z", "tester", "P0_3"),
+    ]) == []
+    assert queue.enqueue([(None, "recP0", "2024-04-01T00:00:00.000Z", "tester", "P0_1")]) == ["P0_1"]
+    assert queue.contains(qrcode_id="P0_1")
+
+    flusher = QueueFlusher(queue, remote)
+    flusher.flush_once()
+    assert remote.tables["QRCodes"]["recQ0"]["Status"] == "使用済み"
+    assert remote.tables["Products"]["recP0"]["CurrentStock"] == 99
+    assert queue.counts()[DONE] == 1
+    # 使用済みだったものと、Airtableに無いものは送信しません。
+    assert sorted(r["qrcode_id"] for r in queue.rejected()) == ["P0_2", "P0_3"]
+    assert queue.contains("recQ0")
+
+
+def test_old_queue_file_is_migrated(tmp_path):
+    # QRCodeIDの列が無い以前のファイルも、記録を残したまま開けること
+    path = str(tmp_path / "queue.db")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE consume_queue ("
+        "seq INTEGER PRIMARY KEY AUTOINCREMENT, qrcode_record_id TEXT NOT NULL UNIQUE, "
+        "product_record_id TEXT NOT NULL, used_at TEXT NOT NULL, used_by TEXT, "
+        "state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+        "next_attempt_at REAL NOT NULL DEFAULT 0, last_error TEXT, updated_at REAL NOT NULL)"
+    )
+    conn.execute(
+        "INSERT INTO consume_queue (qrcode_record_id, product_record_id, used_at, state, updated_at) "
+        "VALUES ('recQ0', 'recP0', '2024-04-01T00:00:00.000Z', 'queued', 0)"
+    )
+    conn.commit()
+    conn.close()
+
+    queue = ConsumeQueue(path)
+    assert queue.contains("recQ0")
+    assert queue.enqueue([(None, "recP0", "2024-04-01T00:00:00.000Z", "tester", "P0_2")]) == []
+    assert queue.pending_by_product() == {"recP0": 2}
@@ -0,0 +1,6 @@
+# ==============================================================================
+# views/
+# 画面ごとのモジュールです（login: ログイン・新規登録、user: 使用登録、admin: 管理者メニュー）。
+# app.py は表示する画面のモジュールだけを読み込むため、カメラ用の OpenCV / streamlit-webrtc は
+# 使用登録の画面で、pandas / qrcode は管理者メニューで初めて読み込まれます。
+# ==============================================================================
@@ -0,0 +1,367 @@
+# ==============================================================================
+# views/admin.py
+# 管理者メニュー（在庫状況・使用履歴・QRコード生成・一括更新・性能）の画面です。
+# ==============================================================================
+from datetime import datetime, timedelta
+
+import pandas as pd
+import streamlit as st
+
+import analytics  # 在庫切れ予測の状態（要発注など）
+import database
+import metrics  # 処理時間・呼び出し回数の記録
+import qr_labels  # QRコード画像・ラベルシートの生成
+import stocktake  # 在庫の一括更新（入荷・棚卸し）
+import tenants  # 研究室（テナント）ごとの設定と、現在の研究室
+from views.common import LOCAL_TZ, qrcode_base_url
+
+# 使用履歴の1ページあたりの件数
+HISTORY_PAGE_SIZE = 50
+
+
+def render():
+    """管理者メニューを表示する"""
+    st.title('管理者メニュー')
+
+    # QRコード画像のキャッシュ（全セッション共有）。ディレクトリを指定するとディスクにも保存します。
+    qr_image_cache = qr_labels.get_image_cache(disk_dir=st.secrets.get("QR_IMAGE_CACHE_DIR"))
+    # QRコードのURL（複数の研究室がある場合は研究室IDを含み、読み取るとその研究室の画面が開きます）
+    qr_base_url = qrcode_base_url()
+
+    def make_label_sheet(qrcode_ids):
+        """QRCodeIDのリストから印刷用シート（PDFと1ページ目のPNG）を作成する"""
+        # ページの描画は1度だけ行い、PDFとPNGの両方に使います。
+        sheets = qr_labels.render_label_sheets(qrcode_ids, qr_base_url, formats=("PDF", "PNG"), cache=qr_image_cache)
+        return {"name": f"{qrcode_ids[0]}-{qrcode_ids[-1]}", "pdf": sheets["PDF"], "png": sheets["PNG"]}
+
+    # --- 使用履歴の検索条件 ---
+    # 各タブで必要なデータを先にまとめて並行取得するため、条件は入力欄の現在値（session_state）から作ります。
+    today = datetime.now(LOCAL_TZ).date()
+    history_period = st.session_state.get("history_period", (today - timedelta(days=30), today))
+    history_status = st.session_state.get("history_status", "使用済み")
+    # 期間は「開始日の0時」から「終了日の翌日0時」まで（日付入力の途中は片方だけの場合があります）
+    since = until = None
+    if len(history_period) >= 1:
+        since = datetime.combine(history_period[0], datetime.min.time(), tzinfo=LOCAL_TZ)
+    if len(history_period) == 2:
+        until = datetime.combine(history_period[1] + timedelta(days=1), datetime.min.time(), tzinfo=LOCAL_TZ)
+    history_filters = {
+        "since": since,
+        "until": until,
+        "product_tag": st.session_state.get("history_product"),
+        "used_by": (st.session_state.get("history_user") or "").strip() or None,
+        "status": None if history_status == "すべて" else history_status,
+    }
+
+    # ページ送り用のカーソル（Airtableのoffsetは前方向にしか進めないため、開いたページ分を記憶します）
+    if st.session_state.get("history_filters") != history_filters:
+        st.session_state.history_filters = history_filters
+        st.session_state.history_cursors = [None]
+    history_cursors = st.session_state.history_cursors
+
+    # 商品一覧と使用履歴は互いに依存しないため、並行して取得します。
+    admin_data = database.fetch_concurrently(
+        products=database.get_all_products,
+        history=lambda: database.query_usage_history(
+            **history_filters, page_size=HISTORY_PAGE_SIZE, cursor=history_cursors[-1]
+        ),
+    )
+    all_products_list = admin_data["products"]
+
+    # タブを使って各機能を切り替えられるようにします。
+    tab1, tab2, tab3, tab4, tab5 = st.tabs(["在庫状況", "使用履歴", "QRコード生成", "一括更新", "性能"])
+
+    with tab1:
+        st.subheader('現在の在庫一覧')
+        if all_products_list:
+            # 使用ペースから在庫切れまでの日数と発注点を予測し、発注が必要な商品を色付けして表示します。
+            df_products, forecast_ready = database.forecast_stock(
+                all_products_list, lead_time_days=st.secrets.get("REORDER_LEAD_TIME_DAYS", 7)
+            )
+            if not forecast_ready:
+                st.caption("使用履歴から使用ペースを集計しています。しばらくすると予測が表示されます。")
+            low_stock = df_products[df_products['Status'] != analytics.STATUS_OK]
+            if len(low_stock):
+                st.warning(f"発注が必要な品目が {len(low_stock)} 件あります: " + "、".join(low_stock['ProductName']))
+
+            # 表示に必要な列だけを選んで、列名を日本語にします。
+            df_display = df_products[['ProductTag', 'ProductName', 'CurrentStock', 'Unit', 'DailyRate', 'DaysToStockout', 'ReorderPoint', 'Status']]
+            df_display.columns = ['商品タグ', '品目名', '現在庫数', '単位', '使用数/日', '在庫切れまでの日数', '発注点', '状態']
+            status_colors = {analytics.STATUS_OUT: "background-color: #f8d7da", analytics.STATUS_REORDER: "background-color: #fff3cd"}
+            st.dataframe(
+                df_display.style
+                    .apply(lambda row: [status_colors.get(row['状態'], '')] * len(row), axis=1)
+                    .format({'使用数/日': '{:.2f}', '在庫切れまでの日数': '{:.1f}'}, na_rep='-'),
+                use_container_width=True,
+            )
+        else:
+            st.write('商品はまだ登録されていません。')
+
+        st.divider()
+        st.subheader('データベース本体')
+        backend_name = database.get_backend_name()
+        if backend_name == "airtable":
+            st.info("入荷や棚卸しによる在庫数の更新は「一括更新」タブから行えます。商品の追加などは、下のボタンからAirtableを開いて直接編集してください。")
+            st.link_button("Airtableで在庫を直接編集する", f"https://airtable.com/{tenants.current().setting('AIRTABLE_BASE_ID')}")
+            queue_status = database.get_write_queue_status()
+            if queue_status is not None:
+                # 使用登録はいったんサーバー上のキューに記録し、バックグラウンドでAirtableへ送っています。
+                queue_counts = queue_status["counts"]
+                st.caption(
+                    f"Airtableへの送信待ち: {queue_counts['queued'] + queue_counts['marked']}件"
+                    f"（送信済み {queue_counts['done']}件 / 送信できなかったもの {queue_counts['rejected']}件）"
+                )
+                if queue_status["rejected"]:
+                    st.warning("次の使用登録はAirtableに反映できませんでした。在庫数を確認してください。")
+                    df_rejected = pd.DataFrame(queue_status["rejected"])
+                    df_rejected.columns = ['QRコード', '商品のレコードID', '使用日時', '使用者', '理由']
+                    st.dataframe(df_rejected, use_container_width=True, hide_index=True)
+        else:
+            st.info(f"ローカルのデータストア（{backend_name}）で動作しています。")
+
+
+    with tab2:
+        st.subheader('使用履歴')
+        # 絞り込みはデータベース側で行い、1ページ分（HISTORY_PAGE_SIZE件）ずつ取得します。
+        col_period, col_product, col_user, col_status = st.columns([2, 2, 1, 1])
+        col_period.date_input("期間", value=(today - timedelta(days=30), today), key="history_period")
+        history_product_names = {p['ProductTag']: p['ProductName'] for p in all_products_list}
+        col_product.selectbox(
+            "品目", options=list(history_product_names.keys()), format_func=history_product_names.get,
+            index=None, placeholder="すべて", key="history_product",
+        )
+        col_user.text_input("使用者（氏名）", key="history_user")
+        col_status.selectbox("状態", options=["使用済み", "未使用", "すべて"], key="history_status")
+
+        rows, next_cursor = admin_data["history"]
+        if rows:
+            df_history = pd.DataFrame(rows)
+            df_history["UsedAt"] = pd.to_datetime(df_history["UsedAt"], utc=True).dt.tz_convert(LOCAL_TZ).dt.strftime("%Y-%m-%d %H:%M")
+            df_history = df_history[['UsedAt', 'ProductName', 'QRCodeID', 'UsedBy', 'Status']]
+            df_history.columns = ['使用日時', '品目名', 'QRコード', '使用者', '状態']
+            st.dataframe(df_history, use_container_width=True, hide_index=True)
+        else:
+            st.write('条件に合う履歴はありません。')
+
+        col_prev, col_page, col_next = st.columns([1, 2, 1])
+        if col_prev.button("前のページ", disabled=len(history_cursors) == 1):
+            history_cursors.pop()
+            st.rerun()
+        col_page.write(f"{len(history_cursors)} ページ目")
+        if col_next.button("次のページ", disabled=next_cursor is None):
+            history_cursors.append(next_cursor)
+            st.rerun()
+
+
+    with tab3:
+        st.subheader('QRコード生成')
+        if all_products_list:
+            # 商品名をプルダウンメニューで選択できるようにします。
+            product_options = {p['ProductName']: p for p in all_products_list}
+            selected_product_name = st.selectbox(
+                label="QRコードを生成する備品を選択",
+                options=list(product_options.keys()),
+                index=None,
+                placeholder="備品を選択してください..."
+            )
+
+            if selected_product_name:
+                selected_product = product_options[selected_product_name]
+                # 選択された商品のレコードIDとタグを取得
+                product_record_id = selected_product.get('id') # get_all_productsはidを返さないので注意
+                # get_product_by_tagでidを取得する必要がある
+                product_data_with_id = database.get_product_by_tag(selected_product['ProductTag'])
+
+                if product_data_with_id:
+                    product_record_id = product_data_with_id['id']
+
+                    if st.button("新しいQRコードを1つ生成する", type="primary"):
+                        # database.pyの関数を呼び出して、新しいユニークなQRコードIDを作成します。
+                        new_qrcode_id = database.create_new_qrcode(product_record_id, selected_product['ProductTag'])
+                        if new_qrcode_id:
+                            # 生成されたユニークIDを含むURLを作成
+                            url_to_encode = qr_labels.build_qrcode_url(qr_base_url, new_qrcode_id)
+
+                            st.success(f"新しいQRコードを生成しました: {new_qrcode_id}")
+                            st.write("生成されたURL:")
+                            st.code(url_to_encode)
+
+                            # URLを元にQRコード画像を生成して表示（作成した画像はキャッシュに残ります）
+                            img_bytes = qr_image_cache.get(new_qrcode_id, qr_base_url, "PNG")
+                            st.image(img_bytes, caption=f"{selected_product_name} のQRコード", width=200)
+                            st.info("この画像を右クリックして保存し、印刷して使用してください。")
+                        else:
+                            st.error("QRコードの生成に失敗しました。")
+
+                    # --- まとめて生成（印刷用シート） ---
+                    st.divider()
+                    st.markdown("**まとめて生成**（入荷時のラベル印刷用）")
+                    bulk_count = st.number_input("生成する枚数", min_value=1, max_value=500, value=10, step=1)
+                    if st.button(f"QRコードを{bulk_count}枚まとめて生成する"):
+                        new_qrcode_ids = database.create_qrcodes_bulk(product_record_id, selected_product['ProductTag'], int(bulk_count))
+                        if new_qrcode_ids:
+                            # ダウンロードボタンを押すと再実行されるため、シートはセッションに保存しておきます。
+                            st.session_state.label_sheet = make_label_sheet(new_qrcode_ids)
+                            st.session_state.label_sheet["message"] = f"{len(new_qrcode_ids)}枚のQRコードを生成しました。"
+                        else:
+                            st.error("QRコードの生成に失敗しました。")
+
+                    # --- 過去のラベルの再ダウンロード（破損したラベルの貼り替え用） ---
+                    # QRCodeIDは「商品タグ_連番」なので、データベースに問い合わせずに番号から作り直せます。
+                    st.divider()
+                    st.markdown("**過去のラベルを再ダウンロード**")
+                    latest_num = product_data_with_id['fields'].get('LatestQRCodeNum', 0)
+                    if latest_num:
+                        col_start, col_end = st.columns(2)
+                        start_num = col_start.number_input("開始番号", min_value=1, max_value=latest_num, value=latest_num, step=1)
+                        end_num = col_end.number_input("終了番号", min_value=int(start_num), max_value=latest_num, value=latest_num, step=1)
+                        reprint_ids = [f"{selected_product['ProductTag']}_{num}" for num in range(int(start_num), int(end_num) + 1)]
+
+                        if len(reprint_ids) == 1:
+                            reprint_id = reprint_ids[0]
+                            st.image(qr_image_cache.get(reprint_id, qr_base_url, "PNG"), caption=reprint_id, width=200)
+                            col_png, col_svg = st.columns(2)
+                            col_png.download_button("PNGでダウンロード", qr_image_cache.get(reprint_id, qr_base_url, "PNG"), file_name=f"{reprint_id}.png", mime="image/png")
+                            col_svg.download_button("SVGでダウンロード", qr_image_cache.get(reprint_id, qr_base_url, "SVG"), file_name=f"{reprint_id}.svg", mime="image/svg+xml")
+                        elif st.button(f"{reprint_ids[0]} 〜 {reprint_ids[-1]} の印刷用シートを作成する"):
+                            st.session_state.label_sheet = make_label_sheet(reprint_ids)
+                            st.session_state.label_sheet["message"] = f"{len(reprint_ids)}枚分の印刷用シートを作成しました。"
+                    else:
+                        st.write("この備品のQRコードはまだ生成されていません。")
+
+                    label_sheet = st.session_state.get("label_sheet")
+                    if label_sheet:
+                        st.divider()
+                        st.success(label_sheet["message"])
+                        col_pdf, col_png = st.columns(2)
+                        col_pdf.download_button("印刷用シートをダウンロード (PDF)", label_sheet["pdf"], file_name=f"{label_sheet['name']}.pdf", mime="application/pdf")
+                        col_png.download_button("1ページ目をダウンロード (PNG)", label_sheet["png"], file_name=f"{label_sheet['name']}.png", mime="image/png")
+                        st.image(label_sheet["png"], caption="印刷用シート（1ページ目）", width=400)
+                else:
+                    st.error("商品のIDが取得できませんでした。")
+
+
+    with tab4:
+        st.subheader('在庫の一括更新（入荷・棚卸し）')
+        st.write("現在の在庫一覧をダウンロードし、Quantity 列に数量を入力してアップロードしてください。在庫数が変わる商品だけを更新します。")
+        df_template = stocktake.make_template(all_products_list)
+        col_csv, col_xlsx = st.columns(2)
+        col_csv.download_button(
+            "在庫一覧をCSVでダウンロード", stocktake.to_csv_bytes(df_template),
+            file_name=f"stock_{today:%Y%m%d}.csv", mime="text/csv",
+        )
+        col_xlsx.download_button(
+            "在庫一覧をExcelでダウンロード", stocktake.to_excel_bytes(df_template),
+            file_name=f"stock_{today:%Y%m%d}.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        )
+
+        bulk_modes = {stocktake.MODE_SET: "棚卸し（数えた数で置き換える）", stocktake.MODE_ADD: "入荷（今の在庫数に足す）"}
+        bulk_mode = st.radio("更新の種類", options=list(bulk_modes.keys()), format_func=bulk_modes.get, horizontal=True)
+        uploaded_file = st.file_uploader("数量を入力したファイル", type=["csv", "xlsx"])
+        if uploaded_file is not None:
+            try:
+                counts = stocktake.read_upload(uploaded_file, uploaded_file.name)
+            except ValueError as e:
+                st.error(str(e))
+                counts = None
+            report = database.reconcile_stock(counts, bulk_mode) if counts is not None else None
+            if report is not None:
+                result_counts = report['Result'].value_counts()
+                changed_count = int(result_counts.get(stocktake.RESULT_CHANGED, 0))
+                st.write("、".join(f"{result}: {count}件" for result, count in result_counts.items()))
+                problem_results = [stocktake.RESULT_INVALID, stocktake.RESULT_UNKNOWN, stocktake.RESULT_DUPLICATE]
+                if report['Result'].isin(problem_results).any():
+                    st.warning("反映できない行があります。ファイルを確認してください（その行は更新しません）。")
+                st.dataframe(stocktake.to_report(report), use_container_width=True, hide_index=True)
+
+                if st.button(f"{changed_count}件の変更を反映する", type="primary", disabled=changed_count == 0):
+                    progress_bar = st.progress(0.0, text="更新しています...")
+                    applied = database.apply_stock_changes(
+                        report, bulk_mode, progress=lambda done, total: progress_bar.progress(done / total, text=f"{done} / {total}件")
+                    )
+                    # ダウンロードボタンを押すと再実行されるため、結果はセッションに保存しておきます。
+                    st.session_state.stock_report = {"report": stocktake.to_report(applied), "mode": bulk_mode}
+                    st.rerun()
+
+        stock_report = st.session_state.get("stock_report")
+        if stock_report:
+            st.divider()
+            df_report = stock_report["report"]
+            failed = df_report[df_report['エラー'].notna()]
+            if len(failed):
+                st.error(f"{len(failed)}件を反映できませんでした。レポートを確認してください。")
+            else:
+                st.success(f"{int(df_report['反映'].sum())}件の在庫数を更新しました。")
+            report_name = f"{'stocktake' if stock_report['mode'] == stocktake.MODE_SET else 'restock'}_{datetime.now(LOCAL_TZ):%Y%m%d_%H%M}"
+            col_report_csv, col_report_xlsx = st.columns(2)
+            col_report_csv.download_button(
+                "結果のレポートをCSVでダウンロード", stocktake.to_csv_bytes(df_report),
+                file_name=f"{report_name}.csv", mime="text/csv",
+            )
+            col_report_xlsx.download_button(
+                "結果のレポートをExcelでダウンロード", stocktake.to_excel_bytes(df_report),
+                file_name=f"{report_name}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            )
+
+
+    with tab5:
+        st.subheader('処理時間と通信回数')
+        st.caption(
+            f"{datetime.fromtimestamp(metrics.registry.started_at, LOCAL_TZ):%Y-%m-%d %H:%M} からの記録です"
+            "（全セッション合計。パーセンタイルは直近の記録から計算します）。"
+        )
+        metric_rows, metric_counters = metrics.registry.summary()
+
+        # 処理ごとの時間（database.py の関数・データストアの操作・Airtableへの通信・QRコードの読み取りと画像作成）
+        duration_rows = [r for r in metric_rows if r["kind"] == metrics.DURATION]
+        if duration_rows:
+            df_durations = pd.DataFrame(duration_rows)
+            df_durations["error_rate"] = df_durations["error_rate"] * 100
+            for col in ["p50", "p95", "p99", "mean"]:
+                df_durations[col] = df_durations[col] * 1000
+            df_durations = df_durations[['name', 'count', 'error_rate', 'p50', 'p95', 'p99', 'mean']]
+            df_durations.columns = ['処理', '件数', 'エラー率 (%)', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', '平均 (ms)']
+            st.dataframe(df_durations.round(1), use_container_width=True, hide_index=True)
+        else:
+            st.write('まだ記録がありません。')
+
+        # 起動時間（サーバーの起動後、最初の1回だけの記録。ライブラリの読み込み時間を含みます）
+        startup_times = metrics.registry.startup_times()
+        if startup_times:
+            st.markdown("**起動時間**（サーバーの起動後の最初の1回。記録をリセットしても残ります）")
+            df_startup = pd.DataFrame(sorted(startup_times.items()), columns=['処理', '時間 (ms)'])
+            df_startup['時間 (ms)'] = df_startup['時間 (ms)'] * 1000
+            st.dataframe(df_startup.round(1), use_container_width=True, hide_index=True)
+
+        # 画面表示1回あたりの通信回数（キャッシュの効果の確認用）
+        st.markdown("**画面表示1回あたりの通信回数**")
+        call_kinds = {metrics.API_CALLS_PER_RENDER: "Airtableへの通信", metrics.BACKEND_CALLS_PER_RENDER: "データストアの操作"}
+        call_rows = [r for r in metric_rows if r["kind"] in call_kinds]
+        if call_rows:
+            df_calls = pd.DataFrame(call_rows)
+            df_calls["kind"] = df_calls["kind"].map(call_kinds)
+            df_calls = df_calls[['name', 'kind', 'count', 'mean', 'p50', 'p95', 'p99']]
+            df_calls.columns = ['画面', '種類', '表示回数', '平均', 'p50', 'p95', 'p99']
+            st.dataframe(df_calls.round(2), use_container_width=True, hide_index=True)
+
+        # キャッシュのヒット率と、その他の回数
+        if metric_counters:
+            cache_names = sorted({name.rsplit(".", 1)[0] for name in metric_counters if name.startswith("cache.")})
+            for cache_name in cache_names:
+                hits = metric_counters.get(f"{cache_name}.hit", 0) + metric_counters.get(f"{cache_name}.disk_hit", 0)
+                total = hits + metric_counters.get(f"{cache_name}.miss", 0)
+                if total:
+                    st.write(f"{cache_name} のヒット率: {hits / total:.1%}（{hits} / {total}）")
+            df_counters = pd.DataFrame(list(metric_counters.items()), columns=['項目', '回数'])
+            st.dataframe(df_counters, use_container_width=True, hide_index=True)
+
+        col_export, col_reset = st.columns(2)
+        col_export.download_button(
+            "Prometheus形式でダウンロード", metrics.registry.to_prometheus(),
+            file_name="stock_app_metrics.prom", mime="text/plain",
+        )
+        if col_reset.button("記録をリセットする"):
+            metrics.registry.reset()
+            st.rerun()
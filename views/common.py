@@ -0,0 +1,49 @@
+# ==============================================================================
+# views/common.py
+# 各画面で共通に使う設定と、パスワード照合・ログイン試行制限の共有インスタンスです。
+# ==============================================================================
+from zoneinfo import ZoneInfo
+
+import streamlit as st
+
+import auth  # パスワード照合とログイン試行回数の制限
+import tenants  # 研究室（テナント）ごとの設定と、現在の研究室
+
+# アプリのベースURL。QRコード生成時に使用します。
+# Streamlit Cloudにデプロイした後のURLに書き換えてください。
+APP_BASE_URL = "https://your-app-name.streamlit.app"
+
+# 日時の表示・期間指定に使うタイムゾーン
+LOCAL_TZ = ZoneInfo(st.secrets.get("TIMEZONE", "Asia/Tokyo"))
+
+# --- 管理者パスワードをSecretsから安全に読み込む ---
+# Streamlit CloudのSecrets機能を使うことで、パスワードをコード内に直接書かなくて済みます。
+# 研究室ごとに [tenants.<研究室ID>] に書くこともでき、無ければ全体の設定を使います。
+def admin_password_hash():
+    """現在の研究室の管理者パスワードのハッシュ値"""
+    return tenants.current().setting("admin_password")
+
+def master_pin_hash():
+    """現在の研究室の共通ピンコード（新規登録用）のハッシュ値"""
+    return tenants.current().setting("master_pin_hash")
+
+
+def qrcode_base_url():
+    """QRコードに埋め込むURLの起点（複数の研究室がある場合は研究室IDを付けます）"""
+    if tenants.is_multi_tenant():
+        return f"{APP_BASE_URL}?lab={tenants.current().id}"
+    return APP_BASE_URL
+
+# --- パスワード照合の設定 ---
+# bcryptの照合は共有のスレッドプールで行い、同時実行数を制限します。
+# 失敗が続いた場合は、一定時間そのユーザー名（ピンコード・管理者パスワードは研究室）への試行を止めます。
+# 全体の失敗回数が LOGIN_GLOBAL_MAX_FAILURES を超えた場合は、すべての試行を止めます。
+password_verifier = auth.get_password_verifier(
+    max_workers=st.secrets.get("BCRYPT_WORKERS", 2),
+    max_pending=st.secrets.get("BCRYPT_MAX_PENDING", 8),
+)
+login_limiter = auth.get_rate_limiter(
+    max_failures=st.secrets.get("LOGIN_MAX_FAILURES", 5),
+    window_seconds=st.secrets.get("LOGIN_LOCK_SECONDS", 300),
+    global_max_failures=st.secrets.get("LOGIN_GLOBAL_MAX_FAILURES", 50),
+)
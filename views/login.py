@@ -0,0 +1,99 @@
+# ==============================================================================
+# views/login.py
+# ログイン前の画面（ログインと新規登録）です。
+# ==============================================================================
+import streamlit as st
+
+import auth  # パスワード照合とログイン試行回数の制限
+import database
+import tenants  # 研究室（テナント）ごとの設定と、現在の研究室
+from views.common import login_limiter, master_pin_hash, password_verifier
+
+
+def render():
+    """ログイン・新規登録の画面を表示する"""
+    st.title('研究室　消耗品管理システム')
+    # 複数の研究室がある場合は、ログインする研究室を選びます（URLの lab で指定された研究室を初期値にします）。
+    # ユーザーは研究室ごとに登録されるため、選んだ研究室のデータで照合・登録します。
+    tenant = tenants.current()
+    if tenants.is_multi_tenant():
+        tenant_ids = list(tenants.registry())
+        tenant_id = st.selectbox(
+            "研究室", options=tenant_ids, index=tenant_ids.index(tenant.id),
+            format_func=lambda tenant_id: tenants.get(tenant_id).name,
+        )
+        tenant = tenants.activate(tenant_id)
+    # タブでログインと新規登録を切り替えます。
+    login_tab, register_tab = st.tabs(["ログイン", "新規登録"])
+
+    # --- ログインタブ ---
+    with login_tab:
+        with st.form("login_form"):
+            username = st.text_input("ユーザーネーム")
+            password = st.text_input("パスワード", type="password")
+            submitted = st.form_submit_button("ログイン")
+            if submitted:
+                login_limit_key = f"user:{tenant.id}:{username}"
+                retry_after = login_limiter.retry_after(login_limit_key)
+                if retry_after:
+                    st.error(f"ログインの試行回数が多すぎます。{retry_after}秒後に再度お試しください。")
+                else:
+                    # database.pyの関数を使ってユーザー情報を取得（キャッシュ済みなら通信なし）
+                    user = database.get_user(username)
+                    # パスワードがハッシュ値と一致するかチェック
+                    try:
+                        login_ok = bool(user) and password_verifier.verify(password, user.get('HashedPassword'))
+                    except auth.LoginBusyError as e:
+                        st.warning(str(e))
+                    else:
+                        if login_ok:
+                            # ログイン成功なら、セッションに状態を保存してリロード
+                            login_limiter.reset(login_limit_key)
+                            st.session_state.authentication_status = True
+                            st.session_state.tenant_id = tenant.id
+                            st.session_state.name = user['Name']
+                            st.rerun()
+                        else:
+                            login_limiter.record_failure(login_limit_key)
+                            st.error("ユーザーネームまたはパスワードが間違っています。")
+
+    # --- 新規登録タブ ---
+    with register_tab:
+        st.info('アカウントを登録してください。')
+        with st.form("registration_form", clear_on_submit=True):
+            name_reg = st.text_input("氏名")
+            username_reg = st.text_input("ユーザーネーム (ログインID)", help="半角英数字で入力してください。")
+            password_reg = st.text_input("パスワード", type="password")
+            password_rep = st.text_input("パスワード（確認用）", type="password")
+            pin_reg = st.text_input("共通ピンコード", type="password", max_chars=4)
+            reg_submitted = st.form_submit_button("登録する")
+
+            if reg_submitted:
+                # 入力値のバリデーション（チェック）。bcryptを使うピンコードの照合は、簡単なチェックの後に行います。
+                # ピンコードは研究室で共通なので、接続元ではなく研究室ごとに試行回数を数えます。
+                pin_limit_key = f"pin:{tenant.id}"
+                retry_after = login_limiter.retry_after(pin_limit_key)
+                if retry_after:
+                    st.error(f"試行回数が多すぎます。{retry_after}秒後に再度お試しください。")
+                elif not (name_reg and username_reg and password_reg and password_rep):
+                    st.warning("すべての項目を入力してください。")
+                elif password_reg != password_rep:
+                    st.error("パスワードが一致しません。")
+                else:
+                    try:
+                        pin_ok = password_verifier.verify(pin_reg, master_pin_hash())
+                        if not pin_ok:
+                            login_limiter.record_failure(pin_limit_key)
+                            st.error("共通ピンコードが違います。")
+                        elif database.get_user(username_reg):
+                            st.error("このユーザーネームは既に使用されています。")
+                        else:
+                            # パスワードをハッシュ化
+                            hashed_password = password_verifier.hash(password_reg, rounds=st.secrets.get("BCRYPT_ROUNDS", 12))
+                            # データベースに新しいユーザーを追加
+                            database.add_user(name_reg, username_reg, hashed_password)
+                            # 登録成功のフラグを立ててリロード
+                            st.session_state.just_registered = True
+                            st.rerun()
+                    except auth.LoginBusyError as e:
+                        st.warning(str(e))
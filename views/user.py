@@ -0,0 +1,282 @@
+# ==============================================================================
+# views/user.py
+# 通常ユーザー向けの使用登録の画面です（カメラでQRコードを読み取り、在庫を1つ減らします）。
+# ==============================================================================
+import time
+
+import streamlit as st
+from streamlit_webrtc import webrtc_streamer, WebRtcMode
+
+import auth  # パスワード照合とログイン試行回数の制限
+import database
+import scanner  # カメラ映像からのQRコード読み取り
+import tenants  # 研究室（テナント）ごとの設定と、現在の研究室
+from views.common import admin_password_hash, login_limiter, password_verifier
+
+
+def render():
+    """使用登録の画面を表示する"""
+    name = st.session_state["name"]
+
+    # 管理者メニューがロックされている場合は、通常ユーザー向けの画面を表示します。
+
+    # --- 管理者メニューへの入り口 ---
+    st.sidebar.subheader("管理者用")
+    admin_password_input = st.sidebar.text_input("管理者パスワードを入力", type="password", key="admin_pass")
+    if st.sidebar.button("認証"):
+        # 管理者パスワードは研究室ごとに1つなので、研究室ごとに試行回数を数えます。
+        admin_limit_key = f"admin:{tenants.current().id}"
+        retry_after = login_limiter.retry_after(admin_limit_key)
+        if retry_after:
+            st.sidebar.error(f"試行回数が多すぎます。{retry_after}秒後に再度お試しください。")
+        else:
+            # 入力されたパスワードが、Secretsに保存されているハッシュ値と一致するかチェックします。
+            try:
+                admin_ok = password_verifier.verify(admin_password_input, admin_password_hash())
+            except auth.LoginBusyError as e:
+                st.sidebar.warning(str(e))
+            else:
+                if admin_ok:
+                    login_limiter.reset(admin_limit_key)
+                    st.session_state.admin_unlocked = True
+                    st.rerun() # ページをリロードして管理者画面を表示
+                else:
+                    login_limiter.record_failure(admin_limit_key)
+                    st.sidebar.error("パスワードが違います。")
+
+    # --- メインコンテンツ ---
+    st.title('研究室　消耗品管理システム')
+    st.header('使用登録')
+
+    # --- QRコードスキャナー ---
+    # streamlit-webrtcを使ってカメラ映像を表示し、QRコードをリアルタイムで検出します。
+    # 読み取り処理（scanner.QRScanner）はセッションごとに1つ作り、再実行をまたいで使い回します。
+    # 検出したQRコードのデータはst.session_stateに保存されます。
+    if 'scanned_code' not in st.session_state:
+        st.session_state.scanned_code = None
+    if 'qr_scanner' not in st.session_state:
+        st.session_state.qr_scanner = scanner.QRScanner(
+            decode_every_n=st.secrets.get("SCAN_DECODE_EVERY_N", 3),
+            min_interval=st.secrets.get("SCAN_MIN_INTERVAL", 0.0),
+            max_width=st.secrets.get("SCAN_MAX_WIDTH", 640),
+            # 読み取りは全セッション共有のプールで行い、カメラのコールバックをすぐに返します。
+            pool=scanner.get_decode_pool(st.secrets.get("SCAN_WORKERS")),
+        )
+    qr_scanner = st.session_state.qr_scanner
+
+    webrtc_ctx = webrtc_streamer(
+        key="qr-scanner",
+        mode=WebRtcMode.SENDONLY,
+        video_frame_callback=qr_scanner,
+        media_stream_constraints={"video": {"facingMode": "environment"}, "audio": False},
+        async_processing=True,
+    )
+
+    # 読み取り時間の表示（スキャン間隔や縮小サイズの調整用）
+    scan_stats_area = st.expander("スキャナーの処理時間").empty()
+
+    def show_scan_stats():
+        scan_stats = qr_scanner.stats()
+        avg_ms = f"{scan_stats['avg_ms']:.1f}" if scan_stats['avg_ms'] is not None else "-"
+        p95_ms = f"{scan_stats['p95_ms']:.1f}" if scan_stats['p95_ms'] is not None else "-"
+        scan_stats_area.write(
+            f"読み取り / 受信フレーム: {scan_stats['decoded_frames']} / {scan_stats['frames']}　"
+            f"破棄: {scan_stats['dropped_frames']}　"
+            f"平均: {avg_ms} ms　p95: {p95_ms} ms"
+        )
+
+    show_scan_stats()
+
+    # --- まとめて使用（連続スキャン） ---
+    # 読み取ったQRコードを一覧（カート）に貯め、最後にまとめて使用を記録します。
+    # 読み取りのたびの通信や画面の再読み込みが無いため、キットの開封などで続けて登録できます。
+    if st.toggle("まとめて使用（連続スキャン）", key="cart_mode"):
+        render_cart(webrtc_ctx, qr_scanner, show_scan_stats, name)
+        return
+
+    # カメラの映像は別スレッドで処理されるため、結果が出るまで待ってから画面を更新します。
+    scanned = qr_scanner.pop_result()
+    if scanned:
+        st.session_state.scanned_code = scanned
+    elif webrtc_ctx.state.playing and not st.session_state.scanned_code:
+        def on_scanned(qrcode_id):
+            st.session_state.scanned_code = qrcode_id
+            st.rerun()
+
+        wait_for_scans(webrtc_ctx, qr_scanner, show_scan_stats, on_scanned)
+
+    st.markdown("---")
+
+    # --- スキャン後の処理 ---
+    # URLクエリパラメータか、カメラのスキャン結果を取得します。
+    active_qrcode_id = st.session_state.get("scanned_code") or st.query_params.get("qrcode")
+
+    if active_qrcode_id:
+        # QRコードのデータを取得し、同時に商品キャッシュも用意しておきます（並行取得）。
+        scan_data = database.fetch_concurrently(
+            qrcode=(database.get_qrcode_data, active_qrcode_id),
+            products=database.get_all_products,
+        )
+        qrcode_data = scan_data["qrcode"]
+
+        if qrcode_data and qrcode_data.get('unverified'):
+            st.warning("データベースにつながらないため、QRコードの確認は接続が戻ってから行います。")
+
+        if not qrcode_data:
+            st.error(f"QRコード '{active_qrcode_id}' がデータベースに見つかりません。")
+        elif qrcode_data['fields'].get('Status') == '使用済み':
+            st.error(f"このQRコード ({active_qrcode_id}) は既に使用されています。")
+        else:
+            # QRコードに紐づく商品情報を取得
+            product_record_id = qrcode_data['fields'].get('Product', [None])[0]
+            if product_record_id:
+                # レコードIDの索引から商品を取得します（キャッシュ済みなら通信なし）。
+                product_data_with_id = database.get_product_by_record_id(product_record_id)
+
+                if not product_data_with_id:
+                    st.error("QRコードに紐づく商品が見つかりませんでした。")
+                else:
+                    product = product_data_with_id['fields']
+                    current_stock = int(product.get('CurrentStock', 0))
+
+                    st.subheader(f"品目名: {product['ProductName']}")
+                    st.metric(label="現在の在庫数", value=f"{current_stock} {product.get('Unit', '')}")
+
+                    if current_stock > 0:
+                        if st.button(f"「{product['ProductName']}」を1つ使用する", type="primary", use_container_width=True):
+                            # 在庫を1つ減らし、QRコードを「使用済み」にする（更新後の在庫数が返ります）
+                            new_stock = database.consume_qrcode(
+                                qrcode_data['id'], product_data_with_id['id'], used_by=name, qrcode_id=active_qrcode_id
+                            )
+
+                            if new_stock is not None:
+                                # 処理が終わったら、スキャン状態をリセット
+                                st.session_state.scanned_code = None
+                                if "qrcode" in st.query_params:
+                                    st.query_params.clear()
+
+                                st.success(f"「{product['ProductName']}」の使用を記録しました。（残り {new_stock} {product.get('Unit', '')}）")
+                                st.balloons()
+                                # 画面をリフレッシュして最新の状態を再表示
+                                st.rerun()
+                    else:
+                        st.error(f"「{product['ProductName']}」の在庫がありません。")
+
+    else:
+        st.info("上のカメラでQRコードをスキャンしてください。")
+
+
+def render_cart(webrtc_ctx, qr_scanner, show_scan_stats, name):
+    """まとめて使用の画面（読み取ったQRコードをカートに貯め、確定するとまとめて記録する）"""
+    # カート: {QRCodeID: {"product_id", "ProductName", "Unit"}}（同じQRコードは1回だけ入ります）
+    cart = st.session_state.setdefault("cart", {})
+    cart_message = st.session_state.pop("cart_message", None)
+    if cart_message:
+        st.success(cart_message)
+    # URLから開いた場合も、カートに加えます。
+    if "qrcode" in st.query_params:
+        add_to_cart(cart, st.query_params["qrcode"])
+        st.query_params.clear()
+
+    message_area = st.empty()
+    cart_area = st.empty()
+    col_commit, col_clear = st.columns(2)
+    if col_commit.button("まとめて使用を記録する", type="primary", use_container_width=True) and cart:
+        commit_cart(cart, name)
+    if col_clear.button("カートを空にする", use_container_width=True):
+        cart.clear()
+        st.rerun()
+    show_cart(cart_area, cart)
+
+    def on_scanned(qrcode_id):
+        level, message = add_to_cart(cart, qrcode_id)
+        getattr(message_area, level)(message)
+        show_cart(cart_area, cart)
+
+    scanned = qr_scanner.pop_result()
+    if scanned:
+        on_scanned(scanned)
+    if webrtc_ctx.state.playing:
+        # 読み取り結果はこの表示の中でカートに加えるため、再実行せずに続けて読み取れます。
+        wait_for_scans(webrtc_ctx, qr_scanner, show_scan_stats, on_scanned)
+    elif not cart:
+        st.info("上のカメラでQRコードを続けてスキャンしてください。")
+
+
+def wait_for_scans(webrtc_ctx, qr_scanner, show_scan_stats, on_scanned):
+    """
+    カメラが動いている間、読み取り結果を待って on_scanned(QRCodeID) を呼ぶ（処理時間の表示は1秒ごとに更新）。
+    カメラの映像は別スレッドで処理されるため、この表示の中で結果を待ちます。
+    """
+    # ここからは読み取り結果を待つだけなので、画面表示の計測はここで締めます。
+    st.session_state.metrics_render.finish()
+    last_stats_at = time.monotonic()
+    while webrtc_ctx.state.playing:
+        scanned = qr_scanner.pop_result()
+        if scanned:
+            on_scanned(scanned)
+        if time.monotonic() - last_stats_at > 1.0:
+            show_scan_stats()
+            last_stats_at = time.monotonic()
+        time.sleep(0.1)
+
+
+def add_to_cart(cart, qrcode_id):
+    """
+    QRコードをカートに加え、(表示の種類, メッセージ) を返す。
+    QRCodeIDは「商品タグ_連番」なので、商品と在庫数はキャッシュから調べます（通信しません）。
+    QRコードが使用済みかどうかは、確定するときにまとめて確認します。
+    """
+    if qrcode_id in cart:
+        return "info", f"{qrcode_id} は既にカートに入っています。"
+    product_data_with_id = database.get_product_by_tag(qrcode_id.rsplit("_", 1)[0])
+    if not product_data_with_id:
+        return "error", f"QRコード '{qrcode_id}' に紐づく商品が見つかりませんでした。"
+    product = product_data_with_id['fields']
+    in_cart = sum(1 for item in cart.values() if item["product_id"] == product_data_with_id['id'])
+    if product.get('CurrentStock', 0) <= in_cart:
+        return "error", f"「{product['ProductName']}」の在庫が足りません（在庫 {product.get('CurrentStock', 0)} {product.get('Unit', '')}）。"
+    cart[qrcode_id] = {"product_id": product_data_with_id['id'], "ProductName": product['ProductName'], "Unit": product.get('Unit', '')}
+    return "success", f"「{product['ProductName']}」をカートに入れました（{qrcode_id}）。"
+
+
+def show_cart(area, cart):
+    """カートの中身を品目ごとにまとめて表示する"""
+    if not cart:
+        area.caption("カートは空です。")
+        return
+    by_product = {}
+    for qrcode_id, item in cart.items():
+        by_product.setdefault(item["product_id"], (item, []))[1].append(qrcode_id)
+    lines = [f"**カート（{len(cart)}点）**"]
+    for item, qrcode_ids in by_product.values():
+        lines.append(f"- {item['ProductName']} × {len(qrcode_ids)} {item['Unit']}（{', '.join(qrcode_ids)}）")
+    area.markdown("\n".join(lines))
+
+
+def commit_cart(cart, name):
+    """カートのQRコードをまとめて確認し、使用を記録する（QRコードの更新と在庫の減算はそれぞれまとめて書き込みます）"""
+    qrcodes = database.get_qrcodes_data(list(cart))
+    if qrcodes is None:
+        return
+    unusable = [c for c in cart if c not in qrcodes or qrcodes[c]['fields'].get('Status') == '使用済み']
+    if unusable:
+        for qrcode_id in unusable:
+            del cart[qrcode_id]
+        st.error(f"見つからないか既に使用されているため、カートから外しました: {', '.join(unusable)}")
+        return
+
+    if any(qrcodes[c].get('unverified') for c in cart):
+        st.warning("データベースにつながらないため、QRコードの確認は接続が戻ってから行います。")
+    items = [(qrcodes[c]['id'], qrcodes[c]['fields'].get('Product', [cart[c]['product_id']])[0], c) for c in cart]
+    new_stocks = database.consume_qrcodes(items, used_by=name)
+    if new_stocks is None:
+        return
+    counts = {}
+    for item in cart.values():
+        counts[item["ProductName"]] = counts.get(item["ProductName"], 0) + 1
+    st.session_state.cart_message = (
+        f"{len(cart)}点の使用を記録しました: " + "、".join(f"{product_name} × {count}" for product_name, count in counts.items())
+    )
+    cart.clear()
+    st.rerun()
@@ -0,0 +1,336 @@
+# ==============================================================================
+# write_queue.py
+# 使用登録（QRコードの使用済み化と在庫の減算）を、ローカルのSQLiteファイルに記録してから
+# バックグラウンドでAirtableへ送る書き込みキューです（DATABASE_BACKEND = "airtable" のとき使用）。
+#   - 画面ではキューへの記録だけを待つため、Airtableが遅い・つながらないときもすぐに完了します。
+#   - 同じQRコードはキューに1度しか入らないため、送信前でも二重使用を防げます（再起動後も有効）。
+#   - 送信は「QRコードを使用済みにする → 在庫を減らす」の2段階で、段階ごとに完了を記録します。
+#     Airtable上ですでに自分が使用済みにしたQRコードは再送せず、在庫を二重に減らしません。
+#   - Airtableにつながらずレコードが分からない使用登録は、QRCodeIDだけで積み、送信時にレコードを調べます。
+# ==============================================================================
+import contextlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+from backends import BATCH_SIZE
+from sync import RETRY_BASE_DELAY, RETRY_MAX_DELAY
+
+logger = logging.getLogger(__name__)
+
+# キューの状態
+QUEUED = "queued"  # 未送信
+MARKED = "marked"  # QRコードは使用済みにした（在庫の減算が未送信）
+DONE = "done"  # 送信完了
+REJECTED = "rejected"  # 他の端末ですでに使用済みだったなど、送信できなかった
+
+# 送信完了した記録を残しておく時間（Airtable上でも使用済みになったあとは不要です）
+DONE_RETENTION = 24 * 60 * 60  # 秒
+
+
+class ConsumeQueue:
+    """使用登録を保存するSQLiteのキュー"""
+
+    def __init__(self, path):
+        self.path = path
+        # 画面のスレッドと送信スレッドの両方から使うため、1つの接続をロックで守ります。
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        # キューに積まれたときに呼ばれる関数（QueueFlusher.wakeup を設定します）
+        self.on_enqueue = None
+        with self._lock, self._conn:
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(consume_queue)")]
+            # QRCodeIDの列が無い以前のファイルは、作り直して記録を移します。
+            migrate = columns and "qrcode_id" not in columns
+            if migrate:
+                self._conn.execute("ALTER TABLE consume_queue RENAME TO consume_queue_old")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS consume_queue ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, qrcode_record_id TEXT UNIQUE, qrcode_id TEXT UNIQUE, "
+                "product_record_id TEXT NOT NULL, used_at TEXT NOT NULL, used_by TEXT, "
+                "state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+                "next_attempt_at REAL NOT NULL DEFAULT 0, last_error TEXT, updated_at REAL NOT NULL)"
+            )
+            if migrate:
+                moved = ", ".join(columns)
+                self._conn.execute(f"INSERT INTO consume_queue ({moved}) SELECT {moved} FROM consume_queue_old")
+                self._conn.execute("DROP TABLE consume_queue_old")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_consume_queue_state ON consume_queue (state, next_attempt_at)")
+
+    def enqueue(self, entries):
+        """
+        使用登録をまとめてキューに積む（entries は (QRコードのレコードID, 商品のレコードID, 使用日時, 使用者, QRCodeID) のリスト）。
+        Airtableにつながらずレコードが分からない場合は、レコードIDをNoneにしてQRCodeIDで積みます。
+        すでに積まれているQRコードが1つでもあれば何も積まず、そのレコードID（またはQRCodeID）のリストを返します（積めたら空のリスト）。
+        """
+        qrcode_record_ids = [entry[0] for entry in entries if entry[0]]
+        qrcode_ids = [entry[4] for entry in entries if entry[4]]
+        now = time.time()
+        with self._lock, self._conn:
+            existing = [row[0] for row in self._conn.execute(
+                f"SELECT COALESCE(qrcode_record_id, qrcode_id) FROM consume_queue "
+                f"WHERE qrcode_record_id IN ({','.join('?' * len(qrcode_record_ids))}) "
+                f"OR qrcode_id IN ({','.join('?' * len(qrcode_ids))})",
+                qrcode_record_ids + qrcode_ids,
+            )]
+            if existing:
+                return existing
+            self._conn.executemany(
+                "INSERT INTO consume_queue "
+                "(qrcode_record_id, product_record_id, used_at, used_by, qrcode_id, state, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(*entry, QUEUED, now) for entry in entries],
+            )
+        if self.on_enqueue:
+            self.on_enqueue()
+        return []
+
+    def contains(self, qrcode_record_id=None, qrcode_id=None):
+        """このQRコードがキューに積まれているか（送信前・送信済みを問わず。レコードIDかQRCodeIDで調べます）"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM consume_queue WHERE qrcode_record_id = ? OR qrcode_id = ?", (qrcode_record_id, qrcode_id)
+            ).fetchone() is not None
+
+    def set_qrcode_record_id(self, seq, qrcode_record_id):
+        """QRCodeIDで積んだ記録にレコードIDを設定する（同じQRコードがレコードIDで積まれていればFalseを返す）"""
+        try:
+            with self._lock, self._conn:
+                self._conn.execute(
+                    "UPDATE consume_queue SET qrcode_record_id = ?, updated_at = ? WHERE seq = ?",
+                    (qrcode_record_id, time.time(), seq),
+                )
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+    def pending_by_product(self):
+        """商品ごとの、まだAirtableの在庫に反映していない使用数"""
+        with self._lock:
+            return dict(self._conn.execute(
+                "SELECT product_record_id, COUNT(*) FROM consume_queue WHERE state IN (?, ?) GROUP BY product_record_id",
+                (QUEUED, MARKED),
+            ).fetchall())
+
+    def counts(self):
+        """状態ごとの件数（画面表示用）"""
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT state, COUNT(*) FROM consume_queue GROUP BY state").fetchall())
+        return {state: counts.get(state, 0) for state in (QUEUED, MARKED, DONE, REJECTED)}
+
+    def rejected(self, limit=50):
+        """送信できなかった使用登録（新しい順）"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT COALESCE(qrcode_id, qrcode_record_id), product_record_id, used_at, used_by, last_error FROM consume_queue "
+                "WHERE state = ? ORDER BY seq DESC LIMIT ?",
+                (REJECTED, limit),
+            ).fetchall()
+        return [dict(zip(("qrcode_id", "product_record_id", "used_at", "used_by", "error"), row)) for row in rows]
+
+    def take(self, limit):
+        """送信する記録を古い順に取り出す（再試行待ちのものは除く）"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT seq, qrcode_record_id, product_record_id, used_at, used_by, state, attempts, qrcode_id "
+                "FROM consume_queue "
+                "WHERE state IN (?, ?) AND next_attempt_at <= ? ORDER BY seq LIMIT ?",
+                (QUEUED, MARKED, time.time(), limit),
+            ).fetchall()
+
+    def set_state(self, seqs, state, error=None):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE consume_queue SET state = ?, last_error = ?, updated_at = ? WHERE seq = ?",
+                [(state, error, time.time(), seq) for seq in seqs],
+            )
+
+    def schedule_retry(self, rows, error):
+        """送信できなかった記録を、待ち時間を延ばして再送させる（途中まで送れて完了にした記録はそのまま）"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE consume_queue SET attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ? "
+                "WHERE seq = ? AND state IN (?, ?)",
+                [
+                    (row[6] + 1, now + min(RETRY_BASE_DELAY * 2 ** row[6], RETRY_MAX_DELAY), error, now, row[0], QUEUED, MARKED)
+                    for row in rows
+                ],
+            )
+
+    def prune(self, older_than=DONE_RETENTION):
+        """送信完了から時間が経った記録を削除する"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM consume_queue WHERE state = ? AND updated_at < ?", (DONE, time.time() - older_than)
+            )
+
+
+class QueueFlusher:
+    """キューの使用登録をバックグラウンドでまとめてAirtableへ送る"""
+
+    def __init__(self, queue, remote, interval=5.0, linger=0.5, batch_size=50, on_flushed=None, on_rejected=None,
+                 lock_products=None):
+        self.queue = queue
+        self.remote = remote
+        self.interval = interval
+        # 積まれてから送信するまで少し待ち、その間に積まれた分を1回の送信にまとめます。
+        self.linger = linger
+        self.batch_size = batch_size
+        # 在庫を更新した商品レコードのリストを受け取る関数（キャッシュの更新に使います）
+        self.on_flushed = on_flushed
+        # 送信できなかった記録があったときに呼ばれる関数
+        self.on_rejected = on_rejected
+        # 商品のレコードIDのリストを受け取り、その商品のロックを取るコンテキストマネージャを返す関数。
+        # 在庫の読み取り〜書き込みの間に、棚卸しなどほかの処理が同じ商品の在庫を書き換えないようにします。
+        self.lock_products = lock_products
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        queue.on_enqueue = self.wakeup
+
+    # --- スレッドの制御 ---
+    def start(self):
+        """バックグラウンドの送信スレッドを開始する"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="consume-queue", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+
+    def wakeup(self):
+        """次の周期を待たずに送信させる"""
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                while self.flush_once():
+                    pass  # 残りがあれば続けて送ります
+                self.queue.prune()
+            except Exception:
+                logger.exception("使用登録の送信に失敗しました")
+            if self._wakeup.wait(self.interval):
+                self._stop.wait(self.linger)
+            self._wakeup.clear()
+
+    # --- 送信 ---
+    def flush_once(self):
+        """キューから1回分を取り出して送信する。送信できたものがあればTrueを返す"""
+        rows = self.queue.take(self.batch_size)
+        if not rows:
+            return False
+        queued = [row for row in rows if row[5] == QUEUED]
+        marked = [row for row in rows if row[5] == MARKED]
+        try:
+            marked += self._mark_qrcodes(queued)
+        except Exception as e:
+            logger.exception("QRコードの使用済み化に失敗しました（%d件）", len(queued))
+            self.queue.schedule_retry(queued, str(e))
+        if marked:
+            try:
+                self._decrement_stock(marked)
+            except Exception as e:
+                logger.exception("在庫の更新に失敗しました（%d件）", len(marked))
+                self.queue.schedule_retry(marked, str(e))
+                return False
+        return True
+
+    def _mark_qrcodes(self, rows):
+        """QRコードを使用済みにし、在庫を減らす段階に進めた記録を返す"""
+        if not rows:
+            return []
+        rows, rejected = self._resolve_qrcodes(rows)
+        remote = {r['id']: r['fields'] for r in self.remote.get_many("QRCodes", [row[1] for row in rows])} if rows else {}
+        to_mark, already = [], []
+        for row in rows:
+            fields = remote.get(row[1])
+            if fields is None:
+                rejected.append((row, "QRコードがAirtableに見つかりません"))
+            elif fields.get("Status") != "使用済み":
+                to_mark.append(row)
+            elif fields.get("UsedAt") == row[3] and fields.get("UsedBy") == row[4]:
+                # 前回の送信でQRコードの更新だけ成功していた場合（在庫の減算から再開します）
+                already.append(row)
+            else:
+                rejected.append((row, "他の端末ですでに使用済みです"))
+
+        if to_mark:
+            self.remote.batch_update("QRCodes", [
+                {"id": row[1], "fields": {"Status": "使用済み", "UsedAt": row[3], "UsedBy": row[4]}}
+                for row in to_mark
+            ])
+        advanced = to_mark + already
+        self.queue.set_state([row[0] for row in advanced], MARKED)
+        if rejected:
+            for row, reason in rejected:
+                logger.warning("使用登録を送信できませんでした（%s）: %s", row[7] or row[1], reason)
+                self.queue.set_state([row[0]], REJECTED, reason)
+            if self.on_rejected:
+                self.on_rejected()
+        return advanced
+
+    def _resolve_qrcodes(self, rows):
+        """
+        QRCodeIDだけで積んだ記録のQRコードのレコードを調べ、(レコードIDのそろった記録, 送信できない記録と理由) を返す。
+        QRコードが見つからない・商品が違う・同じQRコードがレコードIDで積まれている記録は送信しません。
+        """
+        unresolved = {row[7]: row for row in rows if row[1] is None}
+        if not unresolved:
+            return rows, []
+        found = {}
+        cursor = None
+        while True:
+            records, cursor = self.remote.query_page(
+                "QRCodes", [("QRCodeID", "in", list(unresolved))], page_size=100, cursor=cursor
+            )
+            found.update({r['fields'].get("QRCodeID"): r for r in records})
+            if not cursor:
+                break
+
+        resolved, rejected = [row for row in rows if row[1] is not None], []
+        for qrcode_id, row in unresolved.items():
+            record = found.get(qrcode_id)
+            if record is None:
+                rejected.append((row, "QRコードがAirtableに見つかりません"))
+            elif record['fields'].get("Product", [None])[0] != row[2]:
+                rejected.append((row, "QRコードに紐づく商品が異なります"))
+            elif not self.queue.set_qrcode_record_id(row[0], record['id']):
+                rejected.append((row, "同じQRコードの使用登録がすでにあります"))
+            else:
+                resolved.append((row[0], record['id'], *row[2:]))
+        return resolved, rejected
+
+    def _decrement_stock(self, rows):
+        """
+        商品ごとに使用数をまとめて、Airtable上の最新の在庫数から減らす。
+        BATCH_SIZE 商品ずつ送って記録を完了にしていくため、再送で減らすのはまだ送れていない商品だけです。
+        """
+        rows_by_product = defaultdict(list)
+        for row in rows:
+            rows_by_product[row[2]].append(row)
+        product_ids = list(rows_by_product)
+        for start in range(0, len(product_ids), BATCH_SIZE):
+            chunk = product_ids[start:start + BATCH_SIZE]
+            with self.lock_products(chunk) if self.lock_products else contextlib.nullcontext():
+                remote = {r['id']: r['fields'] for r in self.remote.get_many("Products", chunk)}
+                updates = [
+                    {"id": product_id, "fields": {
+                        "CurrentStock": (remote.get(product_id, {}).get("CurrentStock") or 0) - len(rows_by_product[product_id])
+                    }}
+                    for product_id in chunk
+                ]
+                updated = self.remote.batch_update("Products", updates)
+                self.queue.set_state([row[0] for product_id in chunk for row in rows_by_product[product_id]], DONE)
+            if self.on_flushed:
+                self.on_flushed(updated)